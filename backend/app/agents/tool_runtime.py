@@ -7,7 +7,7 @@ from psycopg.rows import dict_row
 
 
 from app.agents.http_tool import HttpTool  # you already have this
-from app.rag.index import rag_search
+from app.rag.index import rag_search, rag_search_federated
 from app.core.db import get_conn
 
 
@@ -21,17 +21,26 @@ class ToolProto:
 class RagSearchTool(ToolProto):
     name = "rag.search"
 
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, corpora: Optional[List[str]] = None):
         self.user_id = user_id
+        # shared corpora from the tool config (cloned from the agent template)
+        self.corpora = list(corpora or [])
 
     def run(self, query: str, k: int = 6, source: str | None = None, min_score: float = 0.0):
-        hits = self._search_impl(query, k=k*2)  # overfetch a bit
-        if source:
-            s = source.lower()
-            hits = [h for h in hits if s in (h.get("metadata", {}).get("source","").lower())]
-        if min_score:
-            hits = [h for h in hits if (h.get("score") or 0.0) >= min_score]
-        return hits[:k]
+        """{"hits": [...]} on success, {"hits": [], "error": ...} on a bad request."""
+        # both constraints are evaluated inside the index search, so a filtered
+        # query still returns k hits whenever k matching chunks exist
+        filters = {"source_contains": source} if source else None
+        try:
+            if self.corpora:
+                hits = rag_search_federated(
+                    self.user_id, query, self.corpora, k=k, filters=filters, min_score=min_score or None
+                )
+            else:
+                hits = rag_search(self.user_id, query, k=k, filters=filters, min_score=min_score or None)
+        except ValueError as e:  # e.g. a corpus the deployment does not share
+            return {"hits": [], "error": str(e)}
+        return {"hits": hits}
 
 
 def _ensure_dict(cfg: Any) -> dict:
@@ -95,7 +104,7 @@ def build_tools_for_user(
             tools[name] = HttpTool(cfg)
         elif kind == "rag.search":
             # allow custom-named alias of rag.search if desired
-            tools[name] = RagSearchTool(user_id)
+            tools[name] = RagSearchTool(user_id, corpora=cfg.get("corpora"))
         # elif kind == "your_future_kind": tools[name] = ...
         else:
             # unknown kind: skip silently or log
@@ -1,13 +1,67 @@
 from __future__ import annotations
-from fastapi import APIRouter, Depends
+import os
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from app.api.files import ingest_upload
 from app.core.db import get_conn
 from app.core.security import get_current_user, Authed
 from app.core.provisioning import provision_user_defaults
+from app.rag.index import (
+    RAG_SHARED_CORPORA,
+    chunk_cache_stats,
+    corpus_store_id,
+    delete_source,
+    embed_batcher_stats,
+    index_cache_stats,
+    list_sources,
+    query_cache_stats,
+    result_cache_stats,
+)
+
+# user ids allowed to build shared corpora (comma-separated)
+RAG_CORPUS_ADMINS = {u.strip() for u in os.getenv("RAG_CORPUS_ADMINS", "").split(",") if u.strip()}
 
 router = APIRouter(prefix="/v1/admin", tags=["admin"])
 
+def require_corpus_admin(user: Authed = Depends(get_current_user)) -> Authed:
+    if user.user_id not in RAG_CORPUS_ADMINS:
+        raise HTTPException(403, "Not a corpus admin (RAG_CORPUS_ADMINS)")
+    return user
+
+def _corpus_id(name: str) -> str:
+    try:
+        return corpus_store_id(name)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
 @router.post("/provision")
 def reprovision_me(user: Authed = Depends(get_current_user)):
     with get_conn() as conn:
         agent_id = provision_user_defaults(conn, user.user_id)
         return {"ok": True, "agent_id": agent_id}
+
+@router.get("/rag/stats")
+def rag_stats(user: Authed = Depends(require_corpus_admin)):
+    """Process-local RAG cache and embedding-batcher counters, for sizing budgets."""
+    return {
+        "index_cache": index_cache_stats(),
+        "query_cache": query_cache_stats(),
+        "result_cache": result_cache_stats(),
+        "chunk_cache": chunk_cache_stats(),
+        "embedder": embed_batcher_stats(),
+    }
+
+# Shared corpora: built here, searched by tenants once listed in RAG_SHARED_CORPORA
+
+@router.post("/rag/corpora/{name}/files")
+def upload_corpus_file(name: str, file: UploadFile = File(...), user: Authed = Depends(require_corpus_admin)):
+    """Extract, chunk, and upsert a file into the shared corpus `name`."""
+    return dict(ingest_upload(_corpus_id(name), file), corpus=name, shared=name in RAG_SHARED_CORPORA)
+
+@router.get("/rag/corpora/{name}/files")
+def list_corpus_files(name: str, user: Authed = Depends(require_corpus_admin)):
+    items = list_sources(_corpus_id(name))
+    return {"files": items, "total_chunks": sum(i["chunks"] for i in items), "shared": name in RAG_SHARED_CORPORA}
+
+@router.delete("/rag/corpora/{name}/files/{source}")
+def delete_corpus_file(name: str, source: str, user: Authed = Depends(require_corpus_admin)):
+    return {"ok": True, "removed": delete_source(_corpus_id(name), source)}
@@ -22,7 +22,7 @@ from app.memory.history import trim_and_summarize
 # If you created a helper to build tool instances from DB rows:
 #   from app.agents.build_tools import build_tools_for_user
 # If not, we'll include a tiny fallback for RAG only:
-from app.rag.index import rag_search
+from app.rag.index import rag_search, rag_search_federated
 
 router = APIRouter()
 
@@ -83,9 +83,16 @@ class _RagTool:
     name: str = "rag.search"
     def __init__(self, user_id: str, config: dict | None = None):
         self.user_id = user_id
+        self.corpora = list((config or {}).get("corpora") or [])
 
     def run(self, query: str, k: int = 4):
-        docs = rag_search(self.user_id, query=query, k=k)
+        if self.corpora:
+            try:
+                docs = rag_search_federated(self.user_id, query, self.corpora, k=k)
+            except ValueError as e:  # a corpus the deployment does not share
+                return {"results": [], "error": str(e)}
+        else:
+            docs = rag_search(self.user_id, query=query, k=k)
         return {"results": docs}
 
 def _build_tools_for_user(user_id: str, tool_rows: List[dict]) -> dict[str, object]:
@@ -24,6 +24,11 @@ def upload_file(file: UploadFile = File(...), user: Authed = Depends(get_current
     Upload a file, extract text, chunk, and upsert into the user's RAG index.
     Accepts PDF / DOCX / TXT.
     """
+    return ingest_upload(user.user_id, file)
+
+
+def ingest_upload(store_id: str, file: UploadFile) -> dict:
+    """Extract, chunk, and upsert an uploaded file into the store `store_id`."""
     try:
         with NamedTemporaryFile(delete=False) as tmp:
             shutil.copyfileobj(file.file, tmp)
@@ -56,7 +61,7 @@ def upload_file(file: UploadFile = File(...), user: Authed = Depends(get_current
 
     try:
         n = upsert_chunks_for_source(
-            user_id=user.user_id,
+            user_id=store_id,
             source=source,
             chunks=chunks,
             metadata=extracted.get("meta") or {},
@@ -64,7 +69,12 @@ def upload_file(file: UploadFile = File(...), user: Authed = Depends(get_current
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Index upsert failed: {e!s}")
 
-    return {"ok": True, "source": source, "chunks_added": n, "meta": extracted.get("meta") or {}}
+    return {
+        "ok": True,
+        "source": source,
+        "chunks_added": n,
+        "meta": extracted.get("meta") or {},
+    }
 
 
 @router.get("/v1/files")
@@ -0,0 +1,38 @@
+# app/api/health.py
+from __future__ import annotations
+
+from typing import Dict, Optional
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+router = APIRouter(tags=["health"])
+
+# set once by the app lifespan after the embedding model is loaded and warm
+_STATE: Dict = {"ready": False, "error": None, "embeddings": None}
+
+
+def mark_ready(embeddings: Optional[Dict] = None) -> None:
+    _STATE.update(ready=True, error=None, embeddings=embeddings)
+
+
+def mark_failed(error: str) -> None:
+    _STATE.update(ready=False, error=error)
+
+
+@router.get("/health")
+def health():
+    """Liveness: the process is up and serving HTTP."""
+    return {"ok": True}
+
+
+@router.get("/health/ready")
+def health_ready():
+    """
+    Readiness: 200 once startup warm-up has finished, 503 before that (or if it
+    failed), so load balancers only route traffic to warm workers.
+    """
+    body = {"ready": _STATE["ready"], "embeddings": _STATE["embeddings"]}
+    if _STATE["error"]:
+        body["error"] = _STATE["error"]
+    return JSONResponse(body, status_code=200 if _STATE["ready"] else 503)
@@ -1,25 +1,96 @@
 # app/api/search.py
 from __future__ import annotations
 
-from typing import Optional
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Union
 
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 
 from app.api.auth import Authed, get_current_user
-from app.rag.index import rag_search, list_loaded_sources, rag_query_with_trace
+from app.rag.index import (
+    rag_search,
+    rag_search_many,
+    list_loaded_sources,
+    rag_query_with_trace,
+    set_search_params,
+)
 
 router = APIRouter()
 
+SearchMode = Literal["vector", "lexical", "hybrid"]
+
+class SearchFilters(BaseModel):
+    source: Optional[Union[str, List[str]]] = None
+    source_contains: Optional[str] = None
+    mime: Optional[Union[str, List[str]]] = None
+    file_id: Optional[Union[str, List[str]]] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+    def to_dict(self) -> Dict:
+        out = self.model_dump(exclude_none=True)
+        for key in ("uploaded_after", "uploaded_before"):
+            if key in out:
+                out[key] = out[key].timestamp()
+        return out
+
 class SearchIn(BaseModel):
     query: str = Field(..., min_length=1)
     k: Optional[int] = 5
+    # None -> server default (RAG_SEARCH_MODE)
+    mode: Optional[SearchMode] = None
+    filters: Optional[SearchFilters] = None
+    min_score: Optional[float] = None
 
 @router.post("/v1/search")
 def search_docs(payload: SearchIn, user: Authed = Depends(get_current_user)):
     try:
-        hits = rag_search(user.user_id, payload.query, k=payload.k or 5)
+        hits = rag_search(
+            user.user_id,
+            payload.query,
+            k=payload.k or 5,
+            mode=payload.mode,
+            filters=payload.filters.to_dict() if payload.filters else None,
+            min_score=payload.min_score,
+        )
         return {"query": payload.query, "k": payload.k or 5, "hits": hits}
+    except ValueError as e:  # bad mode / filters
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {e!s}")
+
+
+
+class SearchBatchIn(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=64)
+    k: Optional[int] = 5
+    mode: Optional[SearchMode] = None
+    filters: Optional[SearchFilters] = None
+    min_score: Optional[float] = None
+
+@router.post("/v1/search/batch")
+def search_docs_batch(payload: SearchBatchIn, user: Authed = Depends(get_current_user)):
+    """
+    Run several queries in one request; they share a single embedding batch
+    and a single index search.
+    """
+    k = payload.k or 5
+    try:
+        results = rag_search_many(
+            user.user_id,
+            payload.queries,
+            k=k,
+            mode=payload.mode,
+            filters=payload.filters.to_dict() if payload.filters else None,
+            min_score=payload.min_score,
+        )
+        return {
+            "k": k,
+            "results": [{"query": q, "hits": hits} for q, hits in zip(payload.queries, results)],
+        }
+    except ValueError as e:  # bad mode / filters
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {e!s}")
 
@@ -60,4 +131,22 @@ def rag_query(body: RAGQueryIn, user: Authed = Depends(get_current_user)):
             })
         return {"hits": out_hits, "by_source": tally}
     except Exception as e:
-        raise HTTPException(500, f"Query failed: {e!s}")
\ No newline at end of file
+        raise HTTPException(500, f"Query failed: {e!s}")
+
+
+class SearchParamsIn(BaseModel):
+    nprobe: Optional[int] = Field(None, ge=1, le=4096)
+    ef_search: Optional[int] = Field(None, ge=1, le=4096)
+
+@router.put("/v1/rag/search-params")
+def rag_search_params(body: SearchParamsIn, user: Authed = Depends(get_current_user)):
+    """
+    Tune recall vs. latency for this user's approximate index
+    (IVF nprobe / HNSW efSearch). Ignored while the index is still flat.
+    """
+    try:
+        return set_search_params(user.user_id, nprobe=body.nprobe, ef_search=body.ef_search)
+    except ValueError as e:  # not per-user tunable on this backend
+        raise HTTPException(409, str(e))
+    except Exception as e:
+        raise HTTPException(500, f"Update failed: {e!s}")
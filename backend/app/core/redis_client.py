@@ -7,3 +7,11 @@ def get_redis():
   if _redis is None:
     _redis = redis.from_url(REDIS_URL, decode_responses=True)
   return _redis
+
+_redis_bytes = None
+def get_redis_bytes():
+  """Same server as get_redis(), but without response decoding (binary payloads)."""
+  global _redis_bytes
+  if _redis_bytes is None:
+    _redis_bytes = redis.from_url(REDIS_URL)
+  return _redis_bytes
@@ -15,6 +15,8 @@ class Settings(BaseSettings):
     EMBEDDINGS_BACKEND: str = "hf"
     EMBEDDINGS_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2"
     RAG_STORE_DIR: str = ".rag_store"
+    # "faiss" (files under RAG_STORE_DIR) or "pgvector" (Postgres tables)
+    RAG_BACKEND: str = "faiss"
 
     #EMBEDDINGS_BACKEND=llama
     #EMBEDDINGS_MODEL=text-embedding-3-small     # name doesn’t matter to llama.cpp, but LangChain requires a string
@@ -1,3 +1,7 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -12,9 +16,28 @@ from app.api.tools import router as tools_router
 from app.api.agents import router as agents_router
 from app.api.agents_tools import router as agent_tools_router
 from app.api.admin import router as admin_router
+from app.api.health import router as health_router, mark_failed, mark_ready
+from app.rag.index import warm_up
+
+# load + warm the embedding model before the worker accepts requests
+RAG_PRELOAD = os.getenv("RAG_PRELOAD", "true").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if RAG_PRELOAD:
+        try:
+            mark_ready(await asyncio.to_thread(warm_up))
+        except Exception as e:
+            # keep serving liveness, but stay out of rotation until fixed
+            print(f"[startup] warning: embedding warm-up failed: {e!s}")
+            mark_failed(str(e))
+    else:
+        mark_ready()
+    yield
 
 
-app = FastAPI(title="Agent Mega Stack API", version="0.1.0")
+app = FastAPI(title="Agent Mega Stack API", version="0.1.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,6 +59,7 @@ app.include_router(tools_router)
 app.include_router(agents_router)
 app.include_router(agent_tools_router)
 app.include_router(admin_router)
+app.include_router(health_router) # /health, /health/ready
 
 @app.get("/openapi.json")
 def openapi_json():
@@ -0,0 +1,332 @@
+# app/rag/ann.py
+from __future__ import annotations
+
+import math
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import faiss
+
+# Index kinds a user store can be in. "flat" is exact brute force; the others
+# are approximate and are only built once a corpus is big enough to train them.
+FLAT = "flat"
+HNSW = "hnsw"
+IVF_FLAT = "ivf_flat"
+IVF_PQ = "ivf_pq"
+ANN_KINDS = (HNSW, IVF_FLAT, IVF_PQ)
+
+RAG_ANN_KIND = os.getenv("RAG_ANN_KIND", HNSW)
+# vector count at which a flat store is promoted to RAG_ANN_KIND (0 disables)
+RAG_ANN_THRESHOLD = int(os.getenv("RAG_ANN_THRESHOLD", "50000"))
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "80"))
+DEFAULT_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "16"))
+DEFAULT_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "64"))
+
+# Vector storage inside the search structure:
+#   none    full float32 vectors
+#   sq8     8-bit scalar codes (4x smaller), for flat, HNSW and IVF stores
+#   pq      SQ8 while flat, product-quantized IVF-PQ codes once promoted
+#   binary  sign bits only (32x smaller), scanned by Hamming distance; never
+#           promoted, since a popcount scan stays fast at these sizes
+# Quantized stores re-score the top RAG_RERANK_FACTOR * k candidates (at least
+# RAG_BINARY_CANDIDATES for binary codes) against the exact float16 vectors
+# kept in the memory-mapped docstore.
+RAG_QUANTIZATION = os.getenv("RAG_QUANTIZATION", "none").lower()
+RAG_RERANK_FACTOR = int(os.getenv("RAG_RERANK_FACTOR", "4"))
+RAG_BINARY_CANDIDATES = int(os.getenv("RAG_BINARY_CANDIDATES", "256"))
+# quantized scores can undershoot the exact ones; a min_score range search on a
+# quantized index uses a radius this much lower and re-checks after re-ranking
+RANGE_MARGIN = 0.05
+
+FLOAT32 = "float32"
+SQ8 = "sq8"
+PQ = "pq"
+BINARY = "binary"
+
+
+def _inner(index: faiss.Index) -> faiss.Index:
+    if isinstance(index, faiss.IndexBinaryIDMap2):
+        return faiss.downcast_IndexBinary(index.index)
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+
+
+def is_binary(index) -> bool:
+    return isinstance(index, faiss.IndexBinary)
+
+
+def binarize(vecs: np.ndarray) -> np.ndarray:
+    """Sign-bit codes of (n, d) float vectors -> (n, d / 8) uint8."""
+    return np.packbits(np.asarray(vecs) > 0, axis=1)
+
+
+def index_kind(index: faiss.Index) -> str:
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return HNSW
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return IVF_PQ
+    if isinstance(inner, faiss.IndexIVF):
+        return IVF_FLAT
+    return FLAT
+
+
+def storage_kind(index: faiss.Index) -> str:
+    if is_binary(index):
+        return BINARY
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexIVFPQ, faiss.IndexPQ)):
+        return PQ
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return SQ8
+    return FLOAT32
+
+
+def is_quantized(index: faiss.Index) -> bool:
+    return storage_kind(index) != FLOAT32
+
+
+def _quantize() -> bool:
+    return RAG_QUANTIZATION in (SQ8, PQ)
+
+
+def _preset_sq8(sq_index: faiss.Index, d: int) -> None:
+    """
+    Give a uniform 8-bit quantizer a fixed range instead of training it. Components
+    of a unit vector are ~N(0, 1/d), so +-6/sqrt(d) covers them; the rare outlier
+    is clipped, which only costs candidate recall, not final ordering (re-rank).
+    """
+    r = min(1.0, 6.0 / math.sqrt(d))
+    faiss.copy_array_to_vector(np.array([-r, 2 * r], dtype="float32"), sq_index.sq.trained)
+    sq_index.is_trained = True
+
+
+def _flat_storage() -> str:
+    if RAG_QUANTIZATION == BINARY:
+        return BINARY
+    return SQ8 if _quantize() else FLOAT32
+
+
+def build_flat(d: int) -> faiss.Index:
+    # cosine via normalized vectors; the ID map gives every chunk a stable
+    # int64 id so single sources can be removed without touching the rest
+    if RAG_QUANTIZATION == BINARY:
+        if d % 8:
+            raise ValueError(f"binary codes need a dimension divisible by 8, got {d}")
+        return faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(d))
+    if not _quantize():
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    inner = faiss.IndexScalarQuantizer(
+        d, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_INNER_PRODUCT
+    )
+    _preset_sq8(inner, d)
+    return faiss.IndexIDMap2(inner)
+
+
+def conforms(index: faiss.Index) -> bool:
+    """False when a flat store's vector storage no longer matches RAG_QUANTIZATION."""
+    if index_kind(index) != FLAT:
+        return True
+    return storage_kind(index) == _flat_storage()
+
+
+def promotion_kind() -> str:
+    return IVF_PQ if RAG_QUANTIZATION == PQ else RAG_ANN_KIND
+
+
+def _nlist_for(n: int) -> int:
+    # usual rule of thumb (~4*sqrt(n)), keeping >= 39 training points per list
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def _pq_m_for(d: int) -> int:
+    # largest sub-quantizer count giving >= 4 dims per sub-vector
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2):
+        if d % m == 0 and d // m >= 4:
+            return m
+    return 1
+
+
+def build_trained(kind: str, vecs: np.ndarray, ids: np.ndarray) -> faiss.Index:
+    """Build an approximate index of `kind` over vecs (trained on them) keyed by ids."""
+    n, d = vecs.shape
+    if kind == HNSW:
+        if _quantize():
+            inner = faiss.IndexHNSWSQ(
+                d, faiss.ScalarQuantizer.QT_8bit_uniform, RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT
+            )
+            _preset_sq8(faiss.downcast_index(inner.storage), d)
+            inner.is_trained = True
+        else:
+            inner = faiss.IndexHNSWFlat(d, RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = RAG_HNSW_EF_CONSTRUCTION
+        index = faiss.IndexIDMap2(inner)
+    elif kind in (IVF_FLAT, IVF_PQ):
+        quantizer = faiss.IndexFlatIP(d)
+        nlist = _nlist_for(n)
+        if kind == IVF_PQ:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, _pq_m_for(d), 8, faiss.METRIC_INNER_PRODUCT)
+        elif _quantize():
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, d, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vecs)
+        # IVF takes arbitrary ids natively; the hashtable direct map keeps
+        # reconstruct() and remove_ids() working by id
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        raise ValueError(f"Unknown ANN index kind: {kind}")
+    if n:
+        index.add_with_ids(vecs, ids)
+    return index
+
+
+def add(index: faiss.Index, vecs: np.ndarray, ids: np.ndarray) -> None:
+    """add_with_ids for float vectors, binarizing them for a binary index."""
+    index.add_with_ids(binarize(vecs) if is_binary(index) else vecs, ids)
+
+
+def search(
+    index: faiss.Index, qv: np.ndarray, k: int, params: Optional[faiss.SearchParameters] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    index.search for float queries. Binary indexes are searched by Hamming
+    distance h, reported as the similarity 1 - 2h/d so results sort the same
+    way as inner products (candidates only; callers re-rank them exactly).
+    """
+    if not is_binary(index):
+        return index.search(qv, k, params=params)
+    dist, labels = index.search(binarize(qv), k, params=params)
+    return 1.0 - 2.0 * dist.astype("float32") / index.d, labels
+
+
+def candidates(index: faiss.Index, k: int) -> int:
+    """How many hits to fetch for k results (more when codes are re-ranked)."""
+    if not is_quantized(index):
+        return k
+    fetch = k * max(1, RAG_RERANK_FACTOR)
+    return max(fetch, RAG_BINARY_CANDIDATES) if is_binary(index) else fetch
+
+
+def supports_range_search(index: faiss.Index) -> bool:
+    return not is_binary(index)
+
+
+def write_index(index: faiss.Index, path: str) -> None:
+    if is_binary(index):
+        faiss.write_index_binary(index, path)
+    else:
+        faiss.write_index(index, path)
+
+
+def read_index(path: str, io_flags: int = 0) -> faiss.Index:
+    with open(path, "rb") as f:
+        binary = f.read(2) == b"IB"  # binary index fourccs all start with "IB"
+    if binary:
+        return faiss.read_index_binary(path, io_flags)
+    return faiss.read_index(path, io_flags)
+
+
+def serialize_index(index: faiss.Index) -> bytes:
+    if is_binary(index):
+        return faiss.serialize_index_binary(index).tobytes()
+    return faiss.serialize_index(index).tobytes()
+
+
+def deserialize_index(data: bytes) -> faiss.Index:
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if data[:2] == b"IB":
+        return faiss.deserialize_index_binary(buf)
+    return faiss.deserialize_index(buf)
+
+
+def copy_index(index: faiss.Index, deep: bool = False) -> faiss.Index:
+    """
+    Private modifiable copy. deep=True round-trips through serialization, which
+    also works for mmapped indexes and binary ID maps (clone_index can't).
+    """
+    if is_binary(index):
+        return faiss.deserialize_index_binary(faiss.serialize_index_binary(index))
+    if deep:
+        return faiss.deserialize_index(faiss.serialize_index(index))
+    return faiss.clone_index(index)
+
+
+def remove_ids(
+    index: faiss.Index,
+    ids: np.ndarray,
+    remaining: Callable[[], Tuple[np.ndarray, np.ndarray]],
+) -> faiss.Index:
+    """
+    Remove ids from index, returning the index to use afterwards. HNSW graphs
+    cannot drop nodes, so they are rebuilt from remaining() -> (vectors, ids).
+    """
+    if ids.size == 0:
+        return index
+    if index_kind(index) != HNSW:
+        index.remove_ids(ids)
+        return index
+    vecs, keep_ids = remaining()
+    return build_trained(HNSW, vecs, keep_ids)
+
+
+def should_promote(index: faiss.Index) -> bool:
+    return (
+        RAG_ANN_THRESHOLD > 0
+        and not is_binary(index)
+        and promotion_kind() in ANN_KINDS
+        and index_kind(index) == FLAT
+        and index.ntotal >= RAG_ANN_THRESHOLD
+    )
+
+
+def approx_bytes(index: faiss.Index) -> int:
+    """Rough resident size of the search structure (codes + ids + graph links)."""
+    if is_binary(index):
+        return index.ntotal * (index.code_size + 8)
+    inner = _inner(index)
+    per_vec = 8  # id map / IVF id list entry
+    if isinstance(inner, faiss.IndexHNSW):
+        per_vec += faiss.downcast_index(inner.storage).sa_code_size() + 2 * RAG_HNSW_M * 4
+    elif isinstance(inner, faiss.IndexIVF):
+        per_vec += inner.code_size
+    else:
+        per_vec += inner.sa_code_size()
+    return index.ntotal * per_vec
+
+
+def id_selector(allowed: np.ndarray) -> Tuple[faiss.IDSelector, np.ndarray]:
+    """
+    Selector accepting the ids where the bool mask `allowed` is True; ids past
+    its end are rejected. Returns (selector, packed bits): the selector only
+    points at the bits, so the caller keeps both alive for the search.
+    """
+    bits = np.packbits(np.asarray(allowed, dtype=bool), bitorder="little")
+    # faiss takes the bitmap's length in bytes, not in ids
+    return faiss.IDSelectorBitmap(bits.size, faiss.swig_ptr(bits)), bits
+
+
+def search_params(
+    index: faiss.Index, params: Dict, sel: Optional[faiss.IDSelector] = None
+) -> Optional[faiss.SearchParameters]:
+    """
+    Per-query parameters for the index kind (thread-safe, unlike setting nprobe).
+    sel restricts the search to the ids it accepts; the caller keeps it alive.
+    """
+    kind = index_kind(index)
+    if kind == HNSW:
+        out = faiss.SearchParametersHNSW(efSearch=int(params.get("ef_search") or DEFAULT_EF_SEARCH))
+    elif kind in (IVF_FLAT, IVF_PQ):
+        out = faiss.SearchParametersIVF(nprobe=int(params.get("nprobe") or DEFAULT_NPROBE))
+    elif sel is not None:
+        out = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        out.sel = sel
+    return out
@@ -0,0 +1,151 @@
+# app/rag/batcher.py
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+class Histogram:
+    """Power-of-two bucket counts (le_1, le_2, le_4, ... le_inf) plus count/sum."""
+
+    def __init__(self, max_bound: int = 1024):
+        self.bounds: List[int] = []
+        b = 1
+        while b <= max_bound:
+            self.bounds.append(b)
+            b *= 2
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: int) -> None:
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"le_{b}": n for b, n in zip(self.bounds, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "buckets": buckets,
+            "count": self.count,
+            "sum": self.sum,
+            "mean": (self.sum / self.count) if self.count else 0.0,
+        }
+
+
+class EmbeddingBatcher:
+    """
+    Single inference thread that coalesces concurrent encode calls.
+
+    Callers enqueue their texts and block on a future. The worker takes the
+    first waiting job, keeps collecting for up to max_wait_ms (or until
+    max_batch texts), sorts the combined texts by length so similar lengths
+    share padding, runs one encode, and scatters the rows back to each caller.
+    Calls larger than max_batch are split, and a call only queues its next
+    slice once the previous one is encoded: a search arriving mid-upload waits
+    for at most the batch in flight, not for the rest of the upload.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], np.ndarray],
+        *,
+        max_batch: int = 64,
+        max_wait_ms: float = 3.0,
+        name: str = "embed",
+    ):
+        self._encode = encode
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._queue: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queue_depth = Histogram()
+        self.batch_size = Histogram()
+        self.batches = 0
+        self.errors = 0
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return self._encode(texts)
+        self._ensure_started()
+        parts = []
+        for start in range(0, len(texts), self.max_batch):
+            fut: Future = Future()
+            self._queue.put((texts[start:start + self.max_batch], fut))
+            parts.append(fut.result())
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f"rag-{self.name}-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self) -> List[Tuple[List[str], Future]]:
+        jobs = [self._queue.get()]
+        n = len(jobs[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(job)
+            n += len(job[0])
+        return jobs
+
+    def _run(self) -> None:
+        while True:
+            jobs = self._collect()
+            texts = [t for job, _ in jobs for t in job]
+            with self._stats_lock:
+                self.queue_depth.observe(len(jobs) + self._queue.qsize())
+                self.batch_size.observe(len(texts))
+                self.batches += 1
+            try:
+                order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+                sorted_vecs = self._encode([texts[i] for i in order])
+                vecs = np.empty_like(sorted_vecs)
+                vecs[order] = sorted_vecs
+            except Exception as e:
+                with self._stats_lock:
+                    self.errors += 1
+                for _, fut in jobs:
+                    fut.set_exception(e)
+                continue
+            start = 0
+            for job, fut in jobs:
+                fut.set_result(vecs[start:start + len(job)])
+                start += len(job)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": self.batches,
+                "errors": self.errors,
+                "pending": self._queue.qsize(),
+                "queue_depth": self.queue_depth.snapshot(),
+                "batch_size": self.batch_size.snapshot(),
+            }
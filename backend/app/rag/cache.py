@@ -0,0 +1,237 @@
+# app/rag/cache.py
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class ByteBudgetCache:
+    """
+    Thread-safe in-process cache bounded by an approximate byte budget.
+
+    Each entry carries a caller-supplied size and an optional `stamp` (e.g. file
+    mtimes or an index generation). A lookup with a different stamp is a miss and
+    drops the stale entry. When the budget is exceeded the entry with the largest
+    size x idle-time product is evicted first, so big cold entries go before small
+    hot ones. With `ttl` set, entries older than ttl seconds are dropped on lookup.
+    get(..., keep_stale=True) leaves an outdated entry in place (still a miss) so
+    peek() can keep serving it until its replacement is put.
+    """
+
+    def __init__(self, max_bytes: int, name: str = "cache", ttl: Optional[float] = None):
+        self.name = name
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, nbytes, stamp, last_access, created)
+        self._entries: Dict[Hashable, Tuple[Any, int, Any, float, float]] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, stamp: Any = None, keep_stale: bool = False) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, nbytes, cur_stamp, _, created = entry
+            now = time.monotonic()
+            if stamp is not None and cur_stamp != stamp:
+                if not keep_stale:
+                    self._drop(key)
+                    self.invalidations += 1
+                self.misses += 1
+                return None
+            if self.ttl is not None and now - created > self.ttl:
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries[key] = (value, nbytes, cur_stamp, now, created)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """The cached value whatever its stamp, without touching stats or recency."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, nbytes: int, stamp: Any = None) -> None:
+        nbytes = max(0, int(nbytes))
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                # never cache something that alone blows the budget
+                return
+            now = time.monotonic()
+            self._entries[key] = (value, nbytes, stamp, now, now)
+            self._bytes += nbytes
+            self._evict()
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+                self.invalidations += 1
+
+    def invalidate_where(self, pred: Callable[[Hashable], bool]) -> int:
+        """Drop every entry whose key satisfies pred; returns how many were dropped."""
+        with self._lock:
+            doomed = [key for key in self._entries if pred(key)]
+            for key in doomed:
+                self._drop(key)
+            self.invalidations += len(doomed)
+            return len(doomed)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "expirations": self.expirations,
+            }
+
+    # -- internals (caller holds the lock) --
+
+    def _drop(self, key: Hashable) -> None:
+        nbytes = self._entries.pop(key)[1]
+        self._bytes -= nbytes
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._bytes > self.max_bytes and self._entries:
+            victim = max(
+                self._entries,
+                key=lambda k: self._entries[k][1] * (now - self._entries[k][3] + 1e-3),
+            )
+            self._drop(victim)
+            self.evictions += 1
+
+
+class ChunkVectorCache:
+    """
+    Persistent content-addressed vector store: sha256(text) -> embedding.
+
+    Backed by one SQLite file per embedding model (WAL mode, so several worker
+    processes can share it). Rows carry a last-used timestamp; once the file
+    holds more than max_entries rows the least recently used 10% are dropped.
+    The row count is tracked in memory from one COUNT(*) at connect time and is
+    only re-counted when the estimate crosses max_entries (replaced keys and
+    other processes' writes make it drift; the re-count corrects it).
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max(0, int(max_entries))
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS vectors ("
+                " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vec BLOB NOT NULL,"
+                " used_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS vectors_used_at ON vectors(used_at)")
+            (self._rows,) = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        if not self.max_entries or not keys:
+            return {}
+        uniq = list(dict.fromkeys(keys))
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(uniq), 500):  # stay under SQLite's variable limit
+                batch = uniq[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                for key, dim, vec in conn.execute(
+                    f"SELECT key, dim, vec FROM vectors WHERE key IN ({marks})", batch
+                ):
+                    found[key] = np.frombuffer(vec, dtype="float32", count=dim)
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE vectors SET used_at = ? WHERE key = ?", [(now, k) for k in found]
+                )
+                conn.commit()
+            self.hits += len(found)
+            self.misses += len(uniq) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        if not self.max_entries or not items:
+            return
+        now = time.time()
+        rows = [
+            (k, int(v.shape[-1]), np.ascontiguousarray(v, dtype="float32").tobytes(), now)
+            for k, v in items.items()
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?)", rows)
+            self._rows += len(rows)
+            if self._rows > self.max_entries:
+                (self._rows,) = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()
+            if self._rows > self.max_entries:
+                drop = self._rows - int(self.max_entries * 0.9)
+                conn.execute(
+                    "DELETE FROM vectors WHERE key IN "
+                    "(SELECT key FROM vectors ORDER BY used_at LIMIT ?)",
+                    (drop,),
+                )
+                self._rows -= drop
+                self.evictions += drop
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "path": self.path,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+            }
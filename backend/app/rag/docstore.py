@@ -0,0 +1,396 @@
+# app/rag/docstore.py
+from __future__ import annotations
+
+import io
+import json
+import os
+import tempfile
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# docstore.bin layout (little-endian, every section 8-byte aligned):
+#   magic        8 bytes   b"RAGDOCS3" (b"RAGDOCS2" files have no dim / vectors)
+#   header       uint64[7] n, n_sources, n_metas, text_len, source_len, meta_len, dim
+#   ids          int64[n]        sorted ascending (ids are handed out in increasing order)
+#   text_off     int64[n+1]      byte offsets into the text blob
+#   source_code  int32[n]        row -> entry of the source dictionary
+#   meta_code    int32[n]        row -> entry of the metadata dictionary
+#   source_off   int64[n_sources+1]
+#   meta_off     int64[n_metas+1]
+#   text blob | source blob | metadata blob (utf-8 / JSON), each padded to 8 bytes
+#   vectors      float16[n, dim] row-aligned embeddings (absent when dim == 0)
+#
+# Sources and metadata repeat for every chunk of an upload, so both are stored
+# dictionary-encoded: one int32 per row plus one copy of each distinct value.
+# The float16 vectors are the exact copy used for re-ranking and index rebuilds;
+# being memory-mapped they cost page cache, not heap.
+_MAGIC = b"RAGDOCS3"
+_MAGIC_V2 = b"RAGDOCS2"
+_HEADER = len(_MAGIC) + 8 * 7
+_HEADER_V2 = len(_MAGIC) + 8 * 6
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class _StrTable:
+    """offsets + utf-8 blob; entry i is blob[off[i]:off[i+1]]."""
+
+    def __init__(self, offsets: np.ndarray, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return int(self.offsets.shape[0]) - 1
+
+    @classmethod
+    def build(cls, values: Sequence[str]) -> "_StrTable":
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        if encoded:
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, b"".join(encoded))
+
+    def get(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def values(self) -> List[str]:
+        return [self.get(i) for i in range(len(self))]
+
+    def take(self, rows: np.ndarray) -> "_StrTable":
+        """Vectorized subset: copies the kept byte ranges without decoding."""
+        lengths = np.diff(self.offsets)
+        keep = np.zeros(len(self), dtype=bool)
+        keep[rows] = True
+        blob = np.frombuffer(bytes(self.blob), dtype=np.uint8)[np.repeat(keep, lengths)]
+        offsets = np.zeros(int(keep.sum()) + 1, dtype="<i8")
+        np.cumsum(lengths[keep], out=offsets[1:])
+        return _StrTable(offsets, blob.tobytes())
+
+
+class Docstore:
+    """
+    Immutable columnar docstore: id, text, source and metadata columns.
+
+    Loaded through a read-only memmap, so opening a store costs a header parse and
+    a lookup touches only the k rows it needs. Writers derive a new Docstore with
+    without_ids()/appended() and save() it atomically.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        text: _StrTable,
+        source_code: np.ndarray,
+        meta_code: np.ndarray,
+        sources: _StrTable,
+        metas: _StrTable,
+        vectors: Optional[np.ndarray] = None,
+    ):
+        self.ids = ids
+        self._text = text
+        self._source_code = source_code
+        self._meta_code = meta_code
+        self._sources = sources
+        self._metas = metas
+        self.vectors = vectors
+        self._meta_cache: Dict[int, Dict] = {}
+
+    def __len__(self) -> int:
+        return int(self.ids.shape[0])
+
+    # -- construction / persistence --
+
+    @classmethod
+    def empty(cls) -> "Docstore":
+        return cls.build([])
+
+    @classmethod
+    def build(
+        cls, rows: Iterable[Tuple[int, str, Dict]], vectors: Optional[np.ndarray] = None
+    ) -> "Docstore":
+        """
+        rows: (doc_id, text, metadata) with metadata["source"] set.
+        vectors: optional embeddings aligned with rows.
+        """
+        rows = list(rows)
+        order = sorted(range(len(rows)), key=lambda i: rows[i][0])
+        rows = [rows[i] for i in order]
+        if vectors is not None:
+            vectors = np.asarray(vectors, dtype="<f2")[order]
+        source_idx: Dict[str, int] = {}
+        meta_idx: Dict[str, int] = {}
+        source_code = np.zeros(len(rows), dtype="<i4")
+        meta_code = np.zeros(len(rows), dtype="<i4")
+        for i, (_, _, md) in enumerate(rows):
+            md = md or {}
+            src = str(md.get("source", "unknown"))
+            meta_json = json.dumps(md, ensure_ascii=False, sort_keys=True)
+            source_code[i] = source_idx.setdefault(src, len(source_idx))
+            meta_code[i] = meta_idx.setdefault(meta_json, len(meta_idx))
+        return cls(
+            np.fromiter((r[0] for r in rows), dtype="<i8", count=len(rows)),
+            _StrTable.build([r[1] for r in rows]),
+            source_code,
+            meta_code,
+            _StrTable.build(list(source_idx)),
+            _StrTable.build(list(meta_idx)),
+            vectors,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Docstore":
+        return cls._parse(np.memmap(path, dtype=np.uint8, mode="r"), path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Docstore":
+        """Parse a serialized docstore held in memory (a packed tenant's blob)."""
+        return cls._parse(np.frombuffer(data, dtype=np.uint8), "<bytes>")
+
+    @classmethod
+    def _parse(cls, mm: np.ndarray, path: str) -> "Docstore":
+        magic = bytes(mm[: len(_MAGIC)])
+        if magic == _MAGIC:
+            header = [int(x) for x in mm[len(_MAGIC):_HEADER].view("<u8")]
+            pos = _HEADER
+        elif magic == _MAGIC_V2:
+            header = [int(x) for x in mm[len(_MAGIC):_HEADER_V2].view("<u8")] + [0]
+            pos = _HEADER_V2
+        else:
+            raise ValueError(f"Not a docstore file: {path}")
+        n, n_src, n_meta, text_len, src_len, meta_len, dim = header
+
+        def take(nbytes: int, dtype: str | None = None):
+            nonlocal pos
+            chunk = mm[pos:pos + nbytes]
+            pos += _pad8(nbytes)
+            return chunk.view(dtype) if dtype else chunk
+
+        ids = take(8 * n, "<i8")
+        text_off = take(8 * (n + 1), "<i8")
+        source_code = take(4 * n, "<i4")
+        meta_code = take(4 * n, "<i4")
+        source_off = take(8 * (n_src + 1), "<i8")
+        meta_off = take(8 * (n_meta + 1), "<i8")
+        text_blob = take(text_len)
+        source_blob = take(src_len)
+        meta_blob = take(meta_len)
+        vectors = take(2 * n * dim, "<f2").reshape(n, dim) if dim else None
+        return cls(
+            ids,
+            _StrTable(text_off, text_blob),
+            source_code,
+            meta_code,
+            _StrTable(source_off, source_blob),
+            _StrTable(meta_off, meta_blob),
+            vectors,
+        )
+
+    def save(self, path: str) -> None:
+        # a unique temp name: concurrent writers of one path never share a file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".docstore-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                self._write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        self._write(buf)
+        return buf.getvalue()
+
+    def _write(self, f) -> None:
+        sections = [
+            np.ascontiguousarray(self.ids, dtype="<i8").tobytes(),
+            np.ascontiguousarray(self._text.offsets, dtype="<i8").tobytes(),
+            np.ascontiguousarray(self._source_code, dtype="<i4").tobytes(),
+            np.ascontiguousarray(self._meta_code, dtype="<i4").tobytes(),
+            np.ascontiguousarray(self._sources.offsets, dtype="<i8").tobytes(),
+            np.ascontiguousarray(self._metas.offsets, dtype="<i8").tobytes(),
+            bytes(self._text.blob),
+            bytes(self._sources.blob),
+            bytes(self._metas.blob),
+        ]
+        if self.vectors is not None:
+            sections.append(np.ascontiguousarray(self.vectors, dtype="<f2").tobytes())
+        header = np.array(
+            [
+                len(self),
+                len(self._sources),
+                len(self._metas),
+                len(sections[6]),
+                len(sections[7]),
+                len(sections[8]),
+                self.dim,
+            ],
+            dtype="<u8",
+        )
+        f.write(_MAGIC)
+        f.write(header.tobytes())
+        for sec in sections:
+            f.write(sec)
+            f.write(b"\0" * (_pad8(len(sec)) - len(sec)))
+
+    # -- reads --
+
+    @property
+    def dim(self) -> int:
+        return int(self.vectors.shape[1]) if self.vectors is not None else 0
+
+    @property
+    def text_nbytes(self) -> int:
+        return int(self._text.offsets[-1])
+
+    def vectors_at(self, pos: np.ndarray) -> np.ndarray:
+        """Exact (float16-stored) vectors for row positions, as float32."""
+        return np.asarray(self.vectors[np.asarray(pos, dtype="int64")], dtype="float32")
+
+    def positions(self, doc_ids: np.ndarray) -> np.ndarray:
+        """Row positions for doc_ids; -1 where the id is unknown."""
+        doc_ids = np.asarray(doc_ids, dtype="int64")
+        if len(self) == 0:
+            return np.full(doc_ids.shape, -1, dtype="int64")
+        pos = np.searchsorted(self.ids, doc_ids)
+        pos = np.minimum(pos, len(self) - 1)
+        return np.where(self.ids[pos] == doc_ids, pos, -1)
+
+    def text_at(self, pos: int) -> str:
+        return self._text.get(pos)
+
+    def source_at(self, pos: int) -> str:
+        return self._sources.get(int(self._source_code[pos]))
+
+    def _meta_dict(self, code: int) -> Dict:
+        md = self._meta_cache.get(code)
+        if md is None:
+            md = json.loads(self._metas.get(code))
+            self._meta_cache[code] = md
+        return md
+
+    def metadata_at(self, pos: int) -> Dict:
+        return dict(self._meta_dict(int(self._meta_code[pos])))
+
+    def ids_for_source(self, source: str) -> np.ndarray:
+        try:
+            code = self._sources.values().index(source)
+        except ValueError:
+            return np.zeros(0, dtype="int64")
+        return np.asarray(self.ids[self._source_code == code], dtype="int64")
+
+    def rows_where(self, pred: Callable[[Dict], bool]) -> np.ndarray:
+        """
+        Boolean row mask for a metadata predicate. pred runs once per distinct
+        metadata entry (one per upload, typically) and is broadcast through the
+        dictionary codes, so the cost per row is a single gather.
+        """
+        ok = np.fromiter(
+            (pred(self._meta_dict(code)) for code in range(len(self._metas))),
+            dtype=bool,
+            count=len(self._metas),
+        )
+        return ok[self._meta_code] if len(ok) else np.zeros(len(self), dtype=bool)
+
+    # -- derived copies for writers --
+
+    def without_ids(self, doc_ids: np.ndarray) -> "Docstore":
+        pos = self.positions(doc_ids)
+        pos = pos[pos >= 0]
+        if pos.size == 0:
+            return self
+        keep = np.ones(len(self), dtype=bool)
+        keep[pos] = False
+        rows = np.flatnonzero(keep)
+        src_used, source_code = np.unique(self._source_code[rows], return_inverse=True)
+        meta_used, meta_code = np.unique(self._meta_code[rows], return_inverse=True)
+        return Docstore(
+            np.ascontiguousarray(self.ids[rows]),
+            self._text.take(rows),
+            source_code.astype("<i4"),
+            meta_code.astype("<i4"),
+            self._sources.take(src_used),
+            self._metas.take(meta_used),
+            np.ascontiguousarray(self.vectors[rows]) if self.vectors is not None else None,
+        )
+
+    def with_vectors(self, vectors: np.ndarray) -> "Docstore":
+        """Same rows with a (backfilled) vector column in row order."""
+        return Docstore(
+            self.ids,
+            self._text,
+            self._source_code,
+            self._meta_code,
+            self._sources,
+            self._metas,
+            np.asarray(vectors, dtype="<f2"),
+        )
+
+    def appended(
+        self, rows: Sequence[Tuple[int, str, Dict]], vectors: Optional[np.ndarray] = None
+    ) -> "Docstore":
+        """
+        New docstore with rows added; their ids must be above every existing id.
+        The vector column is kept only if both sides have one.
+        """
+        if not rows:
+            return self
+        new = Docstore.build(rows, vectors)
+        merged_vectors = None
+        if new.vectors is not None and (self.vectors is not None or len(self) == 0):
+            merged_vectors = (
+                np.concatenate([self.vectors, new.vectors]) if len(self) else new.vectors
+            )
+        sources, src_map = _merge_dict(self._sources, new._sources)
+        metas, meta_map = _merge_dict(self._metas, new._metas)
+        text_blob = bytes(self._text.blob) + bytes(new._text.blob)
+        text_off = np.concatenate(
+            [self._text.offsets, new._text.offsets[1:] + self._text.offsets[-1]]
+        ).astype("<i8")
+        return Docstore(
+            np.concatenate([self.ids, new.ids]).astype("<i8"),
+            _StrTable(text_off, text_blob),
+            np.concatenate([self._source_code, src_map[new._source_code]]).astype("<i4"),
+            np.concatenate([self._meta_code, meta_map[new._meta_code]]).astype("<i4"),
+            sources,
+            metas,
+            merged_vectors,
+        )
+
+
+def _merge_dict(base: _StrTable, extra: _StrTable) -> Tuple[_StrTable, np.ndarray]:
+    """Union of two dictionary tables plus the code remap for `extra`'s entries."""
+    values = base.values()
+    index = {v: i for i, v in enumerate(values)}
+    remap = np.zeros(len(extra), dtype="<i4")
+    for i, v in enumerate(extra.values()):
+        if v not in index:
+            index[v] = len(values)
+            values.append(v)
+        remap[i] = index[v]
+    return _StrTable.build(values), remap
+
+
+def migrate_json_docstore(json_path: str, bin_path: str) -> Docstore:
+    """
+    One-shot conversion of a legacy docstore.json ({str(id): {"page_content", "metadata"}})
+    into docstore.bin. The JSON file is removed once the binary file is in place.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    ds = docstore_from_records(data)
+    ds.save(bin_path)
+    os.remove(json_path)
+    return ds
+
+
+def docstore_from_records(data: Dict[str, Dict]) -> Docstore:
+    return Docstore.build(
+        (int(k), v.get("page_content", ""), v.get("metadata") or {}) for k, v in data.items()
+    )
@@ -0,0 +1,158 @@
+# app/rag/embedder.py
+from __future__ import annotations
+
+import json
+import os
+from typing import List, Sequence
+
+import numpy as np
+
+# Backends (EMBEDDINGS_BACKEND):
+#   hf         sentence-transformers on torch (the original path)
+#   fastembed  fastembed's ONNX Runtime pipeline; no torch import
+#   onnx       plain ONNX Runtime over the model repo's exported graph, which
+#              lets EMBEDDINGS_ONNX_FILE pick an int8-quantized variant
+# All return L2-normalized float32 rows, so their vectors are interchangeable
+# with existing indexes built from the same model (to float rounding; a
+# quantized graph drifts a little further but keeps cosine ~0.99).
+HF = "hf"
+FASTEMBED = "fastembed"
+ONNX = "onnx"
+BACKENDS = (HF, FASTEMBED, ONNX)
+
+EMBEDDINGS_THREADS = int(os.getenv("EMBEDDINGS_THREADS", "0"))  # 0 = runtime default
+EMBEDDINGS_BATCH_SIZE = int(os.getenv("EMBEDDINGS_BATCH_SIZE", "32"))
+EMBEDDINGS_MAX_LENGTH = int(os.getenv("EMBEDDINGS_MAX_LENGTH", "256"))
+# graph inside the model repo, e.g. onnx/model_qint8_avx512_vnni.onnx for int8
+EMBEDDINGS_ONNX_FILE = os.getenv("EMBEDDINGS_ONNX_FILE", "onnx/model.onnx")
+EMBEDDINGS_POOLING = os.getenv("EMBEDDINGS_POOLING", "mean").lower()
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype="float32")
+    if vecs.ndim == 1:
+        vecs = vecs.reshape(1, -1)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+
+class Embedder:
+    """Tiny protocol: encode(texts) -> (len(texts), dim) float32, unit-normalized."""
+    backend: str
+    model_name: str
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:  # pragma: no cover
+        raise NotImplementedError
+
+
+class SentenceTransformerEmbedder(Embedder):
+    backend = HF
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer  # pulls in torch
+
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name)
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        vecs = self._model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+        if vecs.ndim == 1:
+            vecs = vecs.reshape(1, -1)
+        return vecs.astype("float32")
+
+
+class FastEmbedEmbedder(Embedder):
+    backend = FASTEMBED
+
+    def __init__(self, model_name: str):
+        from fastembed import TextEmbedding
+
+        self.model_name = model_name
+        self._model = TextEmbedding(model_name=model_name, threads=EMBEDDINGS_THREADS or None)
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        vecs = list(self._model.embed(list(texts), batch_size=EMBEDDINGS_BATCH_SIZE))
+        return _normalize(np.stack(vecs)) if vecs else np.zeros((0, 0), dtype="float32")
+
+
+class OnnxEmbedder(Embedder):
+    """
+    Transformer encoder run directly on ONNX Runtime: tokenizers for the fast
+    Rust tokenizer, pooling + normalization in numpy. model_name is a Hugging
+    Face repo id or a local directory holding tokenizer.json and the graph.
+    """
+
+    backend = ONNX
+
+    def __init__(self, model_name: str, onnx_file: str = EMBEDDINGS_ONNX_FILE):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_name = model_name
+        self.onnx_file = onnx_file
+        self._pooling = EMBEDDINGS_POOLING
+        max_length = EMBEDDINGS_MAX_LENGTH
+        try:
+            # sentence-transformers' own sequence limit, when the repo has one
+            with open(self._resolve("sentence_bert_config.json"), "r", encoding="utf-8") as f:
+                max_length = int(json.load(f).get("max_seq_length") or max_length)
+        except Exception:
+            pass
+
+        self._tokenizer = Tokenizer.from_file(self._resolve("tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=max_length)
+        pad_id = self._tokenizer.token_to_id("[PAD]") or 0
+        self._tokenizer.enable_padding(pad_id=pad_id)
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if EMBEDDINGS_THREADS:
+            opts.intra_op_num_threads = EMBEDDINGS_THREADS
+        self._session = ort.InferenceSession(
+            self._resolve(onnx_file), sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self._inputs = {i.name for i in self._session.get_inputs()}
+
+    def _resolve(self, filename: str) -> str:
+        if os.path.isdir(self.model_name):
+            return os.path.join(self.model_name, filename)
+        from huggingface_hub import hf_hub_download
+
+        return hf_hub_download(repo_id=self.model_name, filename=filename)
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        enc = self._tokenizer.encode_batch(texts)
+        ids = np.array([e.ids for e in enc], dtype="int64")
+        mask = np.array([e.attention_mask for e in enc], dtype="int64")
+        feed = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._inputs:
+            feed["token_type_ids"] = np.array([e.type_ids for e in enc], dtype="int64")
+        hidden = self._session.run(None, {k: v for k, v in feed.items() if k in self._inputs})[0]
+        if self._pooling == "cls":
+            return hidden[:, 0]
+        weights = mask[..., None].astype("float32")
+        return (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        # similar lengths share a batch, so little compute goes to padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        out: List[np.ndarray] = [None] * len(texts)  # type: ignore[list-item]
+        for start in range(0, len(order), EMBEDDINGS_BATCH_SIZE):
+            batch = order[start:start + EMBEDDINGS_BATCH_SIZE]
+            for i, vec in zip(batch, self._encode_batch([texts[i] for i in batch])):
+                out[i] = vec
+        return _normalize(np.stack(out))
+
+
+def make_embedder(backend: str, model_name: str) -> Embedder:
+    backend = (backend or HF).lower()
+    if backend == HF:
+        return SentenceTransformerEmbedder(model_name)
+    if backend == FASTEMBED:
+        return FastEmbedEmbedder(model_name)
+    if backend == ONNX:
+        return OnnxEmbedder(model_name)
+    raise ValueError(f"Unknown EMBEDDINGS_BACKEND: {backend} (expected one of {', '.join(BACKENDS)})")
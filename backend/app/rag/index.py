@@ -6,10 +6,16 @@ import os
 import re
 import shutil
 import tempfile
-import uuid
-from dataclasses import dataclass
-from hashlib import sha1
-from typing import Dict, List, Tuple
+import threading
+import time
+import unicodedata
+from collections import Counter
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field, replace
+from hashlib import sha1, sha256
+from typing import Callable, Dict, List, Sequence, Tuple
 
 import numpy as np
 
@@ -20,11 +26,73 @@ except Exception as e:
         "faiss not installed. Install with: python -m pip install faiss-cpu"
     ) from e
 
-# Embeddings: sentence-transformers
-from sentence_transformers import SentenceTransformer
+from app.rag import ann
+from app.rag.batcher import EmbeddingBatcher
+from app.rag.cache import ByteBudgetCache, ChunkVectorCache
+from app.rag.docstore import Docstore, docstore_from_records, migrate_json_docstore
+from app.rag.embedder import Embedder, make_embedder
+from app.rag.layout import DEDICATED, MISSING, PACKED, RESERVED_NAMES, Location, SegmentDirectory
+from app.rag.lexical import LexicalIndex, corpus_stats
+from app.rag.segments import Delta, merge_topk
+from app.rag.wal import WriteAheadLog, exclusive
 
 RAG_STORE_DIR = os.getenv("RAG_STORE_DIR", ".rag_store")
+# where stores live: "faiss" (per-user files under RAG_STORE_DIR) or "pgvector"
+# (shared Postgres tables, so any API node can serve any user; app/rag/pgvector.py)
+RAG_BACKEND = os.getenv("RAG_BACKEND", "faiss").lower()
+PGVECTOR = "pgvector"
+# small tenants are packed into RAG_PACK_SEGMENTS shared segment files; a store
+# whose serialized size passes RAG_PACK_MAX_BYTES moves to its own directory
+RAG_PACK_SEGMENTS = int(os.getenv("RAG_PACK_SEGMENTS", "64"))
+RAG_PACK_MAX_BYTES = int(os.getenv("RAG_PACK_MAX_BYTES", str(4 * 1024 * 1024)))
+# writes land in small delta segments; a background compaction folds them into
+# one once there are more than RAG_LSM_MAX_SEGMENTS, and into the base once
+# delta rows + tombstones pass RAG_LSM_MERGE_RATIO of the base (or the deltas
+# hold more than RAG_LSM_MAX_DELTA_ROWS rows, which are searched by brute force)
+RAG_LSM_MAX_SEGMENTS = int(os.getenv("RAG_LSM_MAX_SEGMENTS", "8"))
+RAG_LSM_MERGE_RATIO = float(os.getenv("RAG_LSM_MERGE_RATIO", "0.25"))
+RAG_LSM_MAX_DELTA_ROWS = int(os.getenv("RAG_LSM_MAX_DELTA_ROWS", "20000"))
+# files of a superseded generation are deleted once no query in this process
+# pins it and it has been retired this long (covers readers in other workers)
+RAG_GENERATION_GRACE_SECONDS = float(os.getenv("RAG_GENERATION_GRACE_SECONDS", "30"))
 EMBED_MODEL = os.getenv("EMBEDDINGS_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# hf (sentence-transformers/torch), fastembed or onnx; see app/rag/embedder.py
+EMBED_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "hf").lower()
+# concurrent encode calls are coalesced by one inference thread: it waits up to
+# RAG_EMBED_BATCH_WAIT_MS for company, up to RAG_EMBED_MAX_BATCH texts per pass
+RAG_EMBED_BATCHING = os.getenv("RAG_EMBED_BATCHING", "true").lower() == "true"
+RAG_EMBED_BATCH_WAIT_MS = float(os.getenv("RAG_EMBED_BATCH_WAIT_MS", "3"))
+RAG_EMBED_MAX_BATCH = int(os.getenv("RAG_EMBED_MAX_BATCH", "64"))
+# budget for loaded user stores (index + docstore) kept in process memory
+RAG_INDEX_CACHE_BYTES = int(os.getenv("RAG_INDEX_CACHE_BYTES", str(512 * 1024 * 1024)))
+# indexes at least this big that have not been written for RAG_MMAP_IDLE_SECONDS
+# are memory-mapped read-only, so worker processes share one page-cache copy
+# (negative disables)
+RAG_MMAP_MIN_BYTES = int(os.getenv("RAG_MMAP_MIN_BYTES", str(32 * 1024 * 1024)))
+RAG_MMAP_IDLE_SECONDS = int(os.getenv("RAG_MMAP_IDLE_SECONDS", "300"))
+# query vectors cached by (model, normalized text); optional shared Redis tier
+RAG_QUERY_CACHE_BYTES = int(os.getenv("RAG_QUERY_CACHE_BYTES", str(32 * 1024 * 1024)))
+RAG_QUERY_CACHE_TTL = int(os.getenv("RAG_QUERY_CACHE_TTL", "3600"))
+RAG_QUERY_CACHE_REDIS = os.getenv("RAG_QUERY_CACHE_REDIS", "false").lower() == "true"
+# search results cached by (user, store generation, query, k, mode, filters);
+# a write starts a new generation, so cached results are never stale
+RAG_RESULT_CACHE_BYTES = int(os.getenv("RAG_RESULT_CACHE_BYTES", str(16 * 1024 * 1024)))
+RAG_RESULT_CACHE_TTL = int(os.getenv("RAG_RESULT_CACHE_TTL", "600"))
+RAG_RESULT_CACHE_REDIS = os.getenv("RAG_RESULT_CACHE_REDIS", "false").lower() == "true"
+# chunk vectors by content hash, shared by all users and kept on disk across
+# restarts; least recently used rows beyond this count are evicted (0 disables)
+RAG_CHUNK_CACHE_MAX = int(os.getenv("RAG_CHUNK_CACHE_MAX", "500000"))
+# default retrieval mode: "vector", "lexical" (BM25) or "hybrid" (both, fused by
+# reciprocal rank); hybrid fuses the top RAG_HYBRID_FACTOR * k of each side
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "vector").lower()
+RAG_HYBRID_FACTOR = int(os.getenv("RAG_HYBRID_FACTOR", "4"))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+# shared read-only corpora (e.g. a template's knowledge base) searched next to a
+# user's own store. Only the ones listed here may be searched (tool configs name
+# corpora freely); they are loaded at warm-up
+RAG_SHARED_CORPORA = [c.strip() for c in os.getenv("RAG_SHARED_CORPORA", "").split(",") if c.strip()]
+RAG_FEDERATED_WORKERS = int(os.getenv("RAG_FEDERATED_WORKERS", "8"))
 
 # ---------------------------
 # Small utilities
@@ -33,14 +101,39 @@ EMBED_MODEL = os.getenv("EMBEDDINGS_MODEL", "sentence-transformers/all-MiniLM-L6
 def _ensure_dir(p: str) -> None:
     os.makedirs(p, exist_ok=True)
 
-def _paths_for_user(user_id: str) -> Tuple[str, str, str]:
-    base = os.path.join(RAG_STORE_DIR, user_id)
-    _ensure_dir(base)
-    return (
-        base,
-        os.path.join(base, "faiss.index"),
-        os.path.join(base, "docstore.json"),
-    )
+# file names of a store, both in a dedicated directory and as packed blob names
+STORE_FILES = ("faiss.index", "docstore.bin", "manifest.json", "lexical.bin")
+
+_LAYOUT = SegmentDirectory(RAG_STORE_DIR, RAG_PACK_SEGMENTS)
+
+def _store_files(base: str) -> Tuple[str, str, str, str]:
+    """(faiss, docstore, manifest, lexical) paths inside a dedicated store directory."""
+    return tuple(os.path.join(base, name) for name in STORE_FILES)  # type: ignore[return-value]
+
+# A dedicated store directory holds immutable files only, plus manifest.json:
+#   gen-NNNNNN/{faiss.index, docstore.bin, lexical.bin}   one per base rewrite
+#   delta-*.seg                                           one per write
+#   manifest.json   the "current" pointer: names the base generation and the
+#                   deltas, and is swapped atomically (os.replace) on every save
+# Pre-generation stores keep their base files next to the manifest.
+def _gen_name(gen: int) -> str:
+    return f"gen-{int(gen):06d}"
+
+def _base_dir(base: str, manifest: Dict) -> str:
+    gen = int(manifest.get("base_gen", 0))
+    return os.path.join(base, _gen_name(gen)) if gen else base
+
+def _wal(user_id: str) -> WriteAheadLog:
+    return WriteAheadLog(_LAYOUT.wal_path(user_id))
+
+def _write_lock(user_id: str):
+    """Serialize writers of one user's store, across threads and worker processes."""
+    return exclusive(_LAYOUT.lock_path(user_id), _LAYOUT.lock_slot(user_id))
+
+def _pg():
+    # imported on first use: the FAISS backend needs no database connection
+    from app.rag import pgvector
+    return pgvector
 
 def _hash_source(source: str) -> str:
     return sha1(source.lower().encode("utf-8")).hexdigest()[:16]
@@ -55,20 +148,206 @@ def _clean_text(s: str) -> str:
 # Model cache
 # ---------------------------
 
-_MODEL: SentenceTransformer | None = None
+_MODEL: Embedder | None = None
+_MODEL_LOCK = threading.Lock()
 
-def _get_model() -> SentenceTransformer:
+def _get_model() -> Embedder:
     global _MODEL
     if _MODEL is None:
-        _MODEL = SentenceTransformer(EMBED_MODEL)
+        # the startup warm-up and early requests may race to load it
+        with _MODEL_LOCK:
+            if _MODEL is None:
+                _MODEL = make_embedder(EMBED_BACKEND, EMBED_MODEL)
     return _MODEL
 
+_BATCHER = EmbeddingBatcher(
+    lambda texts: _get_model().encode(texts),
+    max_batch=RAG_EMBED_MAX_BATCH,
+    max_wait_ms=RAG_EMBED_BATCH_WAIT_MS,
+)
+
 def _embed_texts(texts: List[str]) -> np.ndarray:
-    model = _get_model()
-    vecs = model.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
-    if vecs.ndim == 1:
-        vecs = vecs.reshape(1, -1)
-    return vecs.astype("float32")
+    if RAG_EMBED_BATCHING:
+        return _BATCHER.encode(texts)
+    return _get_model().encode(texts)
+
+def embed_batcher_stats() -> Dict:
+    stats = _BATCHER.stats()
+    stats["enabled"] = RAG_EMBED_BATCHING
+    return stats
+
+def warm_up() -> Dict:
+    """
+    Load the embedding model and push one throwaway batch through it, so the
+    first real upload or search does not pay for weight loading and kernel
+    initialization. Called from the app lifespan before traffic is accepted.
+    """
+    t0 = time.perf_counter()
+    _get_model()
+    t1 = time.perf_counter()
+    # a spread of lengths, so shape-specialized kernels are initialized too
+    vecs = _embed_texts([" ".join(["warm-up"] * n) for n in (1, 16, 64, 256)])
+    t2 = time.perf_counter()
+    corpora = {}
+    if RAG_BACKEND != PGVECTOR:
+        corpora = {name: _ntotal(_shared_store(name)) for name in RAG_SHARED_CORPORA}
+    return {
+        "model": EMBED_MODEL,
+        "backend": EMBED_BACKEND,
+        "dim": int(vecs.shape[1]),
+        "load_seconds": round(t1 - t0, 3),
+        "warmup_seconds": round(t2 - t1, 3),
+        "corpora": corpora,
+        "corpora_seconds": round(time.perf_counter() - t2, 3),
+    }
+
+# ---------------------------
+# Query embedding cache
+# ---------------------------
+
+_QUERY_CACHE = ByteBudgetCache(RAG_QUERY_CACHE_BYTES, name="query", ttl=RAG_QUERY_CACHE_TTL)
+_QUERY_REDIS_STATS = {"hits": 0, "misses": 0, "errors": 0}
+
+def _normalize_query(q: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", q).split())
+
+def _query_key(text: str) -> str:
+    return f"rag:qvec:{EMBED_MODEL}:{sha1(text.encode('utf-8')).hexdigest()}"
+
+def _redis_mget(keys: List[str], stats: Dict) -> List[bytes | None]:
+    try:
+        from app.core.redis_client import get_redis_bytes
+        return get_redis_bytes().mget(keys)
+    except Exception:
+        stats["errors"] += 1
+        return [None] * len(keys)
+
+def _redis_set_many(items: Dict[str, bytes], ttl: int, stats: Dict) -> None:
+    if not items:
+        return
+    try:
+        from app.core.redis_client import get_redis_bytes
+        pipe = get_redis_bytes().pipeline(transaction=False)
+        for key, raw in items.items():
+            pipe.set(key, raw, ex=ttl)
+        pipe.execute()
+    except Exception:
+        stats["errors"] += 1
+
+def _embed_queries(queries: List[str]) -> np.ndarray:
+    """
+    _embed_texts for search queries: repeated or whitespace/unicode-variant queries
+    are served from the in-process cache, then Redis, and only the rest reach
+    the model (in one batch).
+    """
+    texts = [_normalize_query(q) for q in queries]
+    keys = [_query_key(t) for t in texts]
+    found: Dict[str, np.ndarray] = {}
+    for key in keys:
+        vec = _QUERY_CACHE.get(key)
+        if vec is not None:
+            found[key] = vec
+
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if missing and RAG_QUERY_CACHE_REDIS:
+        for key, raw in zip(missing, _redis_mget(missing, _QUERY_REDIS_STATS)):
+            if raw is None:
+                _QUERY_REDIS_STATS["misses"] += 1
+                continue
+            _QUERY_REDIS_STATS["hits"] += 1
+            found[key] = np.frombuffer(raw, dtype="float32")
+            _QUERY_CACHE.put(key, found[key], len(raw))
+
+    todo = {key: text for key, text in zip(keys, texts) if key not in found}
+    if todo:
+        vecs = _embed_texts(list(todo.values()))
+        fresh = {key: vecs[i].copy() for i, key in enumerate(todo)}
+        for key, vec in fresh.items():
+            _QUERY_CACHE.put(key, vec, vec.nbytes)
+        if RAG_QUERY_CACHE_REDIS:
+            _redis_set_many(
+                {key: vec.tobytes() for key, vec in fresh.items()}, RAG_QUERY_CACHE_TTL, _QUERY_REDIS_STATS
+            )
+        found.update(fresh)
+
+    return np.stack([found[key] for key in keys]).astype("float32", copy=False)
+
+def query_cache_stats() -> Dict:
+    stats = _QUERY_CACHE.stats()
+    if RAG_QUERY_CACHE_REDIS:
+        stats["redis"] = dict(_QUERY_REDIS_STATS)
+    return stats
+
+# ---------------------------
+# Search result cache
+# ---------------------------
+
+_RESULT_CACHE = ByteBudgetCache(RAG_RESULT_CACHE_BYTES, name="result", ttl=RAG_RESULT_CACHE_TTL)
+_RESULT_REDIS_STATS = {"hits": 0, "misses": 0, "errors": 0}
+
+def _result_digest(query: str, k: int, mode: str, filters: Dict | None, min_score: float | None) -> str:
+    # whitespace only: NFKC could change what the BM25 tokenizer sees
+    spec = [EMBED_MODEL, " ".join(query.split()), int(k), mode, filters or {}, min_score]
+    return sha1(json.dumps(spec, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _result_redis_key(user_id: str, version: str, digest: str) -> str:
+    return f"rag:res:{user_id}:{version}:{digest}"
+
+def _drop_results(user_id: str) -> None:
+    """Free the user's cached results once a write supersedes their generation."""
+    _RESULT_CACHE.invalidate_where(lambda key: key[0] == user_id)
+
+def result_cache_stats() -> Dict:
+    stats = _RESULT_CACHE.stats()
+    if RAG_RESULT_CACHE_REDIS:
+        stats["redis"] = dict(_RESULT_REDIS_STATS)
+    return stats
+
+# ---------------------------
+# Chunk embedding cache
+# ---------------------------
+
+_CHUNK_CACHE: ChunkVectorCache | None = None
+_CHUNK_CACHE_LOCK = threading.Lock()
+
+def _chunk_cache() -> ChunkVectorCache:
+    global _CHUNK_CACHE
+    with _CHUNK_CACHE_LOCK:
+        if _CHUNK_CACHE is None:
+            slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", EMBED_MODEL)
+            path = os.path.join(RAG_STORE_DIR, "_embeddings", f"{slug}.sqlite")
+            _CHUNK_CACHE = ChunkVectorCache(path, RAG_CHUNK_CACHE_MAX)
+        return _CHUNK_CACHE
+
+def _embed_chunks(texts: List[str]) -> np.ndarray:
+    """
+    _embed_texts for document chunks. Chunks already embedded by this model (in
+    any user's upload) come from the content-addressed cache; only unseen texts
+    reach the model. The cache is shared across tenants, so whether a chunk was
+    a hit must never reach the uploader: hit counts live in chunk_cache_stats().
+    """
+    cache = _chunk_cache()
+    keys = [cache.key(t) for t in texts]
+    try:
+        found = cache.get_many(keys)
+    except Exception as e:
+        print(f"[rag] warning: chunk cache read failed: {e!s}")
+        found = {}
+
+    todo = {key: text for key, text in zip(keys, texts) if key not in found}
+    if todo:
+        vecs = _embed_texts(list(todo.values()))
+        fresh = {key: vecs[i] for i, key in enumerate(todo)}
+        try:
+            cache.put_many(fresh)
+        except Exception as e:
+            print(f"[rag] warning: chunk cache write failed: {e!s}")
+        found.update(fresh)
+
+    return np.stack([found[key] for key in keys]).astype("float32", copy=False)
+
+def chunk_cache_stats() -> Dict:
+    return _chunk_cache().stats()
 
 # ---------------------------
 # Docstore structure
@@ -80,50 +359,31 @@ class DocRec:
     page_content: str
     metadata: Dict
 
-def _load_docstore(path: str) -> Dict[str, Dict]:
-    if not os.path.exists(path):
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def _save_docstore(path: str, data: Dict[str, Dict]) -> None:
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
-    os.replace(tmp, path)
-
-# app/rag/index.py  (append these helpers)
+def _migration_lock(user_id: str):
+    """
+    Serialize migrations of one user's legacy files across workers. Not the
+    write lock: reads migrate too, and writers load while holding that one.
+    """
+    return exclusive(_LAYOUT.lock_path(user_id) + ".migrate", _LAYOUT.lock_slot(user_id))
 
-from collections import Counter
-from typing import List, Dict, Tuple
+def _load_docstore(path: str, user_id: str) -> Docstore:
+    if not os.path.exists(path):
+        base = os.path.dirname(path)
+        if not os.path.exists(os.path.join(base, "docstore.json")):
+            return Docstore.empty()
+        with _migration_lock(user_id):
+            # another worker may have migrated while we waited
+            if not os.path.exists(path):
+                return _migrate_json_store(base)
+    return Docstore.load(path)
 
 def list_loaded_sources(user_id: str) -> List[dict]:
     """
-    Return a list of sources with counts and a best-effort file_id if present.
+    Return a list of sources with counts and a deterministic file_id.
     Example: [{"source":"resume.pdf","chunks":12,"file_id":"ab12cd34"}, ...]
+    Same entries as list_sources(): both read only the source manifest.
     """
-    vs = _load_or_build(user_id)
-    counts: Counter = Counter()
-    file_ids: Dict[str, str] = {}
-
-    # FAISS docstore stores LangChain Document objects in a private dict
-    for doc in vs.docstore._dict.values():
-        meta = doc.metadata or {}
-        src = meta.get("source", "unknown")
-        counts[src] += 1
-        # keep a short hash if we saved one, else derive one from the FAISS doc id
-        fid = meta.get("file_id")
-        if not fid:
-            # fallback: derive a short id from the FAISS key if present
-            # (safe if you stored keys like "<file_id>::page::<n>")
-            key = getattr(doc, "page_content", "")  # not perfect, but non-crashing fallback
-        if src not in file_ids:
-            file_ids[src] = fid or ""
-
-    out = []
-    for src, n in sorted(counts.items()):
-        out.append({"source": src, "chunks": n, "file_id": file_ids.get(src) or ""})
-    return out
+    return list_sources(user_id)
 
 
 def rag_query_with_trace(user_id: str, query: str, *, k: int = 6) -> Tuple[List[dict], Dict[str, int]]:
@@ -147,33 +407,971 @@ def rag_query_with_trace(user_id: str, query: str, *, k: int = 6) -> Tuple[List[
 # ---------------------------
 
 def _build_empty_index(d: int) -> faiss.Index:
-    index = faiss.IndexFlatIP(d)  # cosine via normalized vectors
-    return index
+    return ann.build_flat(d)
+
+@dataclass
+class _Store:
+    """
+    A user's loaded index, docstore and manifest. Cached instances are read-only.
+    index is None for a store that has never held a vector, so its dimension is
+    unknown until the first real chunk is embedded.
+    """
+    index: faiss.Index | None
+    docstore: Docstore
+    manifest: Dict
+    mmapped: bool = False
+    # BM25 index over the same chunks; None until built for a pre-lexical store
+    lexical: LexicalIndex | None = None
+    # loaded from segment blobs: the docstore vectors sit on the heap, not in a mapping
+    packed: bool = False
+    # LSM tail over the base above: immutable delta segments (oldest first) and
+    # the ids deleted since the last compaction, in the base or in a delta
+    deltas: List[Delta] = field(default_factory=list)
+    tombstones: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype="int64"))
+
+def _embedding_info(dim: int) -> Dict:
+    # recorded per store so loading or emptying it never needs the model
+    return {"model": EMBED_MODEL, "backend": EMBED_BACKEND, "dim": int(dim), "normalize": True}
+
+def _ntotal(store: _Store) -> int:
+    base = store.index.ntotal if store.index is not None else 0
+    return base + sum(len(d) for d in store.deltas)
+
+def _docstores(store: _Store) -> List[Docstore]:
+    """Base docstore then each delta's, oldest first."""
+    return [store.docstore] + [d.docstore for d in store.deltas]
+
+def _next_doc_id(store: _Store) -> int:
+    # kept in the manifest so ids of deleted chunks are never handed out again
+    if "next_id" in store.manifest:
+        return int(store.manifest["next_id"])
+    return max((int(ds.ids[-1]) + 1 for ds in _docstores(store) if len(ds)), default=0)
+
+def _ids_for_source(store: _Store, source: str) -> np.ndarray:
+    """Live ids of a source across the base and the deltas."""
+    ids = np.concatenate([ds.ids_for_source(source) for ds in _docstores(store)])
+    return np.setdiff1d(ids, store.tombstones)
+
+def _source_entry(texts: List[str], metas: List[Dict], model: str) -> Dict:
+    """Source manifest entry for the chunks of one upload."""
+    digest = sha256()
+    for t in texts:
+        digest.update(t.encode("utf-8"))
+        digest.update(b"\0")
+    uploaded = [m.get("uploaded_at") for m in metas if m.get("uploaded_at") is not None]
+    return {
+        "chunks": len(texts),
+        "bytes": sum(len(t.encode("utf-8")) for t in texts),
+        "content_hash": digest.hexdigest(),
+        "uploaded_at": max(uploaded) if uploaded else None,
+        "embedding_model": model,
+    }
+
+def _update_sources(sources: Dict, header: Dict) -> None:
+    """Apply one logged write to a source manifest: an upsert replaces its source's entry."""
+    sources.pop(header["source"], None)
+    if header["ids"]:
+        sources[header["source"]] = _source_entry(
+            header["texts"], header["metas"], header.get("model") or EMBED_MODEL
+        )
 
-def _load_or_build(user_id: str) -> Tuple[faiss.Index, Dict[str, Dict]]:
-    base, faiss_path, docstore_path = _paths_for_user(user_id)
-    ds = _load_docstore(docstore_path)
+def _backfill_sources(store: _Store) -> Dict:
+    """
+    Source manifest of a store written before it kept one, from the docstores.
+    One pass over the rows; afterwards every write keeps it current.
+    """
+    rows: Dict[str, Tuple[List[str], List[Dict]]] = {}
+    dead = store.tombstones
+    for ds in _docstores(store):
+        ids = np.asarray(ds.ids, dtype="int64")
+        live = ~np.isin(ids, dead) if dead.size else np.ones(len(ds), dtype=bool)
+        for pos in np.flatnonzero(live):
+            texts, metas = rows.setdefault(ds.source_at(int(pos)), ([], []))
+            texts.append(ds.text_at(int(pos)))
+            metas.append(ds.metadata_at(int(pos)))
+    model = (store.manifest.get("embedding") or {}).get("model") or EMBED_MODEL
+    return {src: _source_entry(texts, metas, model) for src, (texts, metas) in rows.items()}
+
+def _load_manifest(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _fsync_dir(path: str) -> None:
+    # a rename or new file is only durable once its directory entry is flushed
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _save_manifest(path: str, data: Dict) -> None:
+    """
+    Atomic and durable: the manifest commits a generation, and the write-ahead
+    log is reset right after, so it has to be on disk (data and rename) first.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(path) or ".")
+
+def _migrate_legacy_index(index: faiss.Index, ds: Dict[str, Dict]) -> Tuple[faiss.Index, Dict[str, Dict]]:
+    """
+    Older stores kept a bare IndexFlatIP whose row order matched the docstore's
+    insertion order (uuid keys). Re-key both by position, reusing the stored
+    vectors so nothing is re-embedded.
+    """
+    n = min(index.ntotal, len(ds))
+    new_index = _build_empty_index(index.d)
+    if n:
+        vecs = index.reconstruct_n(0, n)
+        new_index.add_with_ids(vecs, np.arange(n, dtype="int64"))
+    recs = list(ds.values())[:n]
+    return new_index, {str(i): rec for i, rec in enumerate(recs)}
+
+def _migrate_json_store(base: str) -> Docstore:
+    """
+    Convert a user directory still holding docstore.json into docstore.bin,
+    re-keying a pre-id-map index on the way.
+    """
+    faiss_path = os.path.join(base, "faiss.index")
+    json_path = os.path.join(base, "docstore.json")
+    bin_path = os.path.join(base, "docstore.bin")
 
+    index = None
     if os.path.exists(faiss_path) and os.path.getsize(faiss_path) > 0:
         index = faiss.read_index(faiss_path)
-        return index, ds
+    if index is None or isinstance(index, faiss.IndexIDMap2):
+        ds = migrate_json_docstore(json_path, bin_path)
+    else:
+        with open(json_path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        index, records = _migrate_legacy_index(index, records)
+        ds = docstore_from_records(records)
+        _write_index(base, faiss_path, index)
+        ds.save(bin_path)
+        os.remove(json_path)
+
+    # the row map from the previous layout is superseded by the text column
+    rows_path = os.path.join(base, "rows.bin")
+    if os.path.exists(rows_path):
+        os.remove(rows_path)
+    return ds
+
+def migrate_json_docstores(store_dir: str = RAG_STORE_DIR) -> int:
+    """One-shot migration of every user store under store_dir. Returns stores converted."""
+    if not os.path.isdir(store_dir):
+        return 0
+    converted = 0
+    for name in sorted(os.listdir(store_dir)):
+        if name in RESERVED_NAMES:
+            continue
+        base = os.path.join(store_dir, name)
+        if not os.path.exists(os.path.join(base, "docstore.json")):
+            continue
+        with _migration_lock(name):
+            if os.path.exists(os.path.join(base, "docstore.json")) and not os.path.exists(
+                os.path.join(base, "docstore.bin")
+            ):
+                _migrate_json_store(base)
+                converted += 1
+    return converted
+
+def pack_small_stores(store_dir: str = RAG_STORE_DIR) -> int:
+    """
+    Move pre-segment per-user directories that fit RAG_PACK_MAX_BYTES into their
+    segment, then remove the directory. Larger stores stay where they are.
+    """
+    if not os.path.isdir(store_dir):
+        return 0
+    packed = 0
+    for name in sorted(os.listdir(store_dir)):
+        base = os.path.join(store_dir, name)
+        if name in RESERVED_NAMES or not os.path.isdir(base):
+            continue
+        with _write_lock(name):
+            loc = _LAYOUT.locate(name)
+            if loc.kind != DEDICATED or loc.base != base:
+                continue
+            store = _read_store(loc)
+            _replay_wal(name, store)
+            _conform_store(store)
+            if _estimated_nbytes(store) > RAG_PACK_MAX_BYTES:
+                continue
+            blobs = _store_blobs(store)
+            if sum(len(b) for b in blobs.values()) > RAG_PACK_MAX_BYTES:
+                continue
+            _LAYOUT.write_packed(name, blobs)
+            _wal(name).reset()
+            _INDEX_CACHE.invalidate(name)
+            shutil.rmtree(base, ignore_errors=True)
+            packed += 1
+    return packed
+
+def _file_stamp(path: str) -> Tuple[int, int, int, int] | None:
+    # inode + device: an atomic replace within one mtime tick and at the same
+    # size is still a different file
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+def _store_stamp(*paths: str) -> Tuple:
+    return tuple(_file_stamp(p) for p in paths)
+
+def _location_stamp(loc: Location) -> Tuple:
+    """Cache stamp: the packed version, or the dedicated files' stat stamps."""
+    if loc.kind == PACKED:
+        return (PACKED, loc.version)
+    if loc.kind == DEDICATED:
+        return (loc.base,) + _store_stamp(*_store_files(loc.base))
+    return (MISSING,)
+
+def _stamp(loc: Location) -> Tuple:
+    """Location stamp plus the write-ahead log's, so logged writes are seen too."""
+    return _location_stamp(loc) + (_file_stamp(_LAYOUT.wal_path(loc.user_id)),)
+
+def _approx_nbytes(store: "_Store") -> int:
+    # search structure plus decoded text; the float16 vectors are memory-mapped,
+    # and so are the codes of an mmapped index (only its id map is on the heap)
+    if store.index is None:
+        index_bytes = 0
+    elif store.mmapped:
+        index_bytes = store.index.ntotal * 8
+    else:
+        index_bytes = ann.approx_bytes(store.index)
+    lexical_bytes = store.lexical.heap_nbytes if store.lexical is not None else 0
+    vector_bytes = store.docstore.vectors.nbytes if store.packed and store.docstore.dim else 0
+    delta_bytes = sum(d.nbytes for d in store.deltas)
+    return index_bytes + store.docstore.text_nbytes + lexical_bytes + vector_bytes + delta_bytes
+
+_INDEX_CACHE = ByteBudgetCache(RAG_INDEX_CACHE_BYTES, name="index")
+
+def index_cache_stats() -> Dict:
+    return _INDEX_CACHE.stats()
 
-    # Build empty index; dimension comes from model
-    dim = int(_embed_texts(["dummy"]).shape[1])
-    index = _build_empty_index(dim)
-    return index, ds
+_MMAP_IO_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
 
-def save_local(user_id: str, index: faiss.Index, docstore: Dict[str, Dict]) -> None:
-    """Persist FAISS and docstore to disk (atomic where possible)."""
-    base, faiss_path, docstore_path = _paths_for_user(user_id)
+def _read_index(faiss_path: str) -> Tuple[faiss.Index, bool]:
+    """Read an index, memory-mapping it when it is large and read-mostly."""
+    st = os.stat(faiss_path)
+    if (
+        _MMAP_IO_FLAGS
+        and 0 <= RAG_MMAP_MIN_BYTES <= st.st_size
+        and time.time() - st.st_mtime >= RAG_MMAP_IDLE_SECONDS
+    ):
+        try:
+            return ann.read_index(faiss_path, _MMAP_IO_FLAGS | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError:
+            pass  # index type without mmap support
+    return ann.read_index(faiss_path), False
 
-    # write index atomically
+def _owned_copy(store: _Store) -> faiss.Index | None:
+    # clone_index of an mmapped index still views the mapping and cannot be
+    # modified, so writers get a fully deserialized copy instead
+    if store.index is None:
+        return None
+    return ann.copy_index(store.index, deep=store.mmapped)
+
+def _read_store(loc: Location) -> _Store:
+    index, mmapped = None, False
+    if loc.kind == PACKED:
+        blobs = _LAYOUT.read_blobs(loc.user_id)
+        ds = Docstore.from_bytes(blobs["docstore.bin"]) if "docstore.bin" in blobs else Docstore.empty()
+        manifest = json.loads(blobs["manifest.json"]) if "manifest.json" in blobs else {}
+        lexical = LexicalIndex.from_bytes(blobs["lexical.bin"]) if "lexical.bin" in blobs else None
+        if blobs.get("faiss.index"):
+            index = ann.deserialize_index(blobs["faiss.index"])
+    elif loc.kind == DEDICATED:
+        # the manifest first: it pins which (immutable) files make up this generation
+        manifest = _load_manifest(_store_files(loc.base)[2])
+        faiss_path, docstore_path, _, lexical_path = _store_files(_base_dir(loc.base, manifest))
+        ds = _load_docstore(docstore_path, loc.user_id)
+        lexical = LexicalIndex.load(lexical_path) if os.path.exists(lexical_path) else None
+        if os.path.exists(faiss_path) and os.path.getsize(faiss_path) > 0:
+            index, mmapped = _read_index(faiss_path)
+    else:
+        ds, manifest, lexical = Docstore.empty(), {}, None
+
+    deltas = []
+    for span in manifest.get("segments") or []:
+        name = Delta.file_name(span)
+        if loc.kind == PACKED:
+            deltas.append(Delta.from_bytes(blobs[name]))
+        else:
+            deltas.append(Delta.load(os.path.join(loc.base, name)))
+    tombstones = np.asarray(manifest.get("tombstones") or [], dtype="int64")
+
+    info = manifest.get("embedding") or {}
+    if info.get("model") not in (None, EMBED_MODEL) and len(ds):
+        print(
+            f"[rag] warning: store of {loc.user_id} was embedded with "
+            f"{info['model']}, not {EMBED_MODEL}; re-upload its sources"
+        )
+
+    if index is None:
+        # no index yet: the dimension comes from the manifest or the docstore's
+        # vector column, never from the model
+        dim = int(info.get("dim") or ds.dim)
+        index = _build_empty_index(dim) if dim else None
+    return _Store(
+        index, ds, manifest, mmapped, lexical, packed=loc.kind == PACKED, deltas=deltas, tombstones=tombstones
+    )
+
+def _load_or_build(user_id: str, *, for_write: bool = False) -> _Store:
+    """
+    Return the user's store, served from the process-wide cache when the files
+    on disk have not changed since they were loaded.
+
+    Cached objects are shared between concurrent readers and must not be mutated;
+    pass for_write=True to get a private index/manifest copy that is safe to
+    modify and then hand to save_local(). The docstore is immutable and never copied.
+    """
+    loc = _LAYOUT.locate(user_id)
+    cached = _INDEX_CACHE.get(user_id, _stamp(loc), keep_stale=True)
+    if cached is None:
+        cached = _load_generation(user_id, None if for_write else _INDEX_CACHE.peek(user_id))
+
+    if for_write:
+        store = _Store(
+            _owned_copy(cached),
+            cached.docstore,
+            deepcopy(cached.manifest),
+            lexical=cached.lexical,
+            packed=cached.packed,
+            deltas=list(cached.deltas),
+            tombstones=cached.tombstones,
+        )
+        _conform_store(store)
+        return store
+    return cached
+
+_LOAD_LOCKS: Dict[str, threading.Lock] = {}
+_LOAD_LOCKS_GUARD = threading.Lock()
+
+def _load_generation(user_id: str, previous: _Store | None) -> _Store:
+    """
+    Load the current generation once per process however many threads ask
+    for it. While one thread loads, readers that already hold the previous
+    generation keep searching it instead of waiting: every generation is a
+    complete, immutable snapshot, so an older one is consistent, just older.
+    """
+    with _LOAD_LOCKS_GUARD:
+        lock = _LOAD_LOCKS.setdefault(user_id, threading.Lock())
+    if previous is not None and not lock.acquire(blocking=False):
+        return previous
+    if previous is None:
+        lock.acquire()
+    try:
+        for attempt in range(3):
+            loc = _LAYOUT.locate(user_id)
+            cached = _INDEX_CACHE.get(user_id, _stamp(loc), keep_stale=True)
+            if cached is not None:
+                return cached
+            try:
+                cached = _read_store(loc)
+            except FileNotFoundError:
+                # a generation superseded between reading its manifest and its files
+                if attempt == 2:
+                    raise
+                continue
+            _replay_wal(user_id, cached)
+            # a json -> bin migration during the read changes the stamp
+            _INDEX_CACHE.put(user_id, cached, _approx_nbytes(cached), _stamp(loc))
+            return cached
+    finally:
+        lock.release()
+
+# queries in flight per (user, generation), with the files that generation reads
+_PINS: Dict[str, Dict[int, List]] = {}
+_PINS_LOCK = threading.Lock()
+
+def _generation(store: _Store) -> int:
+    return int(store.manifest.get("generation", 0))
+
+def _base_files(manifest: Dict) -> set:
+    gen = int(manifest.get("base_gen", 0))
+    return {_gen_name(gen)} if gen else set(STORE_FILES)
+
+def _generation_files(store: _Store) -> set:
+    """Names, relative to a dedicated store directory, that a generation reads."""
+    return {d.name for d in store.deltas} | _base_files(store.manifest)
+
+@contextmanager
+def _pinned(user_id: str, store: _Store | None = None):
+    """
+    The user's current store (or the given, already loaded one), pinned for
+    the length of the block: a save that supersedes it will not reclaim its
+    files while the pin is held.
+    """
+    if store is None:
+        store = _load_or_build(user_id)
+    gen = _generation(store)
+    with _PINS_LOCK:
+        entry = _PINS.setdefault(user_id, {}).setdefault(gen, [store, 0])
+        entry[1] += 1
+    try:
+        yield store
+    finally:
+        with _PINS_LOCK:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _PINS[user_id][gen]
+                if not _PINS[user_id]:
+                    del _PINS[user_id]
+
+def _pinned_files(user_id: str) -> set:
+    with _PINS_LOCK:
+        stores = [entry[0] for entry in _PINS.get(user_id, {}).values()]
+    names: set = set()
+    for store in stores:
+        names |= _generation_files(store)
+    return names
+
+def _retire(user_id: str, base: str, store: _Store) -> List[str]:
+    """
+    Record in the manifest the files the new generation no longer reads, and
+    return those retired more than RAG_GENERATION_GRACE_SECONDS ago that no
+    pinned generation needs: delete them once the manifest is written.
+    """
+    now = time.time()
+    retired: Dict[str, float] = dict(store.manifest.get("retired") or {})
+    live = _generation_files(store) | {"manifest.json"}
+    for name in os.listdir(base) if os.path.isdir(base) else []:
+        reclaimable = name.startswith(("gen-", "delta-")) or name in STORE_FILES
+        if reclaimable and name not in live and not name.endswith(".tmp"):
+            retired.setdefault(name, now)
+    doomed = _due(user_id, retired, live, now)
+    for name in doomed:
+        retired.pop(name)
+    store.manifest["retired"] = retired
+    return doomed
+
+def _due(user_id: str, retired: Dict[str, float], live: set, now: float) -> List[str]:
+    pinned = _pinned_files(user_id)
+    return [
+        name for name, at in retired.items()
+        if now - at >= RAG_GENERATION_GRACE_SECONDS and name not in pinned and name not in live
+    ]
+
+_REAPERS: Dict[str, threading.Timer] = {}
+_REAPERS_LOCK = threading.Lock()
+
+def _schedule_reap(user_id: str, retired: Dict[str, float]) -> None:
+    """
+    Reclaim retired files when the oldest one's grace period is over, so a
+    store that stops being written does not keep its last generations forever.
+    """
+    if not retired:
+        return
+    delay = max(min(retired.values()) + RAG_GENERATION_GRACE_SECONDS - time.time(), 1.0)
+    with _REAPERS_LOCK:
+        if user_id in _REAPERS:
+            return  # an earlier run is due; it schedules the next one
+        timer = _REAPERS[user_id] = threading.Timer(delay, _reap, args=(user_id,))
+    timer.daemon = True
+    timer.start()
+
+def _reap(user_id: str) -> None:
+    """
+    Delete the retired files that are due. The manifest is left as is (its
+    stamp keeps the cached store valid); the next save drops the stale entries.
+    """
+    with _REAPERS_LOCK:
+        _REAPERS.pop(user_id, None)
+    try:
+        with _write_lock(user_id):
+            loc = _LAYOUT.locate(user_id)
+            if loc.kind != DEDICATED:
+                return
+            manifest = _load_manifest(_store_files(loc.base)[2])
+            live = _base_files(manifest) | {"manifest.json"}
+            live.update(Delta.file_name(span) for span in manifest.get("segments") or [])
+            retired = {
+                name: at for name, at in (manifest.get("retired") or {}).items()
+                if os.path.exists(os.path.join(loc.base, name))
+            }
+            doomed = _due(user_id, retired, live, time.time())
+            _delete_retired(loc.base, doomed)
+    except Exception as e:
+        print(f"[rag] warning: reclaiming old generations of {user_id} failed: {e}")
+        return
+    # still pinned by a query in flight, or not yet due: look again later
+    _schedule_reap(user_id, {name: at for name, at in retired.items() if name not in doomed})
+
+def _delete_retired(base: str, names: List[str]) -> None:
+    for name in names:
+        path = os.path.join(base, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def _replay_wal(user_id: str, store: _Store) -> None:
+    """
+    Re-apply logged writes newer than the checkpoint (manifest "wal_seq"):
+    those of a writer that crashed before its manifest was written, or of one
+    still in flight in another process. Records carry the vectors, so recovery
+    never re-embeds. Replaying only rebuilds the record's delta segment and
+    tombstones in memory; the base is never touched, so a half-written delta
+    file is simply written again.
+    """
+    done = int(store.manifest.get("wal_seq", 0))
+    records = [(h, v) for h, v in _wal(user_id).records() if int(h["seq"]) > done]
+    for header, vecs in records:
+        _mutate(store, header, vecs)
+        store.manifest["wal_seq"] = int(header["seq"])
+
+def _mutate(store: _Store, header: Dict, vecs: np.ndarray | None) -> None:
+    """Apply one logged write as LSM state: tombstones for removed ids, a delta for new rows."""
+    removed = np.asarray(header["removed"], dtype="int64")
+    ids = np.asarray(header["ids"], dtype="int64")
+    if "sources" in store.manifest:
+        _update_sources(store.manifest["sources"], header)
+    if removed.size:
+        store.tombstones = np.union1d(store.tombstones, removed)
+    if ids.size:
+        store.deltas.append(Delta.build(header["seq"], ids, header["texts"], header["metas"], vecs))
+        store.manifest["next_id"] = max(_next_doc_id(store), int(ids[-1]) + 1)
+
+def _apply(
+    store: _Store,
+    removed: np.ndarray,
+    ids: np.ndarray,
+    texts: List[str],
+    metas: List[Dict],
+    vecs: np.ndarray | None,
+) -> None:
+    """Drop `removed` ids, then add rows (ids above every existing id) in place."""
+    if removed.size:
+        store.docstore = store.docstore.without_ids(removed)
+        store.lexical = store.lexical.without_ids(removed)
+        if store.index is not None:
+            store.index = ann.remove_ids(store.index, removed, _remaining_vectors(store))
+    if ids.size:
+        if store.index is None:
+            store.index = _build_empty_index(vecs.shape[1])
+        ann.add(store.index, vecs, ids)
+        store.docstore = store.docstore.appended(list(zip(ids.tolist(), texts, metas)), vecs)
+        store.lexical = store.lexical.appended(ids, texts)
+        store.manifest["next_id"] = max(_next_doc_id(store), int(ids[-1]) + 1)
+
+def _commit(user_id: str, store: _Store, header: Dict, vecs: np.ndarray | None = None) -> None:
+    """
+    Log a mutation, apply it to the writable store and checkpoint. Callers hold
+    _write_lock(user_id). Once the record is fsync'd the write survives a crash
+    at any later point: the next load replays it over the last checkpoint.
+
+    The base index and docstore are not rewritten: the new rows become one more
+    delta segment and removed ids become tombstones, so a write costs about the
+    size of the change. Compaction folds them in later, off the write path.
+    """
+    seq = int(store.manifest.get("wal_seq", 0)) + 1
+    header = dict(header, seq=seq)
+    if vecs is not None:
+        header["dim"] = int(vecs.shape[1])
+    _wal(user_id).append(header, vecs)
+    _mutate(store, header, vecs)
+    store.manifest["wal_seq"] = seq
+    _save_tail(user_id, store)
+    _maybe_compact(user_id, store)
+
+def _conform_store(store: _Store) -> None:
+    """
+    Bring a writable store up to the current layout: backfill the float16 vector
+    column for stores written before it existed (from the index itself, no
+    re-embedding), build the BM25 index for stores that predate it, and
+    re-encode a flat index whose storage no longer matches RAG_QUANTIZATION,
+    and build the source manifest for stores that predate it.
+    """
+    store.lexical = _lexical_for(store)
+    if "sources" not in store.manifest:
+        store.manifest["sources"] = _backfill_sources(store)
+    ds = store.docstore
+    if store.index is None:
+        return
+    if len(ds) and ds.vectors is None:
+        store.docstore = ds = ds.with_vectors(
+            store.index.reconstruct_batch(np.asarray(ds.ids, dtype="int64"))
+        )
+    if not ann.conforms(store.index) and ds.vectors is not None:
+        ids = np.asarray(ds.ids, dtype="int64")
+        index = _build_empty_index(store.index.d)
+        if len(ds):
+            ann.add(index, ds.vectors_at(np.arange(len(ds))), ids)
+        store.index = index
+
+def _lexical_for(store: _Store) -> LexicalIndex:
+    """The store's BM25 index, tokenizing the docstore once if it has none yet."""
+    if store.lexical is None or len(store.lexical) != len(store.docstore):
+        ds = store.docstore
+        store.lexical = LexicalIndex.build(
+            np.asarray(ds.ids, dtype="int64"), [ds.text_at(i) for i in range(len(ds))]
+        )
+    return store.lexical
+
+def _remaining_vectors(store: _Store):
+    """Callback for ann.remove_ids: exact vectors + ids of the rows still stored."""
+    ds = store.docstore
+    return lambda: (ds.vectors_at(np.arange(len(ds))), np.asarray(ds.ids, dtype="int64"))
+
+def _write_index(base: str, faiss_path: str, index: faiss.Index) -> None:
     with tempfile.NamedTemporaryFile(delete=False, dir=base) as tmpf:
         tmp_name = tmpf.name
-    faiss.write_index(index, tmp_name)
+    ann.write_index(index, tmp_name)
+    with open(tmp_name, "rb") as f:
+        os.fsync(f.fileno())
     os.replace(tmp_name, faiss_path)
 
-    _save_docstore(docstore_path, docstore)
+def _sync_manifest(store: _Store) -> None:
+    """Start a new generation: record the LSM tail (deltas, tombstones) and embedding info."""
+    store.manifest["generation"] = _generation(store) + 1
+    store.manifest["segments"] = [d.span for d in store.deltas]
+    store.manifest["tombstones"] = store.tombstones.tolist()
+    if store.index is not None:
+        store.manifest["embedding"] = _embedding_info(store.index.d)
+        store.manifest["index_kind"] = ann.index_kind(store.index)
+        store.manifest["storage"] = ann.storage_kind(store.index)
+    elif store.deltas:
+        store.manifest["embedding"] = _embedding_info(store.deltas[0].docstore.dim)
+
+def _write_deltas(base: str, store: _Store) -> None:
+    # deltas are immutable: one already on disk is never rewritten
+    for d in store.deltas:
+        path = os.path.join(base, d.name)
+        if not os.path.exists(path):
+            d.save(path)
+
+def _write_files(user_id: str, base: str, store: _Store) -> None:
+    """
+    Write a store into a dedicated directory as a new base generation. Nothing
+    existing is modified: the new files go to gen-NNNNNN/ and become current
+    when the manifest is swapped in, so readers only ever see whole generations.
+    """
+    gen = int(store.manifest.get("base_gen", 0)) + 1
+    gen_dir = os.path.join(base, _gen_name(gen))
+    _ensure_dir(gen_dir)
+    faiss_path, docstore_path, _, lexical_path = _store_files(gen_dir)
+    _write_deltas(base, store)
+    if store.index is not None:
+        _write_index(gen_dir, faiss_path, store.index)
+    store.docstore.save(docstore_path)
+    _lexical_for(store).save(lexical_path)
+    _fsync_dir(gen_dir)
+    store.manifest["base_gen"] = gen
+    _swap_manifest(user_id, base, store)
+
+def _swap_manifest(user_id: str, base: str, store: _Store) -> None:
+    """Make the store's files current (atomic manifest replace), then reclaim old ones."""
+    doomed = _retire(user_id, base, store)
+    _save_manifest(_store_files(base)[2], store.manifest)
+    _delete_retired(base, doomed)
+    _schedule_reap(user_id, store.manifest["retired"])
+
+def _store_blobs(store: _Store) -> Dict[str, bytes]:
+    blobs = {
+        "docstore.bin": store.docstore.to_bytes(),
+        "lexical.bin": _lexical_for(store).to_bytes(),
+        "manifest.json": json.dumps(store.manifest, ensure_ascii=False).encode("utf-8"),
+    }
+    if store.index is not None:
+        blobs["faiss.index"] = ann.serialize_index(store.index)
+    for d in store.deltas:
+        blobs[d.name] = d.to_bytes()
+    return blobs
+
+def _estimated_nbytes(store: _Store) -> int:
+    ds = store.docstore
+    index_bytes = ann.approx_bytes(store.index) if store.index is not None else 0
+    vector_bytes = ds.vectors.nbytes if ds.dim else 0
+    delta_bytes = sum(d.nbytes for d in store.deltas)
+    return index_bytes + ds.text_nbytes + vector_bytes + 16 * len(ds) + delta_bytes
+
+def save_local(user_id: str, store: _Store) -> None:
+    """
+    Persist the store as a new generation: packed into its segment while it is
+    small, otherwise as files in a dedicated directory. Either way readers see
+    the old or the new generation, never a mix (segment writes are one
+    transaction; dedicated generations are new files behind an atomically
+    swapped manifest). Callers hold _write_lock(user_id); a successful
+    checkpoint empties the write-ahead log.
+    """
+    _sync_manifest(store)
+
+    loc = _LAYOUT.locate(user_id)
+    blobs = None
+    if loc.kind != DEDICATED and _estimated_nbytes(store) <= RAG_PACK_MAX_BYTES:
+        blobs = _store_blobs(store)
+    if blobs is not None and sum(len(b) for b in blobs.values()) <= RAG_PACK_MAX_BYTES:
+        loc = Location(user_id, PACKED, version=_LAYOUT.write_packed(user_id, blobs))
+        store.packed = True
+    elif loc.kind == DEDICATED:
+        _write_files(user_id, loc.base, store)
+    else:
+        # outgrew its segment: files first, then flip the directory entry
+        loc = Location(user_id, DEDICATED, _LAYOUT.dedicated_dir(user_id))
+        _write_files(user_id, loc.base, store)
+        _fsync_dir(os.path.dirname(loc.base))  # the new directory's own entry
+        _LAYOUT.set_dedicated(user_id, loc.base)
+        store.packed = False
+
+    _wal(user_id).reset()
+
+    # the freshly written state becomes the cached copy for readers
+    _INDEX_CACHE.put(user_id, store, _approx_nbytes(store), _stamp(loc))
+    _drop_results(user_id)
+
+    _maybe_promote(user_id, store)
+
+def _save_tail(user_id: str, store: _Store) -> None:
+    """
+    Persist a store whose base is unchanged since it was loaded: a dedicated
+    store only gets its new delta files and manifest written. Packed stores are
+    small and rewritten whole by save_local() in one transaction.
+    """
+    loc = _LAYOUT.locate(user_id)
+    if loc.kind != DEDICATED:
+        save_local(user_id, store)
+        return
+    _sync_manifest(store)
+    _write_deltas(loc.base, store)
+    _swap_manifest(user_id, loc.base, store)
+    _wal(user_id).reset()
+    _INDEX_CACHE.put(user_id, store, _approx_nbytes(store), _stamp(loc))
+    _drop_results(user_id)
+
+# ---------------------------
+# Compaction
+# ---------------------------
+
+_COMPACTING: set = set()
+_COMPACTING_LOCK = threading.Lock()
+
+MINOR, MAJOR = "minor", "major"
+
+def _compaction_kind(store: _Store) -> str | None:
+    delta_rows = sum(len(d) for d in store.deltas)
+    churn = delta_rows + int(store.tombstones.size)
+    if churn and (
+        churn > RAG_LSM_MERGE_RATIO * len(store.docstore) or delta_rows > RAG_LSM_MAX_DELTA_ROWS
+    ):
+        return MAJOR
+    if len(store.deltas) > RAG_LSM_MAX_SEGMENTS:
+        return MINOR
+    return None
+
+def _maybe_compact(user_id: str, store: _Store) -> None:
+    """Start a background compaction once the LSM tail grows past its limits."""
+    kind = _compaction_kind(store)
+    if kind is None:
+        return
+    with _COMPACTING_LOCK:
+        if user_id in _COMPACTING:
+            return
+        _COMPACTING.add(user_id)
+    threading.Thread(
+        target=_compact, args=(user_id, kind), name=f"rag-compact-{user_id}", daemon=True
+    ).start()
+
+def _fold(store: _Store, deltas: List[Delta], tombstones: np.ndarray) -> None:
+    """Rewrite the base in place with the deltas' rows added and tombstoned rows purged."""
+    delta_ids = np.concatenate([np.asarray(d.docstore.ids, dtype="int64") for d in deltas] or [np.zeros(0, "int64")])
+    # dropping the delta ids as well heals a base left half-written by a crashed
+    # compaction; only ids actually in the base count, since any removal makes
+    # an HNSW index rebuild its graph
+    doomed = np.intersect1d(
+        np.union1d(tombstones, delta_ids), np.asarray(store.docstore.ids, dtype="int64")
+    )
+    if doomed.size:
+        _apply(store, doomed, np.zeros(0, dtype="int64"), [], [], None)
+    if not deltas:
+        return
+    live = Delta.merged(deltas, tombstones).docstore
+    if len(live):
+        _apply(
+            store,
+            np.zeros(0, dtype="int64"),
+            np.asarray(live.ids, dtype="int64"),
+            [live.text_at(i) for i in range(len(live))],
+            [live.metadata_at(i) for i in range(len(live))],
+            live.vectors_at(np.arange(len(live))),
+        )
+
+def _compact(user_id: str, kind: str) -> None:
+    """
+    Minor: merge the deltas into one. Major: fold deltas and tombstones into the
+    base index and docstore. The work runs on a snapshot without the write
+    lock, so writes keep landing and readers keep the cached store; the lock is
+    only taken for the swap, which keeps every delta and tombstone newer than
+    the snapshot. The swap is skipped if the base was replaced meanwhile (by
+    another compaction or an ANN promotion, both of which bump base_seq).
+    """
+    failed = False
+    try:
+        snap = _load_or_build(user_id)
+        if not snap.deltas and not snap.tombstones.size:
+            return
+        merged_seqs = {d.seq for d in snap.deltas}
+        delta_ids = np.concatenate(
+            [np.asarray(d.docstore.ids, dtype="int64") for d in snap.deltas] or [np.zeros(0, "int64")]
+        )
+        if kind == MAJOR:
+            # the snapshot's manifest (sources included) keeps _conform_store
+            # from backfilling; the one swapped in is re-read under the lock
+            work = _Store(
+                _owned_copy(snap), snap.docstore, deepcopy(snap.manifest), lexical=snap.lexical, packed=snap.packed
+            )
+            work.mmapped = False
+            _conform_store(work)
+            _fold(work, snap.deltas, snap.tombstones)
+            purged = snap.tombstones
+        else:
+            merged = Delta.merged(snap.deltas, snap.tombstones)
+            purged = np.intersect1d(snap.tombstones, delta_ids)
+
+        with _write_lock(user_id):
+            cur = _load_or_build(user_id, for_write=True)
+            if cur.manifest.get("base_seq", 0) != snap.manifest.get("base_seq", 0):
+                return
+            if not merged_seqs <= {d.seq for d in cur.deltas}:
+                return
+            newer = [d for d in cur.deltas if d.seq not in merged_seqs]
+            tombstones = np.setdiff1d(cur.tombstones, purged)
+            if kind == MAJOR:
+                work.manifest = deepcopy(cur.manifest)
+                work.manifest["base_seq"] = int(cur.manifest.get("base_seq", 0)) + 1
+                work.deltas, work.tombstones = newer, tombstones
+                save_local(user_id, work)
+            else:
+                cur.deltas = ([merged] if len(merged) else []) + newer
+                cur.tombstones = tombstones
+                _save_tail(user_id, cur)
+    except Exception as e:
+        failed = True
+        print(f"[rag] warning: {kind} compaction failed for {user_id}: {e}")
+    finally:
+        with _COMPACTING_LOCK:
+            _COMPACTING.discard(user_id)
+        if not failed:
+            # deltas that landed during the run would otherwise wait for the next write
+            _maybe_compact(user_id, _load_or_build(user_id))
+
+# ---------------------------
+# ANN promotion
+# ---------------------------
+
+_PROMOTING: set = set()
+_PROMOTING_LOCK = threading.Lock()
+
+def _maybe_promote(user_id: str, store: _Store) -> None:
+    """Start a background promotion once a flat store crosses RAG_ANN_THRESHOLD."""
+    if store.index is None or not ann.should_promote(store.index):
+        return
+    with _PROMOTING_LOCK:
+        if user_id in _PROMOTING:
+            return
+        _PROMOTING.add(user_id)
+    threading.Thread(
+        target=_promote, args=(user_id, store), name=f"rag-promote-{user_id}", daemon=True
+    ).start()
+
+def _promote(user_id: str, snapshot: _Store) -> None:
+    """
+    Train an approximate index from the vectors already in the flat index and
+    swap it in. Readers keep using the cached flat index until the swap.
+    """
+    try:
+        ds = snapshot.docstore
+        ids = np.asarray(ds.ids, dtype="int64")
+        vecs = (
+            ds.vectors_at(np.arange(len(ds)))
+            if ds.vectors is not None
+            else snapshot.index.reconstruct_batch(ids)
+        )
+        new_index = ann.build_trained(ann.promotion_kind(), vecs, ids)
+
+        # catch up with writes that landed while we were training
+        with _write_lock(user_id):
+            cur = _load_or_build(user_id, for_write=True)
+            if ann.index_kind(cur.index) != ann.FLAT:
+                return
+            cur_ids = np.asarray(cur.docstore.ids, dtype="int64")
+            added = np.setdiff1d(cur_ids, ids, assume_unique=True)
+            removed = np.setdiff1d(ids, cur_ids, assume_unique=True)
+            if added.size:
+                new_index.add_with_ids(cur.docstore.vectors_at(cur.docstore.positions(added)), added)
+            cur.index = ann.remove_ids(new_index, removed, _remaining_vectors(cur))
+            # a compaction that snapshotted the flat base must not swap it back in
+            cur.manifest["base_seq"] = int(cur.manifest.get("base_seq", 0)) + 1
+            save_local(user_id, cur)
+    except Exception as e:
+        print(f"[rag] warning: {ann.promotion_kind()} promotion failed for {user_id}: {e}")
+    finally:
+        with _PROMOTING_LOCK:
+            _PROMOTING.discard(user_id)
+
+def _set_params(params: Dict, nprobe: int | None, ef_search: int | None) -> None:
+    if nprobe is not None:
+        params["nprobe"] = int(nprobe)
+    if ef_search is not None:
+        params["ef_search"] = int(ef_search)
+
+def _rewrite_manifest(user_id: str, store: _Store, manifest: Dict) -> None:
+    """
+    Replace only the manifest of a store with no logged writes pending (its
+    files stay as they are) and cache the store under the new one. Callers
+    hold _write_lock(user_id).
+    """
+    loc = _LAYOUT.locate(user_id)
+    if loc.kind == DEDICATED:
+        _save_manifest(_store_files(loc.base)[2], manifest)
+    else:
+        payload = json.dumps(manifest, ensure_ascii=False).encode("utf-8")
+        version = _LAYOUT.write_packed(user_id, {"manifest.json": payload}, replace=False)
+        loc = Location(user_id, PACKED, version=version)
+    _INDEX_CACHE.put(
+        user_id,
+        replace(store, manifest=manifest, packed=loc.kind == PACKED),
+        _approx_nbytes(store),
+        _stamp(loc),
+    )
+
+def set_search_params(user_id: str, *, nprobe: int | None = None, ef_search: int | None = None) -> Dict:
+    """
+    Persist per-user ANN search parameters (IVF nprobe / HNSW efSearch).
+    None leaves a value unchanged. Returns the effective parameters.
+    """
+    if RAG_BACKEND == PGVECTOR:
+        raise ValueError("With the pgvector backend, ef_search is set server-wide (RAG_PG_EF_SEARCH)")
+    with _write_lock(user_id):
+        if _wal(user_id).exists():
+            # logged writes are pending: checkpoint everything, not just the manifest
+            store = _load_or_build(user_id, for_write=True)
+            params = store.manifest.setdefault("search", {})
+            _set_params(params, nprobe, ef_search)
+            save_local(user_id, store)
+        else:
+            store = _load_or_build(user_id)
+            manifest = deepcopy(store.manifest)
+            params = manifest.setdefault("search", {})
+            _set_params(params, nprobe, ef_search)
+            # same files, but results may change: a new generation for the result cache
+            manifest["generation"] = _generation(store) + 1
+            _rewrite_manifest(user_id, store, manifest)
+            _drop_results(user_id)
+    return {
+        "index_kind": ann.index_kind(store.index) if store.index is not None else ann.FLAT,
+        "nprobe": params.get("nprobe", ann.DEFAULT_NPROBE),
+        "ef_search": params.get("ef_search", ann.DEFAULT_EF_SEARCH),
+    }
 
 # ---------------------------
 # Public helpers used by API
@@ -187,34 +1385,15 @@ def upsert_chunks_for_source(
 ) -> int:
     """
     Upsert chunk records for a given source. Each chunk dict must include "text".
-    We always create new IDs (no partial update). Old chunks for the source are removed first.
+    Old chunks for the source are removed by id first; vectors for every other
+    source stay in the index untouched, so only the new chunks are embedded, and
+    of those only texts not already in the chunk embedding cache.
     """
     source = source or "uploaded"
     metadata = dict(metadata or {})
     metadata.setdefault("source", source)
+    metadata.setdefault("uploaded_at", int(time.time()))
 
-    index, docstore = _load_or_build(user_id)
-
-    # 1) remove existing vectors for this source by rebuilding from remaining docs
-    if docstore:
-        remaining = {k: v for k, v in docstore.items() if v.get("metadata", {}).get("source") != source}
-    else:
-        remaining = {}
-
-    # Rebuild index with "remaining"
-    if remaining:
-        # embed in batches
-        texts = [v["page_content"] for v in remaining.values()]
-        embs = _embed_texts(texts)
-        new_index = _build_empty_index(embs.shape[1])
-        new_index.add(embs)
-        index = new_index
-    else:
-        # brand new
-        dim = int(_embed_texts(["dummy"]).shape[1])
-        index = _build_empty_index(dim)
-
-    # 2) add new chunks
     cleaned_chunks = []
     for c in chunks:
         if not isinstance(c, dict):
@@ -227,22 +1406,37 @@ def upsert_chunks_for_source(
         rec = {"page_content": t, "metadata": md}
         cleaned_chunks.append(rec)
 
-    if not cleaned_chunks:
-        # nothing to add, persist (so previous source delete sticks)
-        save_local(user_id, index, remaining)
-        return 0
-
+    # embed before taking the write lock; only the store update is serialized
     texts = [r["page_content"] for r in cleaned_chunks]
-    vecs = _embed_texts(texts)
-    index.add(vecs)
+    vecs = _embed_chunks(texts) if texts else None
 
-    # IDs must align in the order we add
-    # We store docs in an ordered mapping via incremental UUIDs.
-    for rec in cleaned_chunks:
-        doc_id = str(uuid.uuid4())
-        remaining[doc_id] = rec
+    if RAG_BACKEND == PGVECTOR:
+        metas = [r["metadata"] for r in cleaned_chunks]
+        entry = _source_entry(texts, metas, EMBED_MODEL) if texts else None
+        _pg().upsert_source(user_id, source, _hash_source(source), texts, metas, vecs, entry)
+        return len(cleaned_chunks)
 
-    save_local(user_id, index, remaining)
+    with _write_lock(user_id):
+        store = _load_or_build(user_id, for_write=True)
+        # old chunks of the source go by id; every other vector stays in place
+        stale = _ids_for_source(store, source)
+        if not stale.size and not texts:
+            return 0
+        start = _next_doc_id(store)
+        _commit(
+            user_id,
+            store,
+            {
+                "op": "upsert",
+                "source": source,
+                "removed": stale.tolist(),
+                "ids": list(range(start, start + len(texts))),
+                "texts": texts,
+                "metas": [r["metadata"] for r in cleaned_chunks],
+                "model": EMBED_MODEL,
+            },
+            vecs,
+        )
     return len(cleaned_chunks)
 
 def list_sources(user_id: str) -> List[Dict]:
@@ -250,76 +1444,539 @@ def list_sources(user_id: str) -> List[Dict]:
     Return a list of sources with chunk counts and a deterministic file_id.
     Example: [{"source":"resume.pdf","chunks":12,"file_id":"ab12cd34ef56..."}]
     """
-    _, _, docstore_path = _paths_for_user(user_id)
-    ds = _load_docstore(docstore_path)
-    counts: Dict[str, int] = {}
-    for v in ds.values():
-        src = (v.get("metadata") or {}).get("source", "unknown")
-        counts[src] = counts.get(src, 0) + 1
-
     out = []
-    for src, n in sorted(counts.items()):
-        out.append({"source": src, "chunks": n, "file_id": _hash_source(src)})
+    for src, entry in sorted(_read_sources(user_id).items()):
+        out.append(dict(entry, source=src, file_id=_hash_source(src)))
     return out
 
+def _read_sources(user_id: str) -> Dict[str, Dict]:
+    """
+    The user's source manifest ({source: {chunks, bytes, content_hash,
+    uploaded_at, embedding_model}}) without loading the store: from the cached
+    store when it is current, else from manifest.json plus any logged writes
+    not yet checkpointed. Stores that predate the manifest are loaded once to
+    build it, and it is saved with them.
+    """
+    if RAG_BACKEND == PGVECTOR:
+        return _pg().read_sources(user_id)
+    loc = _LAYOUT.locate(user_id)
+    # keep_stale: a superseded store may still be serving queries in flight
+    cached = _INDEX_CACHE.get(user_id, _stamp(loc), keep_stale=True)
+    if cached is not None and "sources" in cached.manifest:
+        return cached.manifest["sources"]
+
+    if loc.kind == PACKED:
+        raw = _LAYOUT.read_blob(user_id, "manifest.json")
+        manifest = json.loads(raw) if raw else {}
+    elif loc.kind == DEDICATED:
+        manifest = _load_manifest(_store_files(loc.base)[2])
+    else:
+        manifest = {"sources": {}}
+    if "sources" not in manifest:
+        return _save_backfilled_sources(user_id)
+
+    sources = manifest["sources"]
+    done = int(manifest.get("wal_seq", 0))
+    for header, _ in _wal(user_id).records():
+        if int(header["seq"]) > done:
+            _update_sources(sources, header)
+    return sources
+
+def _save_backfilled_sources(user_id: str) -> Dict[str, Dict]:
+    with _write_lock(user_id):
+        if _wal(user_id).exists():
+            # logged writes are pending: a checkpoint writes the backfill with them
+            store = _load_or_build(user_id, for_write=True)
+            save_local(user_id, store)
+            return store.manifest["sources"]
+        store = _load_or_build(user_id)
+        if "sources" in store.manifest:  # backfilled by another caller meanwhile
+            return store.manifest["sources"]
+        manifest = deepcopy(store.manifest)
+        manifest["sources"] = _backfill_sources(store)
+        _rewrite_manifest(user_id, store, manifest)
+        return manifest["sources"]
+
 def delete_source(user_id: str, source: str) -> int:
     """
-    Remove all chunks for a given source. Rebuild the FAISS index from remaining docs.
+    Remove all chunks for a given source by id. Remaining vectors are kept as-is.
     Returns number of removed chunks.
     """
-    index, docstore = _load_or_build(user_id)
-    if not docstore:
-        return 0
+    if RAG_BACKEND == PGVECTOR:
+        return _pg().delete_source(user_id, source)
+    with _write_lock(user_id):
+        store = _load_or_build(user_id, for_write=True)
+        stale = _ids_for_source(store, source)
+        if stale.size == 0:
+            return 0
+        _commit(
+            user_id,
+            store,
+            {"op": "delete", "source": source, "removed": stale.tolist(), "ids": [], "texts": [], "metas": []},
+        )
+    return int(stale.size)
 
-    keep = {}
-    removed = 0
-    for k, v in docstore.items():
-        if (v.get("metadata") or {}).get("source") == source:
-            removed += 1
-        else:
-            keep[k] = v
+def _rerank_exact(docstore: Docstore, qv: np.ndarray, labels: np.ndarray, k: int):
+    """Re-score one query's quantized candidates against the float16 vectors; keep top k."""
+    cand = labels[labels >= 0]
+    pos = docstore.positions(cand)
+    cand, pos = cand[pos >= 0], pos[pos >= 0]
+    exact = docstore.vectors_at(pos) @ qv
+    order = np.argsort(-exact)[:k]
+    return exact[order], cand[order]
 
-    if removed == 0:
-        return 0
+FILTER_KEYS = ("source", "source_contains", "mime", "file_id", "uploaded_after", "uploaded_before")
+
+def _as_set(value) -> set:
+    return {str(v) for v in value} if isinstance(value, (list, tuple, set)) else {str(value)}
+
+def _clean_filters(filters: Dict | None) -> Dict:
+    """Drop unset (None) keys; unknown keys raise ValueError."""
+    filters = {key: v for key, v in (filters or {}).items() if v is not None}
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown search filter(s): {', '.join(sorted(unknown))}")
+    return filters
+
+def _filter_predicate(filters: Dict) -> Callable[[Dict], bool] | None:
+    """
+    Metadata predicate for structured search filters:
+      source / mime / file_id      exact value or list of values
+      source_contains              case-insensitive substring of the source
+      uploaded_after / _before     unix seconds, inclusive
+    Unset (None) keys are ignored; unknown keys raise ValueError.
+    """
+    filters = _clean_filters(filters)
+    if not filters:
+        return None
+    sources = _as_set(filters["source"]) if "source" in filters else None
+    mimes = _as_set(filters["mime"]) if "mime" in filters else None
+    file_ids = _as_set(filters["file_id"]) if "file_id" in filters else None
+    contains = str(filters.get("source_contains") or "").lower()
+    after = filters.get("uploaded_after")
+    before = filters.get("uploaded_before")
+
+    def pred(md: Dict) -> bool:
+        src = str(md.get("source", "unknown"))
+        if sources is not None and src not in sources:
+            return False
+        if contains and contains not in src.lower():
+            return False
+        if mimes is not None and str(md.get("mime", "")) not in mimes:
+            return False
+        if file_ids is not None and _hash_source(src) not in file_ids:
+            return False
+        if after is not None or before is not None:
+            ts = md.get("uploaded_at")
+            if ts is None:
+                return False
+            if after is not None and ts < after:
+                return False
+            if before is not None and ts > before:
+                return False
+        return True
+
+    return pred
 
-    # rebuild FAISS from keep
-    if keep:
-        texts = [v["page_content"] for v in keep.values()]
-        embs = _embed_texts(texts)
-        new_index = _build_empty_index(embs.shape[1])
-        new_index.add(embs)
-        index = new_index
+def _allowed_ids(store: _Store, filters: Dict | None) -> np.ndarray | None:
+    """
+    Bitmap (bool indexed by doc id) of the live chunks passing filters across
+    the base and the deltas; None = no filter and no tombstones.
+    """
+    pred = _filter_predicate(filters)
+    if pred is None and not store.tombstones.size:
+        return None
+    size = max((int(ds.ids[-1]) + 1 for ds in _docstores(store) if len(ds)), default=0)
+    if pred is None:
+        allowed = np.ones(size, dtype=bool)
     else:
-        dim = int(_embed_texts(["dummy"]).shape[1])
-        index = _build_empty_index(dim)
+        allowed = np.zeros(size, dtype=bool)
+        for ds in _docstores(store):
+            allowed[np.asarray(ds.ids, dtype="int64")[ds.rows_where(pred)]] = True
+    dead = store.tombstones[store.tombstones < size]
+    allowed[dead] = False
+    return allowed
 
-    save_local(user_id, index, keep)
-    return removed
+def _search_store(
+    store: _Store,
+    qv: np.ndarray,
+    k: int,
+    *,
+    allowed: np.ndarray | None = None,
+    min_score: float | None = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Fan a stacked (n_queries, d) matrix out over the base index and every delta
+    segment and merge each query's top-k by score. Delta scores are exact inner
+    products, like the base's (re-ranked when quantized), so they compare directly.
+    """
+    parts = []
+    if store.index is not None and store.index.ntotal:
+        parts.append(_search_base(store, qv, k, allowed=allowed, min_score=min_score))
+    for d in store.deltas:
+        parts.append(d.search(qv, k, allowed, min_score))
+    if len(parts) == 1:
+        return parts[0]
+    return [merge_topk([p[r] for p in parts], k) for r in range(qv.shape[0])]
 
-def rag_search(user_id: str, query: str, k: int = 5) -> List[Dict]:
+def _search_base(
+    store: _Store,
+    qv: np.ndarray,
+    k: int,
+    *,
+    allowed: np.ndarray | None = None,
+    min_score: float | None = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
     """
-    Search the RAG index and return top-k snippets with metadata.
+    Run a stacked (n_queries, d) matrix through the base index in one search call.
+    Returns (scores, doc_ids) per query, best first.
+
+    allowed (from _allowed_ids) becomes an IDSelectorBitmap evaluated inside the
+    index, so filtered queries still get k hits when k matches exist. min_score
+    turns the search into a range search with that cutoff (binary codes have no
+    cosine radius, so there it filters the re-ranked candidates instead).
     """
-    index, docstore = _load_or_build(user_id)
-    if index.ntotal == 0 or not query.strip():
-        return []
+    index, docstore = store.index, store.docstore
+    sel = bits = None
+    if allowed is not None:
+        sel, bits = ann.id_selector(allowed)
+    params = ann.search_params(index, store.manifest.get("search") or {}, sel=sel)
+    rerank = ann.is_quantized(index) and docstore.vectors is not None
+    fetch = ann.candidates(index, k) if rerank else k
+
+    if min_score is None or not ann.supports_range_search(index):
+        scores, idxs = ann.search(index, qv, min(fetch, max(1, index.ntotal)), params)
+        rows = [(scores[r], idxs[r]) for r in range(qv.shape[0])]
+    else:
+        radius = min_score - ann.RANGE_MARGIN if ann.is_quantized(index) else min_score
+        lims, dist, labels = index.range_search(qv, float(radius), params=params)
+        rows = []
+        for r in range(qv.shape[0]):
+            row_scores, row_ids = dist[lims[r]:lims[r + 1]], labels[lims[r]:lims[r + 1]]
+            order = np.argsort(-row_scores, kind="stable")[:fetch]
+            rows.append((row_scores[order], row_ids[order]))
+
+    results = []
+    for r, (row_scores, row_ids) in enumerate(rows):
+        if rerank:
+            row_scores, row_ids = _rerank_exact(docstore, qv[r], row_ids, k)
+        keep = row_ids >= 0
+        if min_score is not None:
+            keep &= row_scores >= min_score
+        results.append((row_scores[keep][:k], row_ids[keep][:k]))
+    return results
+
+def _fuse_rrf(ranked: List[np.ndarray], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Reciprocal rank fusion of several best-first doc id lists -> (scores, doc_ids)."""
+    fused: Dict[int, float] = {}
+    for doc_ids in ranked:
+        for rank, doc_id in enumerate(doc_ids):
+            fused[int(doc_id)] = fused.get(int(doc_id), 0.0) + 1.0 / (RAG_RRF_K + rank + 1)
+    top = sorted(fused.items(), key=lambda kv: -kv[1])[:k]
+    return (
+        np.array([score for _, score in top], dtype="float32"),
+        np.array([doc_id for doc_id, _ in top], dtype="int64"),
+    )
 
-    qv = _embed_texts([query])
-    scores, idxs = index.search(qv, min(k, max(1, index.ntotal)))
-    # FAISS returns only ranks; we need to align with docstore order.
-    # Our docstore is not guaranteed ordered the same way — so we reconstruct
-    # the "insertion order" from current docstore iteration.
-    items = list(docstore.items())  # [(id, rec), ...] order matches add()
+def _to_hits(store: _Store, scores: np.ndarray, doc_ids: np.ndarray) -> List[Dict]:
+    # labels are the stable doc ids assigned at upsert time; each docstore
+    # resolves them to rows by binary search over its id column, newest first
+    doc_ids = np.asarray(doc_ids, dtype="int64")
+    where: List[Tuple[Docstore, int] | None] = [None] * doc_ids.size
+    for ds in reversed(_docstores(store)):
+        for i, pos in enumerate(ds.positions(doc_ids)):
+            if where[i] is None and doc_ids[i] >= 0 and pos >= 0:
+                where[i] = (ds, int(pos))
     hits = []
-    for rank, score in zip(idxs[0], scores[0]):
-        if rank < 0 or rank >= len(items):
+    for found, score in zip(where, scores):
+        if found is None:
             continue
-        _, rec = items[rank]
-        hits.append(
-            {
-                "text": rec["page_content"],
-                "metadata": rec.get("metadata") or {},
-                "score": float(score),
-            }
-        )
+        ds, pos = found
+        hits.append({"text": ds.text_at(pos), "metadata": ds.metadata_at(pos), "score": float(score)})
     return hits
+
+def _lexical_search(
+    store: _Store, query: str, k: int, allowed: np.ndarray | None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """BM25 over the base and the deltas, scored with their combined statistics."""
+    parts = [_lexical_for(store)] + [d.lexical for d in store.deltas]
+    if len(parts) == 1:
+        return parts[0].search(query, k, allowed)
+    corpus = corpus_stats(parts, query)
+    return merge_topk([p.search(query, k, allowed, corpus) for p in parts], k)
+
+def rag_search(
+    user_id: str,
+    query: str,
+    k: int = 5,
+    mode: str | None = None,
+    filters: Dict | None = None,
+    min_score: float | None = None,
+) -> List[Dict]:
+    """
+    Search the RAG index and return top-k snippets with metadata.
+    mode: "vector", "lexical" (BM25) or "hybrid"; defaults to RAG_SEARCH_MODE.
+    filters: see _filter_predicate; applied inside the search, not afterwards.
+    min_score: similarity cutoff (BM25 score in lexical mode).
+    """
+    return rag_search_many(
+        user_id, [query], k=k, mode=mode, filters=filters, min_score=min_score
+    )[0]
+
+def rag_search_many(
+    user_id: str,
+    queries: List[str],
+    k: int = 5,
+    mode: str | None = None,
+    filters: Dict | None = None,
+    min_score: float | None = None,
+) -> List[List[Dict]]:
+    """
+    Search several queries at once: one model.encode batch and one index.search
+    over the stacked query matrix. Returns one hit list per query, in order;
+    blank queries get [].
+
+    In hybrid mode each query's dense and BM25 candidate lists are fused by
+    reciprocal rank, and "score" is the fused score rather than a cosine;
+    min_score then applies to the dense candidates before fusion.
+
+    Results are cached per query in process and, with RAG_RESULT_CACHE_REDIS,
+    in Redis; only the queries missing from both are searched.
+    """
+    mode = (mode or RAG_SEARCH_MODE).lower()
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    if RAG_BACKEND == PGVECTOR:
+        return _pg_search([user_id], queries, k, mode, filters, min_score)
+    # the whole query runs against one generation, whatever lands meanwhile
+    with _pinned(user_id) as store:
+        # every save bumps the generation and every logged write wal_seq, so
+        # the pair names exactly one state of the store
+        version = f"{_generation(store)}.{int(store.manifest.get('wal_seq', 0))}"
+        results: List[List[Dict]] = [[] for _ in queries]
+        digests: Dict[int, str] = {}
+        for i, q in enumerate(queries):
+            if not q or not q.strip():
+                continue
+            digest = _result_digest(q, k, mode, filters, min_score)
+            raw = _RESULT_CACHE.get((user_id, digest), version)
+            if raw is None:
+                digests[i] = digest
+            else:
+                results[i] = json.loads(raw)
+
+        if digests and RAG_RESULT_CACHE_REDIS:
+            keys = [_result_redis_key(user_id, version, d) for d in digests.values()]
+            for (i, digest), raw in zip(list(digests.items()), _redis_mget(keys, _RESULT_REDIS_STATS)):
+                if raw is None:
+                    _RESULT_REDIS_STATS["misses"] += 1
+                    continue
+                _RESULT_REDIS_STATS["hits"] += 1
+                results[i] = json.loads(raw)
+                _RESULT_CACHE.put((user_id, digest), raw, len(raw), version)
+                del digests[i]
+
+        todo = list(digests)
+        found = _search_generation(store, [queries[i] for i in todo], k, mode, filters, min_score)
+        fresh: Dict[str, bytes] = {}
+        for i, hits in zip(todo, found):
+            results[i] = hits
+            raw = json.dumps(hits, ensure_ascii=False).encode("utf-8")
+            _RESULT_CACHE.put((user_id, digests[i]), raw, len(raw), version)
+            fresh[_result_redis_key(user_id, version, digests[i])] = raw
+        if RAG_RESULT_CACHE_REDIS:
+            _redis_set_many(fresh, RAG_RESULT_CACHE_TTL, _RESULT_REDIS_STATS)
+        return results
+
+def _search_generation(
+    store: _Store,
+    queries: List[str],
+    k: int,
+    mode: str,
+    filters: Dict | None,
+    min_score: float | None,
+) -> List[List[Dict]]:
+    results: List[List[Dict]] = [[] for _ in queries]
+    live = [i for i, q in enumerate(queries) if q and q.strip()]
+    if _ntotal(store) == 0 or not live:
+        return results
+    allowed = _allowed_ids(store, filters)
+    if allowed is not None and not allowed.any():
+        return results
+
+    fetch = k * max(1, RAG_HYBRID_FACTOR) if mode == "hybrid" else k
+    dense: List[Tuple[np.ndarray, np.ndarray]] = []
+    if mode != "lexical":
+        qv = _embed_queries([queries[i] for i in live])
+        dense = _search_store(store, qv, fetch, allowed=allowed, min_score=min_score)
+
+    for n, i in enumerate(live):
+        if mode == "vector":
+            scores, doc_ids = dense[n]
+        elif mode == "lexical":
+            scores, doc_ids = _lexical_search(store, queries[i], k, allowed)
+            if min_score is not None:
+                scores, doc_ids = scores[scores >= min_score], doc_ids[scores >= min_score]
+        else:
+            _, lex_ids = _lexical_search(store, queries[i], fetch, allowed)
+            scores, doc_ids = _fuse_rrf([dense[n][1], lex_ids], k)
+        results[i] = _to_hits(store, scores, doc_ids)
+    return results
+def _pg_search(
+    user_ids: List[str],
+    queries: List[str],
+    k: int,
+    mode: str,
+    filters: Dict | None,
+    min_score: float | None,
+) -> List[List[Dict]]:
+    """
+    rag_search_many on the pgvector backend: filters and min_score are part of
+    the SQL query. Lexical mode ranks by Postgres full-text ts_rank_cd rather
+    than BM25; hybrid fuses the two candidate lists by reciprocal rank as usual.
+    """
+    filters = _clean_filters(filters)
+    results: List[List[Dict]] = [[] for _ in queries]
+    live = [i for i, q in enumerate(queries) if q and q.strip()]
+    if not live:
+        return results
+    texts = [queries[i] for i in live]
+    fetch = k * max(1, RAG_HYBRID_FACTOR) if mode == "hybrid" else k
+    if mode != "lexical":
+        dense = _pg().search(user_ids, texts, _embed_queries(texts), fetch, filters, min_score, lexical=False)
+    if mode != "vector":
+        lex = _pg().search(user_ids, texts, None, fetch, filters, None, lexical=True)
+
+    for n, i in enumerate(live):
+        if mode == "vector":
+            rows = dense[n]
+        elif mode == "lexical":
+            rows = [r for r in lex[n] if min_score is None or r["score"] >= min_score]
+        else:
+            by_id = {r["id"]: r for r in dense[n] + lex[n]}
+            ranked = [np.array([r["id"] for r in part], dtype="int64") for part in (dense[n], lex[n])]
+            scores, doc_ids = _fuse_rrf(ranked, k)
+            rows = [dict(by_id[int(d)], score=s) for s, d in zip(scores.tolist(), doc_ids.tolist())]
+        hits = []
+        for r in rows:
+            hit = {"text": r["text"], "metadata": r["metadata"], "score": float(r["score"])}
+            if r["user_id"].startswith(CORPUS_PREFIX):
+                hit["corpus"] = r["user_id"][len(CORPUS_PREFIX):]
+            hits.append(hit)
+        results[i] = hits
+    return results
+
+# ---------------------------
+# Shared corpora and federated search
+# ---------------------------
+
+CORPUS_PREFIX = "_corpus."
+
+def corpus_store_id(name: str) -> str:
+    """
+    Store id of a shared corpus. Corpora are ordinary stores under this id:
+    ingest with upsert_chunks_for_source(corpus_store_id(name), ...), or
+    through the admin endpoints (/v1/admin/rag/corpora/...).
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_.-]+", name or ""):
+        raise ValueError(f"Invalid corpus name: {name!r}")
+    return CORPUS_PREFIX + name
+
+# name -> (stamp, store); outside _INDEX_CACHE so tenant churn never evicts a corpus
+_SHARED: Dict[str, Tuple[Tuple, _Store]] = {}
+_SHARED_LOCK = threading.Lock()
+
+def _shared_store(name: str) -> _Store:
+    """
+    A shared corpus, loaded once per process and served read-only to every
+    tenant. It is only reloaded when the corpus itself is re-ingested.
+    """
+    cid = corpus_store_id(name)
+    loc = _LAYOUT.locate(cid)
+    stamp = _stamp(loc)
+    entry = _SHARED.get(name)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    with _SHARED_LOCK:
+        entry = _SHARED.get(name)
+        if entry is None or entry[0] != stamp:
+            store = _read_store(loc)
+            _replay_wal(cid, store)
+            entry = _SHARED[name] = (stamp, store)
+    return entry[1]
+
+_FEDERATION_POOL: ThreadPoolExecutor | None = None
+_FEDERATION_POOL_LOCK = threading.Lock()
+
+def _federation_pool() -> ThreadPoolExecutor:
+    global _FEDERATION_POOL
+    with _FEDERATION_POOL_LOCK:
+        if _FEDERATION_POOL is None:
+            _FEDERATION_POOL = ThreadPoolExecutor(
+                max_workers=max(1, RAG_FEDERATED_WORKERS), thread_name_prefix="rag-federated"
+            )
+        return _FEDERATION_POOL
+
+def _dense_hits(
+    store: _Store, qv: np.ndarray, k: int, filters: Dict | None, min_score: float | None
+) -> List[Dict]:
+    if _ntotal(store) == 0:
+        return []
+    allowed = _allowed_ids(store, filters)
+    if allowed is not None and not allowed.any():
+        return []
+    scores, doc_ids = _search_store(store, qv, k, allowed=allowed, min_score=min_score)[0]
+    return _to_hits(store, scores, doc_ids)
+
+def rag_search_federated(
+    user_id: str,
+    query: str,
+    corpora: Sequence[str] = (),
+    k: int = 5,
+    filters: Dict | None = None,
+    min_score: float | None = None,
+) -> List[Dict]:
+    """
+    Dense search over the user's store plus shared read-only corpora, merged
+    into one top-k by score. The query is embedded once and every store is
+    searched concurrently on a thread pool (FAISS and the numpy kernels release
+    the GIL). Hits from a corpus carry its name under "corpus". Corpora
+    embedded with another model are skipped: their scores are not comparable.
+    Raises ValueError for a corpus not shared through RAG_SHARED_CORPORA.
+    """
+    unshared = [name for name in corpora if name not in RAG_SHARED_CORPORA]
+    if unshared:
+        raise ValueError(f"Corpus not shared (RAG_SHARED_CORPORA): {', '.join(map(repr, unshared))}")
+    if not query or not query.strip():
+        return []
+    if not corpora:
+        return rag_search(user_id, query, k=k, mode="vector", filters=filters, min_score=min_score)
+    if RAG_BACKEND == PGVECTOR:
+        # one table holds every store: a single query over all the ids
+        ids = [user_id] + [corpus_store_id(name) for name in dict.fromkeys(corpora)]
+        return _pg_search(ids, [query], k, "vector", filters, min_score)[0]
+    qv = _embed_queries([query])
+    with ExitStack() as stack:
+        targets = [(None, stack.enter_context(_pinned(user_id)))]
+        for name in dict.fromkeys(corpora):
+            store = _shared_store(name)
+            if (store.manifest.get("embedding") or {}).get("model") not in (None, EMBED_MODEL):
+                continue
+            targets.append((name, stack.enter_context(_pinned(corpus_store_id(name), store))))
+        pool = _federation_pool()
+        futures = [pool.submit(_dense_hits, store, qv, k, filters, min_score) for _, store in targets]
+        hits: List[Dict] = []
+        for (name, _), future in zip(targets, futures):
+            for hit in future.result():
+                if name is not None:
+                    hit["corpus"] = name
+                hits.append(hit)
+    hits.sort(key=lambda h: -h["score"])
+    return hits[:k]
+
+
+if __name__ == "__main__":
+    # python -m app.rag.index  -> convert any remaining docstore.json stores
+    # python -m app.rag.index  -> then pack small per-user directories into segments
+    print(f"migrated {migrate_json_docstores()} store(s) under {RAG_STORE_DIR}")
+    print(f"packed {pack_small_stores()} small store(s) into {RAG_PACK_SEGMENTS} segment(s)")
@@ -0,0 +1,185 @@
+# app/rag/layout.py
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from hashlib import sha1
+from typing import Dict, Optional, Tuple
+
+# On-disk layout under the store root:
+#
+#   segments/seg-NN.sqlite   shared segment files. A tenant hashes to one of them;
+#                            its `tenants` row says where the tenant's store lives
+#                            and, for small tenants, `blobs` holds the store's
+#                            files (index, docstore, manifest, lexical) inline.
+#   tenants/<hh>/<user_id>/  dedicated directory for a tenant that outgrew packing
+#   <user_id>/               pre-segment per-user directory; still served in place
+#   wal/<hh>/<user_id>.wal   write-ahead log of mutations not yet checkpointed
+#   wal/<hh>/.locks          writer locks of the shard's tenants: one byte each
+#                            (fcntl record lock at the tenant's slot), so no
+#                            file per tenant; shared by all workers
+#
+# Packing keeps one file per ~thousand small tenants instead of a directory with
+# four files each. Lookups only ever read: nothing is created until a write.
+PACKED = "packed"
+DEDICATED = "dedicated"
+MISSING = "missing"
+
+RESERVED_NAMES = ("segments", "tenants", "wal", "_embeddings")
+
+
+@dataclass(frozen=True)
+class Location:
+    user_id: str
+    kind: str  # PACKED | DEDICATED | MISSING
+    base: Optional[str] = None  # directory of a dedicated store
+    version: int = 0  # bumped on every packed write
+
+
+class SegmentDirectory:
+    """Tenant -> segment directory plus the packed blobs, in shared SQLite files."""
+
+    def __init__(self, root: str, n_segments: int):
+        self.root = root
+        self.n_segments = max(1, int(n_segments))
+        self._conns: Dict[int, sqlite3.Connection] = {}
+        self._locks: Dict[int, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    # -- addressing --
+
+    def segment_for(self, user_id: str) -> int:
+        return int(sha1(user_id.encode("utf-8")).hexdigest()[:8], 16) % self.n_segments
+
+    def segment_path(self, seg: int) -> str:
+        return os.path.join(self.root, "segments", f"seg-{seg:03d}.sqlite")
+
+    def dedicated_dir(self, user_id: str) -> str:
+        shard = sha1(user_id.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.root, "tenants", shard, user_id)
+
+    def legacy_dir(self, user_id: str) -> str:
+        return os.path.join(self.root, user_id)
+
+    def wal_path(self, user_id: str) -> str:
+        shard = sha1(user_id.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.root, "wal", shard, f"{user_id}.wal")
+
+    def lock_path(self, user_id: str) -> str:
+        return os.path.join(os.path.dirname(self.wal_path(user_id)), ".locks")
+
+    def lock_slot(self, user_id: str) -> int:
+        """Byte offset of the tenant's writer lock in lock_path (tenants rarely share one)."""
+        return int(sha1(user_id.encode("utf-8")).hexdigest()[2:10], 16)
+
+    # -- connections --
+
+    def _conn(self, seg: int, *, create: bool) -> Tuple[Optional[sqlite3.Connection], threading.Lock]:
+        with self._guard:
+            lock = self._locks.setdefault(seg, threading.Lock())
+            conn = self._conns.get(seg)
+            if conn is not None:
+                return conn, lock
+            path = self.segment_path(seg)
+            if not os.path.exists(path):
+                if not create:
+                    return None, lock
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # FULL: a committed segment write is a checkpoint, after which the
+            # tenant's write-ahead log is discarded
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tenants ("
+                " user_id TEXT PRIMARY KEY, kind TEXT NOT NULL, path TEXT,"
+                " version INTEGER NOT NULL DEFAULT 0, nbytes INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " user_id TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL,"
+                " PRIMARY KEY (user_id, name))"
+            )
+            conn.commit()
+            self._conns[seg] = conn
+            return conn, lock
+
+    # -- reads (never create files or directories) --
+
+    def locate(self, user_id: str) -> Location:
+        conn, lock = self._conn(self.segment_for(user_id), create=False)
+        row = None
+        if conn is not None:
+            with lock:
+                row = conn.execute(
+                    "SELECT kind, path, version FROM tenants WHERE user_id = ?", (user_id,)
+                ).fetchone()
+        if row is not None:
+            kind, path, version = row
+            return Location(user_id, kind, path, int(version))
+        legacy = self.legacy_dir(user_id)
+        if os.path.isdir(legacy):
+            return Location(user_id, DEDICATED, legacy)
+        return Location(user_id, MISSING)
+
+    def read_blobs(self, user_id: str) -> Dict[str, bytes]:
+        conn, lock = self._conn(self.segment_for(user_id), create=False)
+        if conn is None:
+            return {}
+        with lock:
+            rows = conn.execute(
+                "SELECT name, data FROM blobs WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return {name: bytes(data) for name, data in rows}
+
+    def read_blob(self, user_id: str, name: str) -> Optional[bytes]:
+        conn, lock = self._conn(self.segment_for(user_id), create=False)
+        if conn is None:
+            return None
+        with lock:
+            row = conn.execute(
+                "SELECT data FROM blobs WHERE user_id = ? AND name = ?", (user_id, name)
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    # -- writes --
+
+    def write_packed(self, user_id: str, blobs: Dict[str, bytes], *, replace: bool = True) -> int:
+        """
+        Store blobs for a packed tenant in one transaction and return the new
+        version. replace=False updates only the given names and keeps the rest.
+        """
+        conn, lock = self._conn(self.segment_for(user_id), create=True)
+        version = time.time_ns()
+        with lock:
+            with conn:
+                if replace:
+                    conn.execute("DELETE FROM blobs WHERE user_id = ?", (user_id,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO blobs (user_id, name, data) VALUES (?, ?, ?)",
+                    [(user_id, name, sqlite3.Binary(data)) for name, data in blobs.items()],
+                )
+                (nbytes,) = conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM blobs WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO tenants (user_id, kind, path, version, nbytes)"
+                    " VALUES (?, ?, NULL, ?, ?)",
+                    (user_id, PACKED, version, int(nbytes)),
+                )
+        return version
+
+    def set_dedicated(self, user_id: str, base: str) -> None:
+        """Point the tenant at its own directory and drop any packed blobs."""
+        conn, lock = self._conn(self.segment_for(user_id), create=True)
+        with lock:
+            with conn:
+                conn.execute("DELETE FROM blobs WHERE user_id = ?", (user_id,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO tenants (user_id, kind, path, version, nbytes)"
+                    " VALUES (?, ?, ?, 0, 0)",
+                    (user_id, DEDICATED, base),
+                )
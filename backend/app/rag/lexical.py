@@ -0,0 +1,327 @@
+# app/rag/lexical.py
+from __future__ import annotations
+
+import io
+import math
+import os
+import re
+import unicodedata
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.rag.docstore import _StrTable, _pad8
+
+# lexical.bin layout (little-endian, every section 8-byte aligned):
+#   magic        8 bytes   b"RAGLEX01"
+#   header       uint64[4] n, n_terms, n_postings, term_len
+#   doc_ids      int64[n]            sorted ascending, same ids as the docstore
+#   doc_len      int32[n]            tokens per chunk
+#   post_off     int64[n_terms+1]    term t owns postings post_off[t]:post_off[t+1]
+#   post_row     int32[n_postings]   row into doc_ids, ascending within a term
+#   post_tf      uint16[n_postings]  term frequency in that row (saturates)
+#   term_off     int64[n_terms+1]    + utf-8 term blob
+#
+# Postings are CSR arrays addressed by row, so scoring a query term is one slice
+# and one vectorized add; nothing is decoded per posting.
+_MAGIC = b"RAGLEX01"
+_HEADER = len(_MAGIC) + 8 * 4
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# words, plus dotted/dashed identifiers kept whole (e.g. "err-404", "v1.2.3")
+_TOKEN_RE = re.compile(r"\w+(?:[-.:/]\w+)*")
+_PART_RE = re.compile(r"\w+")
+
+
+class CorpusStats(NamedTuple):
+    """BM25 collection statistics shared by several indexes searched as one."""
+    n: int
+    avgdl: float
+    df: Dict[str, int]
+
+
+def corpus_stats(indexes: Sequence["LexicalIndex"], query: str) -> CorpusStats:
+    """Document count, mean length and per-token df summed over indexes."""
+    tokens = list(dict.fromkeys(tokenize(query)))
+    n = sum(len(ix) for ix in indexes)
+    total = sum(int(np.asarray(ix.doc_len, dtype="int64").sum()) for ix in indexes)
+    df = {tok: sum(ix.doc_freq(tok) for ix in indexes) for tok in tokens}
+    return CorpusStats(n, max(total / n, 1.0) if n else 1.0, df)
+
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    out: List[str] = []
+    for tok in _TOKEN_RE.findall(text):
+        out.append(tok)
+        if not _PART_RE.fullmatch(tok):
+            out.extend(_PART_RE.findall(tok))
+    return out
+
+
+class LexicalIndex:
+    """
+    Immutable BM25 inverted index over a user's chunks.
+
+    Kept beside the docstore and derived the same way: writers call
+    appended()/without_ids() and save() the result; readers memory-map it.
+    """
+
+    def __init__(
+        self,
+        doc_ids: np.ndarray,
+        doc_len: np.ndarray,
+        post_off: np.ndarray,
+        post_row: np.ndarray,
+        post_tf: np.ndarray,
+        terms: _StrTable,
+    ):
+        self.doc_ids = doc_ids
+        self.doc_len = doc_len
+        self.post_off = post_off
+        self.post_row = post_row
+        self.post_tf = post_tf
+        self.terms = terms
+        self._term_index: Optional[Dict[str, int]] = None
+        self._len_norm: Optional[Tuple[float, np.ndarray]] = None
+        self._avgdl: Optional[float] = None
+
+    def __len__(self) -> int:
+        return int(self.doc_ids.shape[0])
+
+    # -- construction / persistence --
+
+    @classmethod
+    def empty(cls) -> "LexicalIndex":
+        return cls.build([], [])
+
+    @classmethod
+    def build(cls, doc_ids: Sequence[int], texts: Sequence[str]) -> "LexicalIndex":
+        """Index texts under doc_ids (ascending, like the docstore's id column)."""
+        vocab: Dict[str, int] = {}
+        doc_len = np.zeros(len(texts), dtype="<i4")
+        term_col: List[int] = []
+        row_col: List[int] = []
+        tf_col: List[int] = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[row] = len(tokens)
+            counts: Dict[int, int] = {}
+            for tok in tokens:
+                t = vocab.setdefault(tok, len(vocab))
+                counts[t] = counts.get(t, 0) + 1
+            term_col.extend(counts)
+            row_col.extend([row] * len(counts))
+            tf_col.extend(counts.values())
+        term = np.asarray(term_col, dtype="int64")
+        row = np.asarray(row_col, dtype="<i4")
+        tf = np.minimum(np.asarray(tf_col, dtype="int64"), 0xFFFF).astype("<u2")
+        return cls._from_columns(
+            np.asarray(doc_ids, dtype="<i8"), doc_len, term, row, tf, _StrTable.build(list(vocab))
+        )
+
+    @classmethod
+    def _from_columns(
+        cls,
+        doc_ids: np.ndarray,
+        doc_len: np.ndarray,
+        term: np.ndarray,
+        row: np.ndarray,
+        tf: np.ndarray,
+        terms: _StrTable,
+    ) -> "LexicalIndex":
+        # rows arrive ascending, so a stable sort by term keeps them ascending per term
+        order = np.argsort(term, kind="stable")
+        post_off = np.zeros(len(terms) + 1, dtype="<i8")
+        np.cumsum(np.bincount(term, minlength=len(terms)), out=post_off[1:])
+        return cls(
+            doc_ids,
+            doc_len,
+            post_off,
+            np.ascontiguousarray(row[order], dtype="<i4"),
+            np.ascontiguousarray(tf[order], dtype="<u2"),
+            terms,
+        )
+
+    def _term_column(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.terms), dtype="int64"), np.diff(self.post_off))
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        return cls._parse(np.memmap(path, dtype=np.uint8, mode="r"), path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LexicalIndex":
+        return cls._parse(np.frombuffer(data, dtype=np.uint8), "<bytes>")
+
+    @classmethod
+    def _parse(cls, mm: np.ndarray, path: str) -> "LexicalIndex":
+        if bytes(mm[: len(_MAGIC)]) != _MAGIC:
+            raise ValueError(f"Not a lexical index file: {path}")
+        n, n_terms, n_post, term_len = [int(x) for x in mm[len(_MAGIC):_HEADER].view("<u8")]
+        pos = _HEADER
+
+        def take(nbytes: int, dtype: str | None = None):
+            nonlocal pos
+            chunk = mm[pos:pos + nbytes]
+            pos += _pad8(nbytes)
+            return chunk.view(dtype) if dtype else chunk
+
+        doc_ids = take(8 * n, "<i8")
+        doc_len = take(4 * n, "<i4")
+        post_off = take(8 * (n_terms + 1), "<i8")
+        post_row = take(4 * n_post, "<i4")
+        post_tf = take(2 * n_post, "<u2")
+        term_off = take(8 * (n_terms + 1), "<i8")
+        term_blob = take(term_len)
+        return cls(doc_ids, doc_len, post_off, post_row, post_tf, _StrTable(term_off, term_blob))
+
+    def save(self, path: str) -> None:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            self._write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        self._write(buf)
+        return buf.getvalue()
+
+    def _write(self, f) -> None:
+        sections = [
+            np.ascontiguousarray(self.doc_ids, dtype="<i8").tobytes(),
+            np.ascontiguousarray(self.doc_len, dtype="<i4").tobytes(),
+            np.ascontiguousarray(self.post_off, dtype="<i8").tobytes(),
+            np.ascontiguousarray(self.post_row, dtype="<i4").tobytes(),
+            np.ascontiguousarray(self.post_tf, dtype="<u2").tobytes(),
+            np.ascontiguousarray(self.terms.offsets, dtype="<i8").tobytes(),
+            bytes(self.terms.blob),
+        ]
+        header = np.array(
+            [len(self), len(self.terms), int(self.post_row.shape[0]), len(sections[6])],
+            dtype="<u8",
+        )
+        f.write(_MAGIC)
+        f.write(header.tobytes())
+        for sec in sections:
+            f.write(sec)
+            f.write(b"\0" * (_pad8(len(sec)) - len(sec)))
+
+    @property
+    def heap_nbytes(self) -> int:
+        # the term -> id dict built on first search; the arrays are memory-mapped
+        return int(self.terms.offsets[-1]) + 80 * len(self.terms)
+
+    # -- derived copies for writers --
+
+    def appended(self, doc_ids: Sequence[int], texts: Sequence[str]) -> "LexicalIndex":
+        """New index with chunks added; their ids must be above every existing id."""
+        if not len(doc_ids):
+            return self
+        new = LexicalIndex.build(doc_ids, texts)
+        values = self.terms.values()
+        index = {v: i for i, v in enumerate(values)}
+        remap = np.zeros(len(new.terms), dtype="int64")
+        for i, v in enumerate(new.terms.values()):
+            if v not in index:
+                index[v] = len(values)
+                values.append(v)
+            remap[i] = index[v]
+        return LexicalIndex._from_columns(
+            np.concatenate([self.doc_ids, new.doc_ids]).astype("<i8"),
+            np.concatenate([self.doc_len, new.doc_len]).astype("<i4"),
+            np.concatenate([self._term_column(), remap[new._term_column()]]),
+            np.concatenate([self.post_row, new.post_row + len(self)]).astype("<i4"),
+            np.concatenate([self.post_tf, new.post_tf]),
+            _StrTable.build(values),
+        )
+
+    def without_ids(self, doc_ids: np.ndarray) -> "LexicalIndex":
+        """Drop chunks by id: postings are masked and re-numbered, nothing re-tokenized."""
+        doc_ids = np.asarray(doc_ids, dtype="int64")
+        if len(self) == 0 or doc_ids.size == 0:
+            return self
+        keep = ~np.isin(self.doc_ids, doc_ids)
+        if keep.all():
+            return self
+        new_row = np.cumsum(keep, dtype="int64") - 1
+        live = keep[self.post_row]
+        term = self._term_column()[live]
+        counts = np.bincount(term, minlength=len(self.terms))
+        used = np.flatnonzero(counts)
+        term_remap = np.cumsum(counts > 0, dtype="int64") - 1
+        return LexicalIndex._from_columns(
+            np.ascontiguousarray(self.doc_ids[keep]),
+            np.ascontiguousarray(self.doc_len[keep]),
+            term_remap[term],
+            new_row[self.post_row[live]].astype("<i4"),
+            np.asarray(self.post_tf[live]),
+            self.terms.take(used),
+        )
+
+    # -- search --
+
+    def _term_id(self, token: str) -> int:
+        if self._term_index is None:
+            self._term_index = {v: i for i, v in enumerate(self.terms.values())}
+        return self._term_index.get(token, -1)
+
+    def doc_freq(self, token: str) -> int:
+        t = self._term_id(token) if len(self) else -1
+        return int(self.post_off[t + 1] - self.post_off[t]) if t >= 0 else 0
+
+    def _length_norm(self, avgdl: float) -> np.ndarray:
+        if self._len_norm is None or self._len_norm[0] != avgdl:
+            dl = np.asarray(self.doc_len, dtype="float32")
+            self._len_norm = (avgdl, BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl))
+        return self._len_norm[1]
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        allowed: Optional[np.ndarray] = None,
+        corpus: Optional[CorpusStats] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        BM25 top-k for query -> (scores, doc_ids), best first. allowed is an
+        optional bool array indexed by doc id; other docs never enter the top-k.
+        corpus (from corpus_stats) scores against statistics of several indexes,
+        so their results can be merged by score.
+        """
+        n = len(self)
+        tokens = list(dict.fromkeys(tokenize(query))) if n else []
+        terms = [(tok, t) for tok in tokens for t in [self._term_id(tok)] if t >= 0]
+        if not terms or k <= 0:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        if corpus is None:
+            if self._avgdl is None:
+                self._avgdl = max(float(np.asarray(self.doc_len, dtype="float32").mean()), 1.0)
+            corpus = CorpusStats(n, self._avgdl, {tok: self.doc_freq(tok) for tok, _ in terms})
+        len_norm = self._length_norm(corpus.avgdl)
+
+        acc = np.zeros(n, dtype="float32")
+        for tok, t in terms:
+            start, end = int(self.post_off[t]), int(self.post_off[t + 1])
+            rows = self.post_row[start:end]
+            tf = np.asarray(self.post_tf[start:end], dtype="float32")
+            df = corpus.df.get(tok, end - start)
+            idf = math.log(1.0 + (corpus.n - df + 0.5) / (df + 0.5))
+            # a row appears once per term, so fancy-index += is safe here
+            acc[rows] += idf * tf * (BM25_K1 + 1.0) / (tf + len_norm[rows])
+
+        if allowed is not None:
+            ids = np.asarray(self.doc_ids, dtype="int64")
+            ok = ids < allowed.shape[0]
+            ok[ok] = allowed[ids[ok]]
+            acc[~ok] = 0.0
+
+        hit = np.flatnonzero(acc)
+        if hit.size > k:
+            hit = hit[np.argpartition(-acc[hit], k - 1)[:k]]
+        hit = hit[np.argsort(-acc[hit], kind="stable")]
+        return acc[hit], np.asarray(self.doc_ids[hit], dtype="int64")
@@ -0,0 +1,319 @@
+# app/rag/pgvector.py
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from psycopg import sql
+
+from app.core.db import get_conn
+
+# Postgres + pgvector storage for RAG stores (RAG_BACKEND=pgvector). Every API
+# node reads and writes the same tables, so any node can serve any user.
+#
+#   <table>          one row per chunk: user_id, source, file_id, uploaded_at,
+#                    text, metadata (jsonb), embedding vector(dim) and a
+#                    generated tsvector for lexical search. HNSW over the
+#                    embeddings (inner product: vectors are normalized), GIN
+#                    over the tsvector, btree on (user_id, source).
+#   <table>_sources  the source manifest (chunks, bytes, content hash, upload
+#                    time, embedding model), written in the chunks' transaction.
+#
+# The tables come from backend/sql/014_rag_pgvector.sql; the app never runs DDL.
+# The vector column has a fixed dimension: a model with another dimension needs
+# its own tables, named by RAG_PG_TABLE.
+#
+# Every dense query filters (by user id at least), so the HNSW scan must keep
+# walking the graph until k rows pass the WHERE clause: hnsw.iterative_scan,
+# pgvector 0.8+. Without it only the ef_search nearest rows of the whole table
+# would be filtered, so older versions (or RAG_PG_ITERATIVE_SCAN set empty)
+# rank the matching rows exactly instead, found through the (user_id, source)
+# index: exact, at a cost that grows with the tenant's rows.
+RAG_PG_TABLE = os.getenv("RAG_PG_TABLE", "rag_chunks")
+RAG_PG_EF_SEARCH = int(os.getenv("RAG_PG_EF_SEARCH", "64"))
+RAG_PG_ITERATIVE_SCAN = os.getenv("RAG_PG_ITERATIVE_SCAN", "strict_order")
+ITERATIVE_SCAN_VERSION = (0, 8)
+
+# None until the first connection finds the tables
+_SCHEMA: Optional[Dict] = None
+_SCHEMA_LOCK = threading.Lock()
+
+_COLUMNS = ("user_id", "source", "file_id", "uploaded_at", "text", "metadata", "embedding")
+
+
+def _names() -> Dict[str, sql.Identifier]:
+    t = RAG_PG_TABLE
+    return {
+        "t": sql.Identifier(t),
+        "sources": sql.Identifier(f"{t}_sources"),
+        "source_idx": sql.Identifier(f"{t}_user_source_idx"),
+        "hnsw_idx": sql.Identifier(f"{t}_embedding_hnsw_idx"),
+        "tsv_idx": sql.Identifier(f"{t}_tsv_idx"),
+    }
+
+
+def _version(text: str) -> tuple:
+    return tuple(int(part) for part in text.split(".")[:2] if part.isdigit())
+
+
+def _schema(conn) -> Optional[Dict]:
+    """
+    {"exact": bool} once the tables exist, else None (nothing written yet, or the
+    migration not applied). The extension version is read on the first check.
+    """
+    global _SCHEMA
+    if _SCHEMA is not None:
+        return _SCHEMA
+    with _SCHEMA_LOCK, conn.cursor() as cur:
+        if _SCHEMA is not None:
+            return _SCHEMA
+        cur.execute("SELECT to_regclass(%s) AS t", (f"{RAG_PG_TABLE}_sources",))
+        if cur.fetchone()["t"] is None:
+            return None
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        version = cur.fetchone()["extversion"]
+        exact = not RAG_PG_ITERATIVE_SCAN or _version(version) < ITERATIVE_SCAN_VERSION
+        if exact and RAG_PG_ITERATIVE_SCAN:
+            print(
+                f"[rag] warning: pgvector {version} has no hnsw.iterative_scan (0.8+): "
+                "dense searches rank each tenant's rows exactly"
+            )
+        _SCHEMA = {"exact": exact}
+    return _SCHEMA
+
+
+def _require_schema(conn) -> None:
+    if _schema(conn) is None:
+        raise RuntimeError(
+            f"RAG table {RAG_PG_TABLE!r} not found: apply backend/sql/014_rag_pgvector.sql"
+        )
+
+
+def _vector_literal(vec: np.ndarray) -> str:
+    return "[" + ",".join(format(x, ".7g") for x in vec.tolist()) + "]"
+
+
+def _source_lock(cur, user_id: str, source: str) -> None:
+    # concurrent uploads of one source would otherwise both delete, then both insert
+    cur.execute(
+        "SELECT pg_advisory_xact_lock(hashtextextended(%s || chr(31) || %s, 0))", (user_id, source)
+    )
+
+
+# ---------------------------
+# Writes
+# ---------------------------
+
+def upsert_source(
+    user_id: str,
+    source: str,
+    file_id: str,
+    texts: Sequence[str],
+    metas: Sequence[Dict],
+    vecs: Optional[np.ndarray],
+    entry: Optional[Dict],
+) -> int:
+    """
+    Replace a source's chunks in one transaction: delete the old rows, COPY the
+    new ones in, and rewrite its manifest row (entry None drops it). Returns the
+    number of rows removed.
+    """
+    with get_conn() as conn:
+        if vecs is not None:
+            _require_schema(conn)
+        elif _schema(conn) is None:
+            return 0
+        n = _names()
+        with conn.cursor() as cur:
+            _source_lock(cur, user_id, source)
+            cur.execute(
+                sql.SQL("DELETE FROM {t} WHERE user_id = %s AND source = %s").format(**n),
+                (user_id, source),
+            )
+            removed = cur.rowcount
+            if texts:
+                copy = sql.SQL("COPY {t} ({cols}) FROM STDIN").format(
+                    cols=sql.SQL(", ").join(map(sql.Identifier, _COLUMNS)), **n
+                )
+                with cur.copy(copy) as cp:
+                    for text, md, vec in zip(texts, metas, vecs):
+                        cp.write_row(
+                            (
+                                user_id,
+                                source,
+                                file_id,
+                                md.get("uploaded_at"),
+                                text,
+                                json.dumps(md, ensure_ascii=False),
+                                _vector_literal(vec),
+                            )
+                        )
+            _write_entry(cur, user_id, source, entry)
+        conn.commit()
+    return removed
+
+
+def delete_source(user_id: str, source: str) -> int:
+    """Remove a source's chunks and manifest row; returns the number of chunks removed."""
+    with get_conn() as conn:
+        if _schema(conn) is None:
+            return 0
+        with conn.cursor() as cur:
+            _source_lock(cur, user_id, source)
+            cur.execute(
+                sql.SQL("DELETE FROM {t} WHERE user_id = %s AND source = %s").format(**_names()),
+                (user_id, source),
+            )
+            removed = cur.rowcount
+            _write_entry(cur, user_id, source, None)
+        conn.commit()
+    return removed
+
+
+def _write_entry(cur, user_id: str, source: str, entry: Optional[Dict]) -> None:
+    n = _names()
+    if entry is None:
+        cur.execute(
+            sql.SQL("DELETE FROM {sources} WHERE user_id = %s AND source = %s").format(**n),
+            (user_id, source),
+        )
+        return
+    cur.execute(
+        sql.SQL(
+            "INSERT INTO {sources} (user_id, source, chunks, bytes, content_hash, uploaded_at, embedding_model)"
+            " VALUES (%s, %s, %s, %s, %s, %s, %s)"
+            " ON CONFLICT (user_id, source) DO UPDATE SET"
+            " chunks = EXCLUDED.chunks, bytes = EXCLUDED.bytes, content_hash = EXCLUDED.content_hash,"
+            " uploaded_at = EXCLUDED.uploaded_at, embedding_model = EXCLUDED.embedding_model"
+        ).format(**n),
+        (
+            user_id,
+            source,
+            entry["chunks"],
+            entry["bytes"],
+            entry["content_hash"],
+            entry["uploaded_at"],
+            entry["embedding_model"],
+        ),
+    )
+
+
+# ---------------------------
+# Reads
+# ---------------------------
+
+def read_sources(user_id: str) -> Dict[str, Dict]:
+    """The user's source manifest, {source: {chunks, bytes, ...}}, from one indexed read."""
+    with get_conn() as conn:
+        if _schema(conn) is None:
+            return {}
+        with conn.cursor() as cur:
+            cur.execute(
+                sql.SQL(
+                    "SELECT source, chunks, bytes, content_hash, uploaded_at, embedding_model"
+                    " FROM {sources} WHERE user_id = %s"
+                ).format(**_names()),
+                (user_id,),
+            )
+            rows = cur.fetchall()
+    return {row.pop("source"): row for row in rows}
+
+
+def _values(value) -> List[str]:
+    return [str(v) for v in value] if isinstance(value, (list, tuple, set)) else [str(value)]
+
+
+def _where(user_ids: Sequence[str], filters: Dict) -> tuple:
+    """WHERE clause and parameters for the user ids and search filters (see index.FILTER_KEYS)."""
+    clauses = [sql.SQL("user_id = ANY(%s)")]
+    params: List = [list(user_ids)]
+    if "source" in filters:
+        clauses.append(sql.SQL("source = ANY(%s)"))
+        params.append(_values(filters["source"]))
+    if filters.get("source_contains"):
+        clauses.append(sql.SQL("strpos(lower(source), %s) > 0"))
+        params.append(str(filters["source_contains"]).lower())
+    if "mime" in filters:
+        clauses.append(sql.SQL("coalesce(metadata->>'mime', '') = ANY(%s)"))
+        params.append(_values(filters["mime"]))
+    if "file_id" in filters:
+        clauses.append(sql.SQL("file_id = ANY(%s)"))
+        params.append(_values(filters["file_id"]))
+    if filters.get("uploaded_after") is not None:
+        clauses.append(sql.SQL("uploaded_at >= %s"))
+        params.append(float(filters["uploaded_after"]))
+    if filters.get("uploaded_before") is not None:
+        clauses.append(sql.SQL("uploaded_at <= %s"))
+        params.append(float(filters["uploaded_before"]))
+    return sql.SQL(" AND ").join(clauses), params
+
+
+def search(
+    user_ids: Sequence[str],
+    queries: Sequence[str],
+    qv: Optional[np.ndarray],
+    k: int,
+    filters: Dict,
+    min_score: Optional[float],
+    lexical: bool,
+) -> List[List[Dict]]:
+    """
+    Top-k rows per query across user_ids, best first, as {"id", "user_id",
+    "text", "metadata", "score"}. Dense search (qv given) orders by inner
+    product, through the HNSW index or exactly (see above), with the filters
+    and min_score applied in the same query; lexical=True ranks full-text
+    matches of any query term by ts_rank_cd instead.
+    """
+    out: List[List[Dict]] = [[] for _ in queries]
+    with get_conn() as conn:
+        schema = _schema(conn)
+        if schema is None:
+            return out
+        where, params = _where(user_ids, filters)
+        n = _names()
+        with conn.cursor() as cur:
+            if not lexical and not schema["exact"]:
+                cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(max(RAG_PG_EF_SEARCH, k)),))
+                cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (RAG_PG_ITERATIVE_SCAN,))
+            for i, query in enumerate(queries):
+                if lexical:
+                    stmt = sql.SQL(
+                        "SELECT id, user_id, text, metadata, ts_rank_cd(tsv, q) AS score"
+                        " FROM {t}, to_tsquery('simple', array_to_string(ARRAY("
+                        "   SELECT quote_literal(l) FROM unnest(tsvector_to_array(to_tsvector('simple', %s))) l"
+                        " ), ' | ')) q"
+                        " WHERE tsv @@ q AND {where} ORDER BY score DESC, id LIMIT %s"
+                    ).format(where=where, **n)
+                    cur.execute(stmt, [query] + params + [k])
+                else:
+                    vec = _vector_literal(qv[i])
+                    cutoff = sql.SQL("")
+                    extra: List = []
+                    if min_score is not None:
+                        # <#> is the negated inner product
+                        cutoff = sql.SQL(" AND embedding <#> %s::vector <= %s")
+                        extra = [vec, -float(min_score)]
+                    if schema["exact"]:
+                        # MATERIALIZED keeps the planner from serving the ORDER BY from the HNSW index
+                        stmt = sql.SQL(
+                            "WITH c AS MATERIALIZED ("
+                            "   SELECT id, user_id, text, metadata, embedding FROM {t} WHERE {where}"
+                            " )"
+                            " SELECT id, user_id, text, metadata, -(embedding <#> %s::vector) AS score"
+                            " FROM c WHERE true{cutoff} ORDER BY embedding <#> %s::vector LIMIT %s"
+                        )
+                        args = params + [vec] + extra + [vec, k]
+                    else:
+                        stmt = sql.SQL(
+                            "SELECT id, user_id, text, metadata, -(embedding <#> %s::vector) AS score"
+                            " FROM {t} WHERE {where}{cutoff}"
+                            " ORDER BY embedding <#> %s::vector LIMIT %s"
+                        )
+                        args = [vec] + params + extra + [vec, k]
+                    cur.execute(stmt.format(where=where, cutoff=cutoff, **n), args)
+                out[i] = cur.fetchall()
+        conn.commit()
+    return out
@@ -0,0 +1,174 @@
+# app/rag/segments.py
+from __future__ import annotations
+
+import io
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.rag.docstore import Docstore, _pad8
+from app.rag.lexical import LexicalIndex
+
+# delta segment layout (little-endian):
+#   magic     8 bytes   b"RAGSEG01"
+#   header    uint64[4] first, seq, docstore_len, lexical_len
+#   docstore  docstore.bin bytes (ids, text, metadata, float16 vectors), 8-byte padded
+#   lexical   lexical.bin bytes over the same rows
+#
+# A delta holds the rows of one write (seq) or, after a minor compaction, of
+# the writes first..seq. It is immutable once written: deletes are tombstones
+# in the store manifest and only disappear when a compaction rewrites the rows.
+_MAGIC = b"RAGSEG01"
+_HEADER = len(_MAGIC) + 8 * 4
+
+
+class Delta:
+    """Small immutable segment searched by brute force over its float16 vectors."""
+
+    def __init__(self, seq: int, docstore: Docstore, lexical: LexicalIndex, first: Optional[int] = None):
+        self.seq = int(seq)
+        self.first = int(seq if first is None else first)
+        self.docstore = docstore
+        self.lexical = lexical
+        self._f32: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+    @property
+    def span(self) -> List[int]:
+        return [self.first, self.seq]
+
+    @property
+    def name(self) -> str:
+        return self.file_name(self.span)
+
+    @staticmethod
+    def file_name(span: Sequence[int]) -> str:
+        """File (dedicated store) or blob (packed store) name of the delta covering span."""
+        first, seq = span
+        return f"delta-{int(first):010d}-{int(seq):010d}.seg"
+
+    @classmethod
+    def build(
+        cls,
+        seq: int,
+        ids: Sequence[int],
+        texts: Sequence[str],
+        metas: Sequence[Dict],
+        vectors: np.ndarray,
+    ) -> "Delta":
+        docstore = Docstore.build(list(zip(ids, texts, metas)), vectors)
+        return cls(seq, docstore, LexicalIndex.build(ids, texts))
+
+    @classmethod
+    def merged(cls, deltas: Sequence["Delta"], tombstones: np.ndarray) -> "Delta":
+        """One delta with the rows of `deltas` (oldest first) minus tombstoned ids."""
+        docstore, lexical = deltas[0].docstore, deltas[0].lexical
+        for d in deltas[1:]:
+            docstore = docstore.appended(
+                [
+                    (int(d.docstore.ids[i]), d.docstore.text_at(i), d.docstore.metadata_at(i))
+                    for i in range(len(d))
+                ],
+                d.docstore.vectors_at(np.arange(len(d))),
+            )
+            lexical = lexical.appended(
+                np.asarray(d.docstore.ids, dtype="int64"), [d.docstore.text_at(i) for i in range(len(d))]
+            )
+        return cls(
+            deltas[-1].seq,
+            docstore.without_ids(tombstones),
+            lexical.without_ids(tombstones),
+            first=deltas[0].first,
+        )
+
+    # -- persistence --
+
+    def to_bytes(self) -> bytes:
+        ds, lex = self.docstore.to_bytes(), self.lexical.to_bytes()
+        buf = io.BytesIO()
+        buf.write(_MAGIC)
+        buf.write(np.array([self.first, self.seq, len(ds), len(lex)], dtype="<u8").tobytes())
+        buf.write(ds)
+        buf.write(b"\0" * (_pad8(len(ds)) - len(ds)))
+        buf.write(lex)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Delta":
+        if data[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("Not a delta segment")
+        header = np.frombuffer(data, dtype="<u8", count=4, offset=len(_MAGIC))
+        first, seq, ds_len, lex_len = [int(x) for x in header]
+        lex_at = _HEADER + _pad8(ds_len)
+        return cls(
+            seq,
+            Docstore.from_bytes(data[_HEADER:_HEADER + ds_len]),
+            LexicalIndex.from_bytes(data[lex_at:lex_at + lex_len]),
+            first=first,
+        )
+
+    def save(self, path: str) -> None:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Delta":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @property
+    def nbytes(self) -> int:
+        vec_bytes = self.docstore.vectors.nbytes if self.docstore.dim else 0
+        # float16 column plus the float32 copy made for the first search
+        return self.docstore.text_nbytes + 3 * vec_bytes + self.lexical.heap_nbytes
+
+    # -- search --
+
+    def search(
+        self,
+        qv: np.ndarray,
+        k: int,
+        allowed: Optional[np.ndarray] = None,
+        min_score: Optional[float] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Exact inner-product top-k for each row of qv -> [(scores, doc_ids)], best first."""
+        n = len(self)
+        empty = (np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64"))
+        if n == 0 or k <= 0:
+            return [empty for _ in range(qv.shape[0])]
+        if self._f32 is None:
+            self._f32 = np.asarray(self.docstore.vectors, dtype="float32")
+        ids = np.asarray(self.docstore.ids, dtype="int64")
+        sims = qv @ self._f32.T
+        if allowed is not None:
+            ok = ids < allowed.shape[0]
+            ok[ok] = allowed[ids[ok]]
+            sims[:, ~ok] = -np.inf
+        out = []
+        for row in sims:
+            top = np.flatnonzero(np.isfinite(row))
+            if top.size > k:
+                top = top[np.argpartition(-row[top], k - 1)[:k]]
+            top = top[np.argsort(-row[top], kind="stable")]
+            if min_score is not None:
+                top = top[row[top] >= min_score]
+            out.append((row[top].astype("float32"), ids[top]))
+        return out
+
+
+def merge_topk(parts: Sequence[Tuple[np.ndarray, np.ndarray]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge best-first (scores, doc_ids) lists from several segments into one top-k."""
+    scores = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype="float32")
+    ids = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype="int64")
+    order = np.argsort(-scores, kind="stable")
+    # an id can surface twice only while a crashed compaction is being healed
+    _, first = np.unique(ids[order], return_index=True)
+    order = order[np.sort(first)][:k]
+    return scores[order], ids[order]
@@ -0,0 +1,121 @@
+# app/rag/wal.py
+from __future__ import annotations
+
+import json
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:  # POSIX only; elsewhere the lock is per-process
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# Write-ahead log record framing (little-endian):
+#   uint32 payload_len, uint32 crc32(payload), payload
+#   payload = uint32 header_len, utf-8 JSON header, float32 vectors (n x dim)
+#
+# A crash mid-append leaves a short or corrupt last frame; readers stop at the
+# first frame that does not check out, and the next append cuts it off.
+_FRAME = struct.Struct("<II")
+_LEN = struct.Struct("<I")
+
+
+class WriteAheadLog:
+    """Append-only log of store mutations, replayed over the last checkpoint."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def append(self, header: Dict, vectors: Optional[np.ndarray] = None) -> None:
+        """Durably append one record (fsync'd before returning)."""
+        head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        vecs = b"" if vectors is None else np.ascontiguousarray(vectors, dtype="<f4").tobytes()
+        payload = _LEN.pack(len(head)) + head + vecs
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        valid = self._scan()[1]
+        with open(self.path, "ab") as f:
+            if f.tell() != valid:
+                f.truncate(valid)  # drop a torn tail left by a crash
+            f.write(_FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def records(self) -> Iterator[Tuple[Dict, Optional[np.ndarray]]]:
+        """(header, vectors) for every intact record, oldest first."""
+        yield from self._scan()[0]
+
+    def _scan(self) -> Tuple[List[Tuple[Dict, Optional[np.ndarray]]], int]:
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0
+        out: List[Tuple[Dict, Optional[np.ndarray]]] = []
+        pos = 0
+        while pos + _FRAME.size <= len(data):
+            length, crc = _FRAME.unpack_from(data, pos)
+            payload = data[pos + _FRAME.size:pos + _FRAME.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            (head_len,) = _LEN.unpack_from(payload, 0)
+            header = json.loads(payload[_LEN.size:_LEN.size + head_len])
+            raw = payload[_LEN.size + head_len:]
+            vectors = None
+            if raw:
+                vectors = np.frombuffer(raw, dtype="<f4").reshape(-1, int(header["dim"]))
+            out.append((header, vectors))
+            pos += _FRAME.size + length
+        return out, pos
+
+    def reset(self) -> None:
+        """Forget every record; call once they are all in a checkpoint."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+_THREAD_LOCKS: Dict[Tuple[str, int], threading.Lock] = {}
+# lock file -> descriptor held for the life of the process: closing any
+# descriptor of a file drops every record lock the process holds on it
+_LOCK_FDS: Dict[str, int] = {}
+_GUARD = threading.Lock()
+
+
+def _lock_fd(path: str) -> int:
+    with _GUARD:
+        fd = _LOCK_FDS.get(path)
+        if fd is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = _LOCK_FDS[path] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        return fd
+
+
+@contextmanager
+def exclusive(path: str, slot: int = 0):
+    """
+    Hold an exclusive lock on byte `slot` of the file at path, across threads
+    (a mutex per path and slot) and across processes (an fcntl record lock), so
+    many keys can share one lock file. Not re-entrant.
+    """
+    with _GUARD:
+        tlock = _THREAD_LOCKS.setdefault((path, slot), threading.Lock())
+    with tlock:
+        if fcntl is None:
+            yield
+            return
+        fd = _lock_fd(path)
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, slot, os.SEEK_SET)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, slot, os.SEEK_SET)
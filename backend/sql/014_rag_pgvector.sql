@@ -0,0 +1,41 @@
+-- 014_rag_pgvector.sql  (schema only)
+-- RAG storage for RAG_BACKEND=pgvector (app/rag/pgvector.py). Needs the pgvector
+-- extension (image pgvector/pgvector:pg16); 0.8+ for filtered HNSW scans, older
+-- versions fall back to exact per-tenant scans.
+--
+-- embedding is vector(384) for the default EMBEDDINGS_MODEL (all-MiniLM-L6-v2).
+-- A model with another dimension needs its own tables: copy this file with the
+-- dimension and the rag_chunks prefix changed, and set RAG_PG_TABLE to match.
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+-- One row per chunk
+CREATE TABLE IF NOT EXISTS rag_chunks (
+  id          BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  user_id     TEXT NOT NULL,            -- tenant, or _corpus.<name> for a shared corpus
+  source      TEXT NOT NULL,
+  file_id     TEXT NOT NULL,
+  uploaded_at DOUBLE PRECISION,
+  text        TEXT NOT NULL,
+  metadata    JSONB NOT NULL DEFAULT '{}',
+  embedding   vector(384) NOT NULL,
+  tsv         tsvector GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED
+);
+
+CREATE INDEX IF NOT EXISTS rag_chunks_user_source_idx ON rag_chunks (user_id, source);
+-- inner product: the embeddings are normalized
+CREATE INDEX IF NOT EXISTS rag_chunks_embedding_hnsw_idx ON rag_chunks
+  USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS rag_chunks_tsv_idx ON rag_chunks USING gin (tsv);
+
+-- Source manifest, written in the same transaction as the source's chunks
+CREATE TABLE IF NOT EXISTS rag_chunks_sources (
+  user_id         TEXT NOT NULL,
+  source          TEXT NOT NULL,
+  chunks          INTEGER NOT NULL,
+  bytes           BIGINT NOT NULL,
+  content_hash    TEXT NOT NULL,
+  uploaded_at     DOUBLE PRECISION,
+  embedding_model TEXT NOT NULL,
+  PRIMARY KEY (user_id, source)
+);
@@ -0,0 +1,39 @@
+# backend/tests/conftest.py
+import os
+import sys
+import tempfile
+import uuid
+import zlib
+
+import numpy as np
+import pytest
+
+# the store root is read at import time: point it somewhere disposable first
+os.environ.setdefault("RAG_STORE_DIR", tempfile.mkdtemp(prefix="rag-test-"))
+os.environ.setdefault("RAG_EMBED_BATCHING", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DIM = 32
+
+
+def hash_embed(texts):
+    """Deterministic bag-of-words vectors: texts sharing words are close."""
+    out = np.zeros((len(texts), DIM), dtype="float32")
+    for i, text in enumerate(texts):
+        for word in text.lower().split():
+            out[i, zlib.crc32(word.encode("utf-8")) % DIM] += 1.0
+        out[i, DIM - 1] += 0.01  # no all-zero rows
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def rag(monkeypatch):
+    from app.rag import index
+
+    monkeypatch.setattr(index, "_embed_texts", hash_embed)
+    return index
+
+
+@pytest.fixture
+def user_id():
+    return f"test-{uuid.uuid4().hex[:12]}"
@@ -0,0 +1,20 @@
+# backend/tests/test_agent_tools.py
+import pytest
+
+
+@pytest.fixture
+def tool_runtime(rag):
+    return pytest.importorskip("app.agents.tool_runtime")
+
+
+def test_rag_tool_returns_hits(rag, user_id, tool_runtime):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "apple orchard"}])
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "apple pie"}])
+    out = tool_runtime.RagSearchTool(user_id).run(query="apple", source="b.txt")
+    assert set(out) == {"hits"}
+    assert [h["text"] for h in out["hits"]] == ["apple pie"]
+
+
+def test_rag_tool_failure_keeps_the_shape(rag, user_id, tool_runtime):
+    out = tool_runtime.RagSearchTool(user_id, corpora=["not-shared"]).run(query="apple")
+    assert out["hits"] == [] and "not shared" in out["error"]
@@ -0,0 +1,140 @@
+# backend/tests/test_ann.py
+import faiss
+import numpy as np
+import pytest
+
+from app.rag import ann
+
+
+def _data(n=4000, d=32, q=50, seed=0):
+    # clustered, like real embeddings: uniform random vectors have no structure to index
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((40, d))
+    vecs = (centers[rng.integers(0, 40, n)] + 0.3 * rng.standard_normal((n, d))).astype("float32")
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    queries = vecs[rng.choice(n, q, replace=False)] + 0.1 * rng.standard_normal((q, d)).astype("float32")
+    return vecs, np.arange(n, dtype="int64") * 3 + 1, queries.astype("float32")
+
+
+def _recall(index, vecs, ids, queries, k=10):
+    exact = faiss.IndexFlatIP(vecs.shape[1])
+    exact.add(vecs)
+    _, truth = exact.search(queries, k)
+    _, got = ann.search(index, queries, k, ann.search_params(index, {}))
+    return np.mean([len(set(ids[t]) & set(g)) / k for t, g in zip(truth, got)])
+
+
+@pytest.mark.parametrize("kind", [ann.HNSW, ann.IVF_FLAT])
+def test_trained_index_recall_against_exact(kind):
+    vecs, ids, queries = _data()
+    index = ann.build_trained(kind, vecs, ids)
+    assert ann.index_kind(index) == kind and index.ntotal == len(ids)
+    assert _recall(index, vecs, ids, queries) >= 0.9
+
+
+def test_promotion_threshold(monkeypatch):
+    monkeypatch.setattr(ann, "RAG_ANN_THRESHOLD", 100)
+    flat = ann.build_flat(8)
+    ann.add(flat, np.eye(8, dtype="float32").repeat(12, axis=0), np.arange(96, dtype="int64"))
+    assert not ann.should_promote(flat)
+    ann.add(flat, np.eye(8, dtype="float32")[:4], np.arange(96, 100, dtype="int64"))
+    assert ann.should_promote(flat)
+    monkeypatch.setattr(ann, "RAG_ANN_THRESHOLD", 0)
+    assert not ann.should_promote(flat)
+
+
+def test_store_promotes_and_keeps_serving(rag, user_id, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: None)
+    monkeypatch.setattr(rag, "_maybe_promote", lambda uid, store: None)
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"w{i} x{i}"} for i in range(400)])
+    rag._compact(user_id, rag.MAJOR)
+    before = rag.rag_search(user_id, "w7 x7", k=1)
+
+    rag._promote(user_id, rag._load_or_build(user_id))
+    store = rag._load_or_build(user_id)
+    assert ann.index_kind(store.index) == ann.promotion_kind() and store.index.ntotal == 400
+    after = rag.rag_search(user_id, "w7 x7", k=1)
+    assert after[0]["score"] == pytest.approx(before[0]["score"], abs=1e-3)
+    # writes land on the promoted index
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "zebra crossing"}])
+    rag._compact(user_id, rag.MAJOR)
+    assert rag.rag_search(user_id, "zebra crossing", k=1)[0]["text"] == "zebra crossing"
+    assert ann.index_kind(rag._load_or_build(user_id).index) == ann.promotion_kind()
+
+
+def _reranked_recall(index, vecs, ids, queries, k=10):
+    from app.rag.docstore import Docstore
+    from app.rag.index import _rerank_exact
+
+    ds = Docstore.build([(int(i), "", {"source": "s"}) for i in ids], vecs)
+    exact = faiss.IndexFlatIP(vecs.shape[1])
+    exact.add(vecs)
+    _, truth = exact.search(queries, k)
+    _, cand = ann.search(index, queries, ann.candidates(index, k), ann.search_params(index, {}))
+    recalls = []
+    for q, t, c in zip(queries, truth, cand):
+        scores, got = _rerank_exact(ds, q, c, k)
+        # re-ranked scores are the exact ones, up to the float16 copy
+        assert np.allclose(scores, vecs[np.searchsorted(ids, got)] @ q, atol=2e-3)
+        recalls.append(len(set(ids[t]) & set(got)) / k)
+    return np.mean(recalls)
+
+
+def test_sq8_flat_recall_after_rerank(monkeypatch):
+    monkeypatch.setattr(ann, "RAG_QUANTIZATION", ann.SQ8)
+    vecs, ids, queries = _data()
+    index = ann.build_flat(vecs.shape[1])
+    ann.add(index, vecs, ids)
+    assert ann.storage_kind(index) == ann.SQ8
+    assert _reranked_recall(index, vecs, ids, queries) >= 0.95
+
+
+def test_pq_promoted_recall_after_rerank(monkeypatch):
+    monkeypatch.setattr(ann, "RAG_QUANTIZATION", ann.PQ)
+    vecs, ids, queries = _data()
+    index = ann.build_trained(ann.promotion_kind(), vecs, ids)
+    assert (ann.index_kind(index), ann.storage_kind(index)) == (ann.IVF_PQ, ann.PQ)
+    assert _reranked_recall(index, vecs, ids, queries) >= 0.8
+
+
+def test_quantized_store_returns_exact_scores(rag, user_id, monkeypatch):
+    from conftest import hash_embed
+
+    monkeypatch.setattr(ann, "RAG_QUANTIZATION", ann.SQ8)
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: None)
+    texts = [f"q{i} r{i % 7} s{i % 11}" for i in range(200)]
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": t} for t in texts])
+    rag._compact(user_id, rag.MAJOR)
+    assert ann.storage_kind(rag._load_or_build(user_id).index) == ann.SQ8
+
+    hits = rag.rag_search(user_id, "r3 s5", k=5)
+    qv = hash_embed(["r3 s5"])[0]
+    # re-ranked against the float16 vectors: each hit carries its exact score
+    assert [h["score"] for h in hits] == pytest.approx(
+        [float(hash_embed([h["text"]])[0] @ qv) for h in hits], abs=2e-3
+    )
+    assert hits[0]["score"] == pytest.approx(max(float(hash_embed([t])[0] @ qv) for t in texts), abs=2e-3)
+
+
+def test_binary_recall_after_rerank(monkeypatch):
+    monkeypatch.setattr(ann, "RAG_QUANTIZATION", ann.BINARY)
+    vecs, ids, queries = _data(d=64)
+    index = ann.build_flat(vecs.shape[1])
+    ann.add(index, vecs, ids)
+    assert ann.storage_kind(index) == ann.BINARY and not ann.should_promote(index)
+    assert ann.candidates(index, 10) == ann.RAG_BINARY_CANDIDATES
+    assert _reranked_recall(index, vecs, ids, queries) >= 0.9
+
+
+def test_binary_store_survives_reload(rag, user_id, monkeypatch):
+    monkeypatch.setattr(ann, "RAG_QUANTIZATION", ann.BINARY)
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: None)
+    texts = [f"q{i} r{i % 7} s{i % 11}" for i in range(200)]
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": t} for t in texts])
+    rag._compact(user_id, rag.MAJOR)
+    rag._INDEX_CACHE.invalidate(user_id)
+    assert ann.storage_kind(rag._load_or_build(user_id).index) == ann.BINARY
+
+    hits = rag.rag_search(user_id, "q17 r3 s6", k=3)
+    assert hits[0]["text"] == "q17 r3 s6"
+    assert hits[0]["score"] == pytest.approx(1.0, abs=2e-3)
@@ -0,0 +1,43 @@
+# backend/tests/test_batcher.py
+import threading
+import time
+
+import numpy as np
+
+from app.rag.batcher import EmbeddingBatcher
+
+PER_TEXT = 0.0005  # seconds of fake model time per text
+
+
+def slow_encode(texts):
+    time.sleep(PER_TEXT * len(texts))
+    return np.ones((len(texts), 4), dtype="float32")
+
+
+def test_search_is_not_queued_behind_a_bulk_encode():
+    batcher = EmbeddingBatcher(slow_encode, max_batch=64, max_wait_ms=1)
+    done = {}
+
+    def upload():
+        batcher.encode([f"chunk {i}" for i in range(640)])  # 10 batches, ~0.32 s
+        done["upload"] = time.perf_counter()
+
+    t = threading.Thread(target=upload)
+    t.start()
+    time.sleep(0.05)  # the upload is mid-way through its batches
+    start = time.perf_counter()
+    vec = batcher.encode(["a search query"])
+    latency = time.perf_counter() - start
+    done["search"] = time.perf_counter()
+    t.join()
+
+    assert vec.shape == (1, 4)
+    # waits for at most the batch in flight (64 texts ~ 32 ms), not the upload
+    assert latency < 0.15
+    assert done["search"] < done["upload"]
+
+
+def test_split_encode_keeps_row_order():
+    batcher = EmbeddingBatcher(lambda texts: np.array([[len(t)] for t in texts], dtype="float32"), max_batch=8)
+    texts = ["x" * n for n in range(1, 30)]
+    assert batcher.encode(texts)[:, 0].tolist() == list(range(1, 30))
@@ -0,0 +1,89 @@
+# backend/tests/test_cache.py
+import sqlite3
+import time
+import uuid
+
+import numpy as np
+
+from app.rag.cache import ByteBudgetCache, ChunkVectorCache
+from conftest import hash_embed
+
+
+def test_budget_evicts_big_cold_entries_first():
+    cache = ByteBudgetCache(100)
+    cache.put("big", "B", 60)
+    time.sleep(0.01)
+    cache.put("small", "s", 10)
+    cache.get("small")
+    cache.put("new", "n", 40)  # 110 bytes: one entry has to go
+
+    assert cache.peek("big") is None
+    assert cache.get("small") == "s" and cache.get("new") == "n"
+    assert cache.stats()["bytes"] == 50 and cache.stats()["evictions"] == 1
+
+
+def test_entry_over_budget_is_not_cached():
+    cache = ByteBudgetCache(10)
+    cache.put("k", "v", 11)
+    assert cache.get("k") is None and cache.stats()["bytes"] == 0
+
+
+def test_stamp_mismatch_is_a_miss():
+    cache = ByteBudgetCache(100)
+    cache.put("k", "v1", 1, stamp=1)
+    assert cache.get("k", stamp=1) == "v1"
+    assert cache.get("k", stamp=2, keep_stale=True) is None
+    assert cache.peek("k") == "v1"  # kept for readers until replaced
+    assert cache.get("k", stamp=2) is None
+    assert cache.peek("k") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_index_cache_serves_the_loaded_store(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id}"}])
+    first = rag._load_or_build(user_id)
+    assert rag._load_or_build(user_id) is first
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"beta {user_id}"}])
+    assert rag._load_or_build(user_id) is not first
+
+
+def test_chunk_cache_evicts_least_recently_used(tmp_path):
+    cache = ChunkVectorCache(str(tmp_path / "vectors.sqlite"), max_entries=10)
+    vec = np.ones(4, dtype="float32")
+    cache.put_many({f"old{i}": vec for i in range(5)})
+    time.sleep(0.01)
+    cache.put_many({f"new{i}": vec for i in range(5)})
+    cache.get_many(["old0"])  # touched: now more recent than the other old keys
+    cache.put_many({"extra": vec})  # 11 rows: down to 9
+
+    left = set(cache.get_many([f"old{i}" for i in range(5)] + [f"new{i}" for i in range(5)]))
+    assert "old0" in left and {f"new{i}" for i in range(5)} <= left
+    assert len(left) == 8 and cache.stats()["evictions"] == 2
+    (rows,) = sqlite3.connect(cache.path).execute("SELECT COUNT(*) FROM vectors").fetchone()
+    assert rows == 9
+
+
+def test_chunk_cache_recounts_replaced_keys_before_evicting(tmp_path):
+    cache = ChunkVectorCache(str(tmp_path / "vectors.sqlite"), max_entries=4)
+    vec = np.ones(4, dtype="float32")
+    for _ in range(3):
+        cache.put_many({"a": vec, "b": vec})  # same keys: the file keeps 2 rows
+    assert cache.stats()["evictions"] == 0
+    assert set(cache.get_many(["a", "b"])) == {"a", "b"}
+
+
+def test_shared_chunks_are_embedded_once(rag, monkeypatch):
+    seen = []
+
+    def embed(texts):
+        seen.extend(texts)
+        return hash_embed(texts)
+
+    monkeypatch.setattr(rag, "_embed_texts", embed)
+    text = f"shared boilerplate {uuid.uuid4().hex}"
+    users = [f"test-{uuid.uuid4().hex[:12]}" for _ in range(2)]
+    for user in users:
+        assert rag.upsert_chunks_for_source(user, "policy.txt", [{"text": text}]) == 1
+    assert seen == [text]
+    for user in users:
+        assert rag.rag_search(user, text, k=1)[0]["text"] == text
@@ -0,0 +1,80 @@
+# backend/tests/test_docstore.py
+import numpy as np
+
+from app.rag.docstore import Docstore
+
+
+def _rows(ids, source="a.txt"):
+    return [(i, f"text {i}", {"source": source, "n": i}) for i in ids]
+
+
+def test_positions_resolve_sparse_ids():
+    ds = Docstore.build(_rows([40, 3, 17]))
+    assert ds.ids.tolist() == [3, 17, 40]
+    assert ds.positions(np.array([17, 40, 3, 5, 99, -1])).tolist() == [1, 2, 0, -1, -1, -1]
+    assert Docstore.empty().positions(np.array([1])).tolist() == [-1]
+
+
+def test_rows_follow_their_ids_through_deletes_and_appends():
+    ds = Docstore.build(_rows([1, 2, 3]), np.eye(3, dtype="float32"))
+    ds = ds.without_ids(np.array([2])).appended(_rows([7], source="b.txt"), np.ones((1, 3), "float32"))
+
+    for doc_id in (1, 3, 7):
+        pos = int(ds.positions(np.array([doc_id]))[0])
+        assert ds.text_at(pos) == f"text {doc_id}"
+        assert ds.metadata_at(pos)["n"] == doc_id
+    assert ds.positions(np.array([2])).tolist() == [-1]
+    assert ds.vectors_at(ds.positions(np.array([3]))).tolist() == [[0.0, 0.0, 1.0]]
+    assert ds.ids_for_source("b.txt").tolist() == [7]
+
+
+def test_save_load_round_trip(tmp_path):
+    ds = Docstore.build(_rows([5, 9]), np.arange(6, dtype="float32").reshape(2, 3))
+    path = str(tmp_path / "docstore.bin")
+    ds.save(path)
+    ds.save(path)  # rewrites go through a fresh temp file each time
+
+    for loaded in (Docstore.load(path), Docstore.from_bytes(ds.to_bytes())):
+        assert loaded.ids.tolist() == [5, 9]
+        assert [loaded.text_at(i) for i in range(2)] == ["text 5", "text 9"]
+        assert loaded.metadata_at(1) == {"source": "a.txt", "n": 9}
+        assert loaded.vectors_at(np.arange(2)).tolist() == [[0, 1, 2], [3, 4, 5]]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["docstore.bin"]
+
+
+def test_concurrent_loads_migrate_a_legacy_store_once(rag, user_id):
+    import json
+    import os
+    import threading
+
+    import faiss
+
+    from conftest import hash_embed
+
+    base = rag._LAYOUT.legacy_dir(user_id)
+    os.makedirs(base)
+    texts = [f"legacy row {i}" for i in range(20)]
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(hash_embed(["x"]).shape[1]))
+    index.add_with_ids(hash_embed(texts), np.arange(20, dtype="int64"))
+    faiss.write_index(index, os.path.join(base, "faiss.index"))
+    with open(os.path.join(base, "docstore.json"), "w") as f:
+        json.dump({str(i): {"page_content": t, "metadata": {"source": "old.txt"}} for i, t in enumerate(texts)}, f)
+
+    loc = rag._LAYOUT.locate(user_id)
+    results, errors = [], []
+
+    def load():
+        try:
+            results.append(rag._read_store(loc))
+        except Exception as e:  # pragma: no cover - the failure being tested for
+            errors.append(e)
+
+    threads = [threading.Thread(target=load) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert not errors
+    assert all(len(store.docstore) == 20 for store in results)
+    assert sorted(os.listdir(base)) == ["docstore.bin", "faiss.index"]
+    hits = rag.rag_search(user_id, "legacy row 7", k=1)
+    assert hits[0]["text"] == "legacy row 7"
@@ -0,0 +1,89 @@
+# backend/tests/test_embedder.py
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.rag import embedder
+from app.rag.embedder import OnnxEmbedder, make_embedder
+
+
+class FakeTokenizer:
+    """Token i of a text is its i-th word's length; pads with 0 to the batch max."""
+
+    def encode_batch(self, texts):
+        toks = [[len(w) for w in t.split()] for t in texts]
+        width = max(len(t) for t in toks)
+        return [
+            SimpleNamespace(
+                ids=t + [0] * (width - len(t)),
+                attention_mask=[1] * len(t) + [0] * (width - len(t)),
+                type_ids=[0] * width,
+            )
+            for t in toks
+        ]
+
+
+class FakeSession:
+    """Hidden state of token t is [t, 1, 0]; padding rows are garbage."""
+
+    def __init__(self):
+        self.feeds = []
+
+    def run(self, outputs, feed):
+        self.feeds.append(feed)
+        ids = feed["input_ids"].astype("float32")
+        hidden = np.stack([ids, np.ones_like(ids), np.zeros_like(ids)], axis=-1)
+        hidden[feed["attention_mask"] == 0] = 99.0
+        return [hidden]
+
+
+def _onnx(pooling="mean"):
+    emb = OnnxEmbedder.__new__(OnnxEmbedder)
+    emb._tokenizer = FakeTokenizer()
+    emb._session = FakeSession()
+    emb._inputs = {"input_ids", "attention_mask"}
+    emb._pooling = pooling
+    return emb
+
+
+def test_onnx_mean_pooling_ignores_padding():
+    vecs = _onnx().encode(["aa bbbb", "a"])
+    expected = np.array([[3.0, 1.0, 0.0], [1.0, 1.0, 0.0]], dtype="float32")
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    assert np.allclose(vecs, expected)
+    assert np.allclose(np.linalg.norm(vecs, axis=1), 1.0)
+
+
+def test_onnx_batches_by_length_and_keeps_input_order(monkeypatch):
+    monkeypatch.setattr(embedder, "EMBEDDINGS_BATCH_SIZE", 2)
+    emb = _onnx(pooling="cls")
+    texts = ["a a a a", "bb", "ccc ccc ccc", "d"]
+    vecs = emb.encode(texts)
+    # cls pooling keeps the first token: its value is the first word's length
+    firsts = vecs[:, 0] / vecs[:, 1]
+    assert np.allclose(firsts, [1, 2, 3, 1])
+    # "d" + "bb" share one batch, the two long texts the other
+    assert [f["input_ids"].shape[1] for f in emb._session.feeds] == [1, 4]
+    assert "token_type_ids" not in emb._session.feeds[0]
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError, match="EMBEDDINGS_BACKEND"):
+        make_embedder("tensorflow", "any-model")
+
+
+@pytest.mark.skipif(
+    not os.getenv("RAG_TEST_EMBEDDING_PARITY"),
+    reason="downloads the model; set RAG_TEST_EMBEDDING_PARITY=1",
+)
+@pytest.mark.parametrize("backend", [embedder.FASTEMBED, embedder.ONNX])
+def test_backends_match_sentence_transformers(backend):
+    pytest.importorskip("sentence_transformers")
+    model = "sentence-transformers/all-MiniLM-L6-v2"
+    texts = ["The quick brown fox.", "Quarterly revenue grew 12% year over year."]
+    reference = make_embedder(embedder.HF, model).encode(texts)
+    vecs = make_embedder(backend, model).encode(texts)
+    assert vecs.shape == reference.shape
+    assert np.all(np.sum(vecs * reference, axis=1) > 0.99)
@@ -0,0 +1,90 @@
+# backend/tests/test_lexical.py
+import numpy as np
+import pytest
+
+from app.rag.lexical import LexicalIndex, corpus_stats, tokenize
+
+TEXTS = [
+    "the cat sat on the mat",
+    "the dog chased the cat",
+    "error err-404 raised by the gateway",
+    "the the the the the the the the cat",
+]
+IDS = [1, 2, 5, 9]
+
+
+@pytest.fixture
+def lex():
+    return LexicalIndex.build(IDS, TEXTS)
+
+
+def _same(a, b):
+    for q in ("cat", "the dog", "404", "gateway mat"):
+        sa, ia = a.search(q, 4)
+        sb, ib = b.search(q, 4)
+        assert ia.tolist() == ib.tolist() and np.allclose(sa, sb)
+
+
+def test_identifiers_are_kept_whole_and_split():
+    assert tokenize("Err-404 at v1.2") == ["err-404", "err", "404", "at", "v1.2", "v1", "2"]
+
+
+def test_bm25_prefers_rare_terms_and_short_docs(lex):
+    _, ids = lex.search("cat", 4)
+    # same tf everywhere; the long, padded chunk comes last
+    assert ids[-1] == 9 and set(ids.tolist()) == {1, 2, 9}
+    _, ids = lex.search("the dog", 4)
+    assert ids[0] == 2  # "dog" is rare, "the" is everywhere
+    _, ids = lex.search("err-404", 4)
+    assert ids.tolist() == [5]
+    assert lex.search("unicorn", 4)[1].size == 0
+
+
+def test_allowed_mask_filters_inside_the_search(lex):
+    allowed = np.zeros(10, dtype=bool)
+    allowed[[2, 9]] = True
+    _, ids = lex.search("cat", 1, allowed=allowed)
+    assert ids.tolist() == [2]
+
+
+def test_derived_indexes_match_a_rebuild(lex):
+    grown = LexicalIndex.build(IDS[:2], TEXTS[:2]).appended(IDS[2:], TEXTS[2:])
+    _same(grown, lex)
+    _same(lex.without_ids(np.array([2, 5])), LexicalIndex.build([1, 9], [TEXTS[0], TEXTS[3]]))
+
+
+def test_save_load_round_trip(lex, tmp_path):
+    path = str(tmp_path / "lexical.bin")
+    lex.save(path)
+    _same(LexicalIndex.load(path), lex)
+    _same(LexicalIndex.from_bytes(lex.to_bytes()), lex)
+
+
+def test_shared_corpus_stats_make_scores_comparable(lex):
+    left = LexicalIndex.build(IDS[:2], TEXTS[:2])
+    right = LexicalIndex.build(IDS[2:], TEXTS[2:])
+    stats = corpus_stats([left, right], "cat")
+    merged = np.concatenate([left.search("cat", 4, corpus=stats)[0], right.search("cat", 4, corpus=stats)[0]])
+    assert np.allclose(np.sort(merged), np.sort(lex.search("cat", 4)[0]))
+
+
+def test_rrf_ranks_docs_found_by_both_lists_first(rag):
+    scores, ids = rag._fuse_rrf([np.array([7, 3, 1]), np.array([3, 8])], k=3)
+    assert ids.tolist() == [3, 7, 8]
+    assert scores[0] == pytest.approx(1 / (rag.RAG_RRF_K + 2) + 1 / (rag.RAG_RRF_K + 1))
+
+
+def test_store_lexical_and_hybrid_modes(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "runbook.txt", [
+        {"text": "restart the gateway after error err-404"},
+        {"text": "the gateway serves traffic"},
+        {"text": "rotate the credentials monthly"},
+    ])
+    hits = rag.rag_search(user_id, "err-404", k=3, mode="lexical")
+    assert [h["text"] for h in hits] == ["restart the gateway after error err-404"]
+
+    hits = rag.rag_search(user_id, "restart gateway err-404", k=3, mode="hybrid")
+    assert hits[0]["text"] == "restart the gateway after error err-404"
+    # first in both the dense and the BM25 list
+    assert hits[0]["score"] == pytest.approx(2 / (rag.RAG_RRF_K + 1))
+    assert all(h["metadata"]["source"] == "runbook.txt" for h in hits)
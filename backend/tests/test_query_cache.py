@@ -0,0 +1,43 @@
+# backend/tests/test_query_cache.py
+import uuid
+
+import numpy as np
+import pytest
+
+from conftest import hash_embed
+
+
+@pytest.fixture
+def embedded(rag, monkeypatch):
+    seen = []
+
+    def embed(texts):
+        seen.extend(texts)
+        return hash_embed(texts)
+
+    monkeypatch.setattr(rag, "_embed_texts", embed)
+    return seen
+
+
+def test_variants_of_a_query_embed_once(rag, embedded):
+    word = uuid.uuid4().hex
+    vecs = rag._embed_queries([f"find {word}", f"  find\t{word} ", f"ｆｉｎｄ {word}"])
+    assert embedded == [f"find {word}"]
+    assert np.array_equal(vecs[0], vecs[1]) and np.array_equal(vecs[0], vecs[2])
+
+    rag._embed_queries([f"find {word}", f"other {word}"])
+    assert embedded == [f"find {word}", f"other {word}"]
+
+
+def test_redis_tier_fills_the_process_cache(rag, embedded, monkeypatch):
+    word = uuid.uuid4().hex
+    shared = {}
+    monkeypatch.setattr(rag, "RAG_QUERY_CACHE_REDIS", True)
+    monkeypatch.setattr(rag, "_redis_mget", lambda keys, stats: [shared.get(k) for k in keys])
+    monkeypatch.setattr(rag, "_redis_set_many", lambda items, ttl, stats: shared.update(items))
+
+    first = rag._embed_queries([word])
+    rag._QUERY_CACHE.clear()  # another worker: only Redis has the vector
+    second = rag._embed_queries([word])
+    assert embedded == [word]
+    assert np.array_equal(first, second)
@@ -0,0 +1,53 @@
+# backend/tests/test_rag_compaction.py
+from app.rag import ann
+
+
+def test_major_compaction_does_not_undo_a_promotion(rag, user_id, monkeypatch):
+    rechecked = []
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: rechecked.append(uid))
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {i}"} for i in range(300)])
+    rag._compact(user_id, rag.MAJOR)
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "beta"}])
+
+    # the promotion lands between the compaction's snapshot and its swap
+    fold = rag._fold
+
+    def fold_then_promote(store, deltas, tombstones):
+        fold(store, deltas, tombstones)
+        rag._promote(user_id, rag._load_or_build(user_id))
+
+    monkeypatch.setattr(rag, "_fold", fold_then_promote)
+    rechecked.clear()
+    rag._compact(user_id, rag.MAJOR)
+
+    store = rag._load_or_build(user_id)
+    assert ann.index_kind(store.index) == ann.promotion_kind()
+    assert sum(len(d) for d in store.deltas) == 1  # left for the next compaction
+    assert rechecked == [user_id]
+    assert {h["text"] for h in rag.rag_search(user_id, "beta", k=1)} == {"beta"}
+
+
+def test_append_only_compaction_keeps_the_hnsw_graph(rag, user_id, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: None)
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {i}"} for i in range(300)])
+    rag._compact(user_id, rag.MAJOR)
+    rag._promote(user_id, rag._load_or_build(user_id))
+    assert ann.index_kind(rag._load_or_build(user_id).index) == ann.HNSW
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "beta"}])
+
+    rebuilds, backfills = [], []
+    build, backfill = ann.build_trained, rag._backfill_sources
+    monkeypatch.setattr(ann, "build_trained", lambda *a: rebuilds.append(a) or build(*a))
+    monkeypatch.setattr(rag, "_backfill_sources", lambda store: backfills.append(1) or backfill(store))
+    rag._compact(user_id, rag.MAJOR)
+
+    store = rag._load_or_build(user_id)
+    assert not store.deltas and store.index.ntotal == 301
+    assert ann.index_kind(store.index) == ann.HNSW
+    assert rebuilds == [] and backfills == []
+    assert rag.rag_search(user_id, "beta", k=1)[0]["text"] == "beta"
+
+    # a real delete still has to rebuild the graph
+    rag.delete_source(user_id, "b.txt")
+    rag._compact(user_id, rag.MAJOR)
+    assert len(rebuilds) == 1 and rag._load_or_build(user_id).index.ntotal == 300
@@ -0,0 +1,45 @@
+# backend/tests/test_rag_corpora.py
+import io
+
+import pytest
+
+
+@pytest.fixture
+def corpus(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+    monkeypatch.setattr(rag, "RAG_SHARED_CORPORA", ["handbook"])
+    rag.upsert_chunks_for_source(rag.corpus_store_id("handbook"), "policy.txt", [{"text": "vacation policy days"}])
+    return "handbook"
+
+
+def test_federated_search_merges_shared_corpus(rag, user_id, corpus):
+    rag.upsert_chunks_for_source(user_id, "notes.txt", [{"text": "my vacation plans"}])
+    hits = rag.rag_search_federated(user_id, "vacation policy days", [corpus], k=2)
+    assert [h.get("corpus") for h in hits] == [corpus, None]
+
+
+def test_federated_search_rejects_unshared_corpus(rag, user_id, corpus):
+    rag.upsert_chunks_for_source(rag.corpus_store_id("private"), "secret.txt", [{"text": "vacation secret"}])
+    with pytest.raises(ValueError, match="private"):
+        rag.rag_search_federated(user_id, "vacation", [corpus, "private"], k=5)
+
+
+def test_admin_ingests_into_a_corpus(rag, user_id, corpus, monkeypatch):
+    admin = pytest.importorskip("app.api.admin")
+    from fastapi import HTTPException, UploadFile
+    from app.core.security import Authed
+
+    monkeypatch.setattr(admin, "RAG_CORPUS_ADMINS", {"ops"})
+    with pytest.raises(HTTPException) as err:
+        admin.require_corpus_admin(Authed(user_id=user_id))
+    assert err.value.status_code == 403
+
+    ops = admin.require_corpus_admin(Authed(user_id="ops"))
+    upload = UploadFile(file=io.BytesIO(b"Expense reports are due monthly."), filename="expenses.txt")
+    out = admin.upload_corpus_file(corpus, file=upload, user=ops)
+    assert out["ok"] and out["shared"] and out["chunks_added"] >= 1
+
+    listed = admin.list_corpus_files(corpus, user=ops)
+    assert {f["source"] for f in listed["files"]} == {"policy.txt", "expenses.txt"}
+    hits = rag.rag_search_federated(user_id, "expense reports due", [corpus], k=1)
+    assert hits[0]["corpus"] == corpus and hits[0]["metadata"]["source"] == "expenses.txt"
@@ -0,0 +1,57 @@
+# backend/tests/test_rag_durability.py
+import os
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+@pytest.fixture
+def events(rag, monkeypatch):
+    """fsync'd paths and WAL resets, in the order they happen."""
+    log = []
+    fsync = os.fsync
+
+    def tracking_fsync(fd):
+        fsync(fd)
+        log.append(("fsync", os.readlink(f"/proc/self/fd/{fd}")))
+
+    reset = rag.WriteAheadLog.reset
+
+    def tracking_reset(wal):
+        log.append(("reset", wal.path))
+        reset(wal)
+
+    monkeypatch.setattr(os, "fsync", tracking_fsync)
+    monkeypatch.setattr(rag.WriteAheadLog, "reset", tracking_reset)
+    return log
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to name fds")
+def test_dedicated_checkpoint_is_durable_before_the_wal_goes(rag, user_id, events, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_PACK_MAX_BYTES", 0)
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"row {i}"} for i in range(5)])
+    events.clear()
+    rag._compact(user_id, rag.MAJOR)
+
+    base = rag._LAYOUT.dedicated_dir(user_id)
+    manifest = rag._store_files(base)[2]
+    done = events.index(("reset", rag._LAYOUT.wal_path(user_id)))
+    synced = [path for kind, path in events[:done] if kind == "fsync"]
+    gen_dir = os.path.join(base, rag._gen_name(rag._load_or_build(user_id).manifest["base_gen"]))
+    for path in rag._store_files(gen_dir):
+        if os.path.basename(path) != "manifest.json":
+            assert any(p.startswith(os.path.dirname(path) + os.sep) for p in synced)
+    assert gen_dir in synced and base in synced
+    # the manifest's data, then its rename, before the log is dropped
+    assert synced.index(base) > max(i for i, p in enumerate(synced) if p.startswith(manifest))
+
+
+def test_segments_commit_with_full_sync(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "row"}])
+    rag._compact(user_id, rag.MAJOR)
+    conn, _ = rag._LAYOUT._conn(rag._LAYOUT.segment_for(user_id), create=False)
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2  # FULL
@@ -0,0 +1,49 @@
+# backend/tests/test_rag_filters.py
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    # the tests fold deltas themselves; no background compaction racing them
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+def test_filter_keeps_ids_at_top_of_range(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "low.txt", [{"text": f"common word {i}"} for i in range(1000)])
+    rag.upsert_chunks_for_source(user_id, "high.txt", [{"text": f"common word top {i}"} for i in range(5)])
+    # fold the deltas into the base, so the filter runs as a faiss IDSelectorBitmap
+    rag._compact(user_id, rag.MAJOR)
+    store = rag._load_or_build(user_id)
+    assert not store.deltas and store.index.ntotal == 1005
+
+    hits = rag.rag_search(user_id, "common word top", k=10, filters={"source": "high.txt"})
+    assert sorted(h["text"] for h in hits) == sorted(f"common word top {i}" for i in range(5))
+
+
+def test_filter_excludes_everything_outside_allowed(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {i}"} for i in range(13)])
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"alpha beta {i}"} for i in range(3)])
+    rag._compact(user_id, rag.MAJOR)
+
+    hits = rag.rag_search(user_id, "alpha", k=50, filters={"source": "a.txt"})
+    assert len(hits) == 13
+    assert {h["metadata"]["source"] for h in hits} == {"a.txt"}
+
+
+def test_id_selector_rejects_ids_past_the_bitmap():
+    import faiss
+    import numpy as np
+
+    from app.rag import ann
+
+    rng = np.random.default_rng(0)
+    vecs = rng.standard_normal((4096, 8)).astype("float32")
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(8))
+    index.add_with_ids(vecs, np.arange(4096, dtype="int64"))
+
+    allowed = np.zeros(21, dtype=bool)
+    allowed[[0, 7, 8, 19, 20]] = True  # the top ids of the mask included
+    sel, bits = ann.id_selector(allowed)
+    _, ids = index.search(vecs[:64], 50, params=ann.search_params(index, {}, sel=sel))
+    found = set(ids[ids >= 0].tolist())
+    assert found == {0, 7, 8, 19, 20}
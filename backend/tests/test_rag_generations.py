@@ -0,0 +1,24 @@
+# backend/tests/test_rag_generations.py
+import os
+import time
+
+
+def test_idle_store_reclaims_its_retired_generations(rag, user_id, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_PACK_MAX_BYTES", 0)  # a dedicated store, with gen-* dirs
+    monkeypatch.setattr(rag, "RAG_GENERATION_GRACE_SECONDS", 0.2)
+    monkeypatch.setattr(rag, "_maybe_compact", lambda uid, store: None)
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {i}"} for i in range(20)])
+    for i in range(3):
+        rag.upsert_chunks_for_source(user_id, f"b{i}.txt", [{"text": f"beta {i}"}])
+        rag._compact(user_id, rag.MAJOR)  # a new base generation each
+    base = rag._LAYOUT.locate(user_id).base
+    assert len([n for n in os.listdir(base) if n.startswith("gen-")]) > 1
+
+    # no further writes: the reaper alone has to clean up
+    deadline = time.monotonic() + 5
+    while len([n for n in os.listdir(base) if n.startswith("gen-")]) > 1 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert [n for n in os.listdir(base) if n.startswith("gen-")] == [rag._gen_name(
+        rag._load_or_build(user_id).manifest["base_gen"]
+    )]
+    assert len(rag.rag_search(user_id, "alpha", k=5)) == 5
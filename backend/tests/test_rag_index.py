@@ -0,0 +1,82 @@
+# backend/tests/test_rag_index.py
+import numpy as np
+import pytest
+
+from conftest import hash_embed
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+@pytest.fixture
+def embedded(rag, monkeypatch):
+    """Texts that reach the embedding model."""
+    seen = []
+
+    def embed(texts):
+        seen.extend(texts)
+        return hash_embed(texts)
+
+    monkeypatch.setattr(rag, "_embed_texts", embed)
+    return seen
+
+
+def _ids(rag, user_id, source):
+    return rag._ids_for_source(rag._load_or_build(user_id), source).tolist()
+
+
+def test_delete_keeps_other_sources_ids(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id} {i}"} for i in range(4)])
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"beta {user_id} {i}"} for i in range(3)])
+    kept = _ids(rag, user_id, "b.txt")
+
+    assert rag.delete_source(user_id, "a.txt") == 4
+    assert _ids(rag, user_id, "a.txt") == []
+    assert _ids(rag, user_id, "b.txt") == kept
+    hits = rag.rag_search(user_id, f"alpha beta {user_id}", k=10)
+    assert {h["metadata"]["source"] for h in hits} == {"b.txt"}
+
+
+def test_reupload_embeds_only_the_new_chunks(rag, user_id, embedded):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id} {i}"} for i in range(4)])
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"beta {user_id} {i}"} for i in range(3)])
+    kept = _ids(rag, user_id, "b.txt")
+    embedded.clear()
+
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id} v2"}])
+    assert embedded == [f"alpha {user_id} v2"]
+    assert _ids(rag, user_id, "b.txt") == kept
+    assert len(_ids(rag, user_id, "a.txt")) == 1
+    # ids are never reused: the new chunk sorts after every earlier one
+    assert min(_ids(rag, user_id, "a.txt")) > max(kept)
+
+
+def test_delete_of_unknown_source_is_a_noop(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id}"}])
+    assert rag.delete_source(user_id, "missing.txt") == 0
+    assert np.asarray(_ids(rag, user_id, "a.txt")).size == 1
+
+
+def test_empty_store_never_loads_the_model(rag, user_id, embedded):
+    assert rag.rag_search(user_id, "anything", k=3) == []
+    assert rag.delete_source(user_id, "a.txt") == 0
+    assert rag.upsert_chunks_for_source(user_id, "a.txt", []) == 0
+    assert embedded == []
+
+
+def test_manifest_records_the_embedding(rag, user_id, embedded):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"alpha {user_id}"}])
+    rag._compact(user_id, rag.MAJOR)
+    rag.delete_source(user_id, "a.txt")
+    rag._compact(user_id, rag.MAJOR)
+    embedded.clear()
+
+    rag._INDEX_CACHE.invalidate(user_id)
+    store = rag._load_or_build(user_id)
+    info = store.manifest["embedding"]
+    assert (info["model"], info["dim"], info["normalize"]) == (rag.EMBED_MODEL, 32, True)
+    # emptied, but the dimension comes back from the manifest, not the model
+    assert store.index is not None and store.index.d == 32 and store.index.ntotal == 0
+    assert embedded == []
@@ -0,0 +1,66 @@
+# backend/tests/test_rag_packing.py
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from conftest import hash_embed
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+def _texts(rag, user_id, query="row", k=100):
+    return sorted(h["text"] for h in rag.rag_search(user_id, query, k=k))
+
+
+def test_small_store_round_trips_through_its_segment(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"row a{i}"} for i in range(10)])
+    rag._compact(user_id, rag.MAJOR)
+    loc = rag._LAYOUT.locate(user_id)
+    assert loc.kind == rag.PACKED
+    assert not os.path.exists(rag._LAYOUT.dedicated_dir(user_id))
+    assert {"docstore.bin", "manifest.json"} <= set(rag._LAYOUT.read_blobs(user_id))
+
+    before = _texts(rag, user_id)
+    rag._INDEX_CACHE.invalidate(user_id)
+    store = rag._load_or_build(user_id)
+    assert store.packed and len(store.docstore) == 10
+    assert _texts(rag, user_id) == before
+
+
+def test_store_moves_out_of_its_segment_when_it_grows(rag, user_id, monkeypatch):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"row a{i}"} for i in range(10)])
+    rag._compact(user_id, rag.MAJOR)
+    size = sum(len(b) for b in rag._LAYOUT.read_blobs(user_id).values())
+
+    monkeypatch.setattr(rag, "RAG_PACK_MAX_BYTES", size)
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"row b{i}"} for i in range(40)])
+    rag._compact(user_id, rag.MAJOR)
+    loc = rag._LAYOUT.locate(user_id)
+    assert loc.kind == rag.DEDICATED and loc.base == rag._LAYOUT.dedicated_dir(user_id)
+    assert rag._LAYOUT.read_blobs(user_id) == {}
+
+    rag._INDEX_CACHE.invalidate(user_id)
+    assert not rag._load_or_build(user_id).packed
+    assert len(_texts(rag, user_id)) == 50
+
+
+def test_pack_small_stores_adopts_legacy_directories(rag, user_id):
+    base = rag._LAYOUT.legacy_dir(user_id)
+    os.makedirs(base)
+    texts = [f"row {i}" for i in range(5)]
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(hash_embed(["x"]).shape[1]))
+    index.add_with_ids(hash_embed(texts), np.arange(5, dtype="int64"))
+    faiss.write_index(index, os.path.join(base, "faiss.index"))
+    with open(os.path.join(base, "docstore.json"), "w") as f:
+        json.dump({str(i): {"page_content": t, "metadata": {"source": "old.txt"}} for i, t in enumerate(texts)}, f)
+
+    assert rag.pack_small_stores() >= 1
+    assert not os.path.exists(base)
+    assert rag._LAYOUT.locate(user_id).kind == rag.PACKED
+    assert _texts(rag, user_id) == texts
@@ -0,0 +1,44 @@
+# backend/tests/test_rag_search.py
+import pytest
+
+from conftest import hash_embed
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+@pytest.fixture
+def corpus(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"apple {i} orchard"} for i in range(10)])
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": f"river {i} bridge"} for i in range(10)])
+    rag._compact(user_id, rag.MAJOR)
+    rag.upsert_chunks_for_source(user_id, "c.txt", [{"text": "apple river delta"}])  # stays a delta
+    return user_id
+
+
+def _key(hits):
+    return [(h["text"], round(h["score"], 5)) for h in hits]
+
+
+@pytest.mark.parametrize("mode", ["vector", "lexical", "hybrid"])
+def test_batch_matches_single_queries(rag, corpus, mode):
+    queries = ["apple orchard", "", "river bridge", "apple river"]
+    batched = rag.rag_search_many(corpus, queries, k=4, mode=mode)
+    assert len(batched) == len(queries) and batched[1] == []
+    for query, hits in zip(queries, batched):
+        if query:
+            assert _key(hits) == _key(rag.rag_search(corpus, query, k=4, mode=mode))
+
+
+def test_batch_embeds_all_queries_in_one_call(rag, corpus, monkeypatch):
+    calls = []
+
+    def embed(texts):
+        calls.append(list(texts))
+        return hash_embed(texts)
+
+    monkeypatch.setattr(rag, "_embed_texts", embed)
+    rag.rag_search_many(corpus, [f"orchard query {corpus} {i}" for i in range(5)], k=2, mode="vector")
+    assert len(calls) == 1 and len(calls[0]) == 5
@@ -0,0 +1,40 @@
+# backend/tests/test_rag_sources.py
+import json
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+def _rewrite_manifest_on_disk(rag, user_id, edit):
+    raw = rag._LAYOUT.read_blob(user_id, "manifest.json")
+    manifest = edit(json.loads(raw))
+    payload = json.dumps(manifest).encode("utf-8")
+    rag._LAYOUT.write_packed(user_id, {"manifest.json": payload}, replace=False)
+
+
+def test_listing_keeps_the_store_cached_for_readers(rag, user_id):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "alpha"}])
+    store = rag._load_or_build(user_id)
+    # another worker checkpoints: the cached store is now a generation behind
+    _rewrite_manifest_on_disk(rag, user_id, lambda m: dict(m, generation=m["generation"] + 1))
+
+    assert [s["source"] for s in rag.list_sources(user_id)] == ["a.txt"]
+    assert rag._INDEX_CACHE.peek(user_id) is store
+
+
+def test_sources_of_a_legacy_store_are_backfilled_once(rag, user_id, monkeypatch):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "alpha"}, {"text": "beta"}])
+    _rewrite_manifest_on_disk(rag, user_id, lambda m: {k: v for k, v in m.items() if k != "sources"})
+    rag._INDEX_CACHE.invalidate(user_id)
+
+    calls = []
+    backfill = rag._backfill_sources
+    monkeypatch.setattr(rag, "_backfill_sources", lambda store: calls.append(1) or backfill(store))
+    for _ in range(3):
+        assert [(s["source"], s["chunks"]) for s in rag.list_sources(user_id)] == [("a.txt", 2)]
+    assert len(calls) == 1
+    assert "sources" in json.loads(rag._LAYOUT.read_blob(user_id, "manifest.json"))
@@ -0,0 +1,63 @@
+# backend/tests/test_rag_storage.py
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+@pytest.fixture
+def dedicated(rag, monkeypatch):
+    monkeypatch.setattr(rag, "RAG_PACK_MAX_BYTES", 0)
+
+
+def test_idle_dedicated_index_is_memory_mapped(rag, user_id, dedicated, monkeypatch):
+    if not rag._MMAP_IO_FLAGS:
+        pytest.skip("faiss build without mmap support")
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"m{i} n{i}"} for i in range(50)])
+    rag._compact(user_id, rag.MAJOR)
+
+    monkeypatch.setattr(rag, "RAG_MMAP_MIN_BYTES", 1)
+    monkeypatch.setattr(rag, "RAG_MMAP_IDLE_SECONDS", 0)
+    rag._INDEX_CACHE.invalidate(user_id)
+    store = rag._load_or_build(user_id)
+    assert store.mmapped
+    top = rag.rag_search(user_id, "m3 n3", k=1)[0]
+
+    # writers work on a deserialized copy; the mapping stays read-only
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "fresh row"}])
+    rag._compact(user_id, rag.MAJOR)
+    assert rag.rag_search(user_id, "fresh row", k=1)[0]["text"] == "fresh row"
+    assert rag.rag_search(user_id, "m3 n3", k=1)[0]["score"] == pytest.approx(top["score"])
+
+
+def test_recently_written_index_is_read_into_memory(rag, user_id, dedicated, monkeypatch):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": f"m{i}"} for i in range(20)])
+    rag._compact(user_id, rag.MAJOR)
+    monkeypatch.setattr(rag, "RAG_MMAP_MIN_BYTES", 1)
+    monkeypatch.setattr(rag, "RAG_MMAP_IDLE_SECONDS", 3600)
+    rag._INDEX_CACHE.invalidate(user_id)
+    assert not rag._load_or_build(user_id).mmapped
+
+
+def test_file_stamp_sees_a_same_size_same_mtime_replace(rag, tmp_path):
+    import os
+
+    path = str(tmp_path / "manifest.json")
+    with open(path, "w") as f:
+        f.write('{"generation": 1}')
+    st = os.stat(path)
+    before = rag._file_stamp(path)
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write('{"generation": 2}')
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    keep = path + ".old"
+    os.link(path, keep)  # keep the old inode alive so it cannot be reused
+    os.replace(tmp, path)
+
+    after = rag._file_stamp(path)
+    assert after[:2] == before[:2]
+    assert after != before
@@ -0,0 +1,73 @@
+# backend/tests/test_result_cache.py
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def manual_compaction(rag, monkeypatch):
+    monkeypatch.setattr(rag, "_maybe_compact", lambda user_id, store: None)
+
+
+@pytest.fixture
+def searches(rag, monkeypatch):
+    """Queries that actually reach the index."""
+    seen = []
+    search = rag._search_generation
+
+    def counting(store, queries, *args):
+        seen.extend(queries)
+        return search(store, queries, *args)
+
+    monkeypatch.setattr(rag, "_search_generation", counting)
+    return seen
+
+
+def test_repeated_query_is_served_from_cache(rag, user_id, searches):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "apple orchard"}])
+    first = rag.rag_search(user_id, "apple", k=3)
+    assert rag.rag_search(user_id, "  apple ", k=3) == first
+    assert searches == ["apple"]
+    # k, mode and filters are part of the key
+    rag.rag_search(user_id, "apple", k=2)
+    rag.rag_search(user_id, "apple", k=3, mode="lexical")
+    assert len(searches) == 3
+
+
+def test_write_invalidates_cached_results(rag, user_id, searches):
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "apple orchard"}])
+    assert len(rag.rag_search(user_id, "apple", k=3)) == 1
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "apple pie"}])
+    assert len(rag.rag_search(user_id, "apple", k=3)) == 2
+    rag.delete_source(user_id, "a.txt")
+    assert [h["text"] for h in rag.rag_search(user_id, "apple", k=3)] == ["apple pie"]
+    assert searches == ["apple"] * 3
+
+
+def test_generation_bump_elsewhere_is_a_miss(rag, user_id, searches, monkeypatch):
+    # another worker's compaction never reaches this process's _drop_results;
+    # the generation in the entry's version is what retires it
+    monkeypatch.setattr(rag, "_drop_results", lambda uid: None)
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "apple orchard"}])
+    before = rag.rag_search(user_id, "apple", k=3)
+    generation = rag._generation(rag._load_or_build(user_id))
+    rag._compact(user_id, rag.MAJOR)
+    assert rag._generation(rag._load_or_build(user_id)) > generation
+
+    assert rag.rag_search(user_id, "apple", k=3) == before
+    assert searches == ["apple", "apple"]
+
+
+def test_redis_tier_is_keyed_by_version(rag, user_id, searches, monkeypatch):
+    shared = {}
+    monkeypatch.setattr(rag, "RAG_RESULT_CACHE_REDIS", True)
+    monkeypatch.setattr(rag, "_redis_mget", lambda keys, stats: [shared.get(k) for k in keys])
+    monkeypatch.setattr(rag, "_redis_set_many", lambda items, ttl, stats: shared.update(items))
+    rag.upsert_chunks_for_source(user_id, "a.txt", [{"text": "apple orchard"}])
+
+    first = rag.rag_search(user_id, "apple", k=3)
+    rag._RESULT_CACHE.clear()  # another worker: only Redis has the result
+    assert rag.rag_search(user_id, "apple", k=3) == first
+    assert searches == ["apple"]
+
+    rag.upsert_chunks_for_source(user_id, "b.txt", [{"text": "apple pie"}])
+    assert len(rag.rag_search(user_id, "apple", k=3)) == 2
+    assert searches == ["apple", "apple"]
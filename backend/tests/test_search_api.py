@@ -0,0 +1,38 @@
+# backend/tests/test_search_api.py
+import pytest
+
+
+@pytest.fixture
+def api(monkeypatch):
+    search = pytest.importorskip("app.api.search")
+    from app.core.security import Authed
+
+    def bad_request(*args, **kwargs):
+        raise ValueError("Unknown search filter(s): colour")
+
+    monkeypatch.setattr(search, "rag_search", bad_request)
+    monkeypatch.setattr(search, "rag_search_many", bad_request)
+    return search, Authed(user_id="test-api")
+
+
+def test_invalid_search_is_a_client_error(api):
+    from fastapi import HTTPException
+
+    search, user = api
+    with pytest.raises(HTTPException) as err:
+        search.search_docs(search.SearchIn(query="q"), user=user)
+    assert err.value.status_code == 400 and "colour" in err.value.detail
+
+    with pytest.raises(HTTPException) as err:
+        search.search_docs_batch(search.SearchBatchIn(queries=["q"]), user=user)
+    assert err.value.status_code == 400
+
+
+def test_search_params_on_pgvector_is_a_conflict(api, rag, monkeypatch):
+    from fastapi import HTTPException
+
+    search, user = api
+    monkeypatch.setattr(rag, "RAG_BACKEND", rag.PGVECTOR)
+    with pytest.raises(HTTPException) as err:
+        search.rag_search_params(search.SearchParamsIn(ef_search=128), user=user)
+    assert err.value.status_code == 409 and "RAG_PG_EF_SEARCH" in err.value.detail
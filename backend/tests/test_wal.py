@@ -0,0 +1,34 @@
+# backend/tests/test_wal.py
+import multiprocessing
+import os
+import time
+
+from app.rag import wal
+
+
+def _hold(path, slot, seconds, started):
+    with wal.exclusive(path, slot):
+        started.set()
+        time.sleep(seconds)
+
+
+def test_exclusive_slots_lock_across_processes(tmp_path):
+    path = str(tmp_path / "shard" / ".locks")
+    started = multiprocessing.Event()
+    other = multiprocessing.Process(target=_hold, args=(path, 7, 0.5, started))
+    other.start()
+    try:
+        assert started.wait(10)
+        t0 = time.monotonic()
+        with wal.exclusive(path, 8):  # a neighbouring slot is free
+            assert time.monotonic() - t0 < 0.2
+        with wal.exclusive(path, 7):  # the held one waits for the other process
+            assert time.monotonic() - t0 > 0.3
+    finally:
+        other.join()
+
+
+def test_writers_leave_no_file_per_tenant(rag, user_id):
+    assert rag.delete_source(user_id, "missing.txt") == 0
+    shard = os.path.dirname(rag._LAYOUT.wal_path(user_id))
+    assert not [name for name in os.listdir(shard) if user_id in name]
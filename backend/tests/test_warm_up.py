@@ -0,0 +1,61 @@
+# backend/tests/test_warm_up.py
+import threading
+import time
+
+import pytest
+
+from conftest import hash_embed
+
+
+class FakeEmbedder:
+    backend = "fake"
+    model_name = "fake-model"
+    loads = 0
+
+    def __init__(self):
+        FakeEmbedder.loads += 1
+        time.sleep(0.05)  # a slow load, so concurrent callers overlap
+        self.batches = []
+
+    def encode(self, texts):
+        self.batches.append(list(texts))
+        return hash_embed(texts)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    # the real _embed_texts / _get_model path, with the model construction faked
+    from app.rag import index
+
+    FakeEmbedder.loads = 0
+    monkeypatch.setattr(index, "_MODEL", None)
+    monkeypatch.setattr(index, "make_embedder", lambda backend, name: FakeEmbedder())
+    return index
+
+
+def test_warm_up_loads_and_exercises_the_model(model):
+    report = model.warm_up()
+    assert FakeEmbedder.loads == 1 and report["dim"] == 32
+    assert len(model._MODEL.batches) == 1 and len(model._MODEL.batches[0]) == 4
+    # the first real request reuses the warm model
+    model._embed_texts(["hello"])
+    assert FakeEmbedder.loads == 1
+
+
+def test_concurrent_first_use_loads_the_model_once(model):
+    threads = [threading.Thread(target=model._get_model) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert FakeEmbedder.loads == 1
+
+
+def test_readiness_follows_warm_up(monkeypatch):
+    health = pytest.importorskip("app.api.health")
+    monkeypatch.setattr(health, "_STATE", {"ready": False, "error": None, "embeddings": None})
+    assert health.health_ready().status_code == 503
+    health.mark_ready({"dim": 32})
+    assert health.health_ready().status_code == 200
+    health.mark_failed("model download failed")
+    assert health.health_ready().status_code == 503